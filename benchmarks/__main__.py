@@ -0,0 +1,4 @@
+from benchmarks.suite import main, set_parser_arguments
+
+
+main(set_parser_arguments())
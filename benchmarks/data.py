@@ -0,0 +1,104 @@
+from clcrypto import password_hash
+from datetime import datetime, timedelta
+from itertools import accumulate
+from models import Message, User, transaction
+import random
+
+
+"""
+Password of every generated user. Hash is computed once and shared, so generating users costs no hashing.
+"""
+PASSWORD = 'Benchmark1'
+
+WORDS = ('hello', 'meeting', 'tomorrow', 'project', 'report', 'lunch', 'thanks', 'question', 'invoice', 'deadline',
+         'coffee', 'review', 'release', 'holiday', 'weekend', 'call', 'budget', 'draft', 'urgent', 'update')
+
+
+class Dataset:
+    """
+    Description of generated data, used by benchmarks to pick users with known traits.
+    """
+    def __init__(self, seed, usernames, user_ids, senders, hot_inboxes, message_count):
+        self.seed = seed
+        self.password = PASSWORD
+        self.usernames = usernames
+        self.user_ids = user_ids
+        # user ids, the most active sender first
+        self.senders = senders
+        # user ids of the biggest inboxes
+        self.hot_inboxes = hot_inboxes
+        self.message_count = message_count
+        self._usernames_by_id = dict(zip(user_ids, usernames))
+
+    def username_of(self, user_id):
+        return self._usernames_by_id[user_id]
+
+    def typical_users(self, count):
+        """
+        :return: list of user ids which are neither hot inboxes nor top senders
+        """
+        excluded = set(self.hot_inboxes) | set(self.senders[:len(self.senders) // 100 + 1])
+        return [user_id for user_id in self.user_ids if user_id not in excluded][:count]
+
+    def describe(self):
+        return {'seed': self.seed,
+                'users': len(self.user_ids),
+                'messages': self.message_count,
+                'hot_inboxes': len(self.hot_inboxes)}
+
+
+def power_law_weights(count, exponent):
+    """
+    :param count: number of items
+    :param exponent: how steep the distribution is, 0 means uniform. float type
+    :return: cumulative weights of items ranked 1..count, weight of rank r is 1 / r ** exponent
+    """
+    return list(accumulate(1 / rank ** exponent for rank in range(1, count + 1)))
+
+
+def generate(users=1000, messages=20000, seed=1, sender_exponent=1.2, hot_inboxes=3, hot_share=0.3,
+             days=90, batch_size=5000):
+    """
+    Fills empty DB (generated usernames cannot exist yet) with users and messages. The same seed gives the same data.
+    Senders follow power law - a few users send most of messages. hot_share of messages go to a few hot inboxes,
+    the rest to recipients chosen uniformly.
+
+    :param users: number of users, int type
+    :param messages: number of messages, int type
+    :param seed: random seed, int type
+    :param sender_exponent: power law exponent of senders, float type
+    :param hot_inboxes: number of huge inboxes, int type
+    :param hot_share: part of messages which go to hot inboxes, float between 0 and 1
+    :param days: messages are spread over this many days before now, int type
+    :param batch_size: number of rows inserted in one transaction, int type
+    :return: Dataset object
+    """
+    rng = random.Random(seed)
+    hashed = password_hash(PASSWORD)
+    usernames = ['user{:07d}'.format(number) for number in range(users)]
+    for start in range(0, users, batch_size):
+        with transaction() as unit:
+            User.copy_many(unit.cursor(), [(username, hashed) for username in usernames[start:start + batch_size]])
+    with transaction() as unit:
+        _cursor = unit.cursor()
+        _cursor.execute("SELECT username, id FROM users;")
+        ids_by_name = dict(_cursor.fetchall())
+    user_ids = [ids_by_name[username] for username in usernames]
+
+    senders = list(user_ids)
+    rng.shuffle(senders)
+    sender_weights = power_law_weights(users, sender_exponent)
+    hot = rng.sample(user_ids, min(hot_inboxes, users))
+    now = datetime.utcnow()
+    for start in range(0, messages, batch_size):
+        batch = list()
+        for i in range(start, min(start + batch_size, messages)):
+            from_id = rng.choices(senders, cum_weights=sender_weights)[0]
+            to_id = rng.choice(hot) if hot and rng.random() < hot_share else rng.choice(user_ids)
+            text = ' '.join(rng.choice(WORDS) for word in range(rng.randint(3, 30)))
+            creation_date = now - timedelta(seconds=rng.uniform(0, days * 86400))
+            # unsaved message with past creation date - id -1 like in Message(), save_many() sets the real one
+            batch.append(Message.from_row([-1, text, from_id, to_id, True, creation_date]))
+        with transaction() as unit:
+            Message.save_many(unit.cursor(), batch)
+    return Dataset(seed, usernames, user_ids, senders, hot, messages)
@@ -0,0 +1,81 @@
+import json
+import math
+import time
+
+
+def percentile(sorted_values, q):
+    """
+    :param sorted_values: sorted list of numbers
+    :param q: quantile, float between 0 and 1
+    :return: nearest-rank q-quantile, None for empty list
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(q * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(durations, elapsed=None):
+    """
+    :param durations: list of call durations in seconds
+    :param elapsed: wall time of the whole run in seconds, sum of durations if not given
+    :return: dict with number of calls, latency (ms) percentiles and throughput (calls per second)
+    """
+    durations = sorted(durations)
+    elapsed = elapsed if elapsed is not None else sum(durations)
+    to_ms = lambda value: None if value is None else round(value * 1000, 4)
+    return {'iterations': len(durations),
+            'mean_ms': to_ms(sum(durations) / len(durations)) if durations else None,
+            'min_ms': to_ms(durations[0]) if durations else None,
+            'p50_ms': to_ms(percentile(durations, 0.5)),
+            'p99_ms': to_ms(percentile(durations, 0.99)),
+            'max_ms': to_ms(durations[-1]) if durations else None,
+            'throughput': round(len(durations) / elapsed, 2) if elapsed else None}
+
+
+def measure(func, iterations=100, warmup=5, setup=None):
+    """
+    Calls func iterations times and measures each call.
+
+    :param func: measured function, called with arguments returned by setup
+    :param iterations: number of measured calls, int type
+    :param warmup: number of calls made before measuring, int type
+    :param setup: function with no arguments run before every call, not measured. Returns tuple of func arguments
+        or None
+    :return: dict, see summarize()
+    """
+    durations = list()
+    for i in range(warmup + iterations):
+        args = setup() if setup is not None else None
+        start = time.perf_counter()
+        func(*(args or ()))
+        duration = time.perf_counter() - start
+        if i >= warmup:
+            durations.append(duration)
+    return summarize(durations)
+
+
+def load_results(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def compare(baseline, current, metric='p50_ms', threshold=0.2):
+    """
+    Compares two benchmark result files.
+
+    :param baseline: results of reference run, dict loaded from JSON
+    :param current: results of checked run, dict loaded from JSON
+    :param metric: compared latency metric, e.g. 'p50_ms' or 'p99_ms'
+    :param threshold: relative slowdown treated as regression, e.g. 0.2 is 20%
+    :return: list of tuples (benchmark name, baseline value, current value, relative change, regressed)
+    """
+    rows = list()
+    for name in sorted(set(baseline['results']) & set(current['results'])):
+        old = baseline['results'][name].get(metric)
+        new = current['results'][name].get(metric)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        rows.append((name, old, new, change, change > threshold))
+    return rows
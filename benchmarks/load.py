@@ -0,0 +1,423 @@
+"""
+Load generator - drives the same functions as users and messages programs (save_new_user, send_message,
+load_user_messages, delete_message) from many threads or processes, and reports throughput, latency percentiles,
+error rate and DB connections over time. Run with: python -m benchmarks.load --help
+"""
+from argparse import ArgumentParser
+from benchmarks.data import PASSWORD, generate
+from benchmarks.harness import percentile, summarize
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import redirect_stdout
+from helpers import authenticate
+import io
+import json
+import models
+from messages import delete_message, load_user_messages, send_message
+from models import Message, transaction
+from models.migrations import migrate
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from users import save_new_user
+
+
+class LoadError(Exception):
+    """
+    Raised by operation which did not do its job, counted as error.
+    """
+
+
+class Context:
+    """
+    Data shared by operations of one worker thread: generated users and random generator of the thread.
+    """
+    def __init__(self, users, seed, prefix):
+        self.users = users
+        self.rng = random.Random(seed)
+        self.prefix = prefix
+        self.created = 0
+
+    def random_user(self):
+        return self.rng.choice(self.users)
+
+    def new_username(self):
+        self.created += 1
+        return '{}x{}'.format(self.prefix, self.created)
+
+
+def logged_in(context):
+    user_id, username = context.random_user()
+    user = authenticate(username, PASSWORD)
+    if not user:
+        raise LoadError('login of {} failed'.format(username))
+    return user
+
+
+def op_create(context):
+    with transaction():
+        save_new_user(context.new_username(), PASSWORD)
+
+
+def op_send(context):
+    with transaction():
+        send_message(logged_in(context), [context.random_user()[0]], 'load test message')
+
+
+def op_list(context):
+    with transaction():
+        load_user_messages(logged_in(context), 20)
+
+
+def op_delete(context):
+    with transaction() as unit:
+        user = logged_in(context)
+        newest = list(Message.iter_messages_for_user(unit.cursor(), user.id, 1))
+        if newest:
+            delete_message(user, str(newest[0].id))
+
+
+"""
+OPERATIONS maps operation names used in --mix to functions. Each one runs as one transaction, like a program run.
+"""
+OPERATIONS = {'create': op_create, 'send': op_send, 'list': op_list, 'delete': op_delete}
+
+
+def parse_mix(text):
+    """
+    :param text: --mix argument, e.g. 'send=50,list=30,delete=10,create=10'
+    :return: tuple (list of operation names, list of their weights). None if text is invalid
+    """
+    names, weights = list(), list()
+    try:
+        for part in text.split(','):
+            name, weight = part.split('=')
+            if name.strip() not in OPERATIONS or float(weight) < 0:
+                return None
+            names.append(name.strip())
+            weights.append(float(weight))
+    except ValueError:
+        return None
+    if not sum(weights):
+        return None
+    return names, weights
+
+
+"""
+DROPPED is error of operation which was not started in --rate mode, because workers were behind schedule.
+Its sample has no latency.
+"""
+DROPPED = 'dropped: workers behind schedule'
+
+
+class Recorder:
+    """
+    Thread-safe list of samples: (finish time, operation name, latency in seconds or None, error message or None).
+    """
+    def __init__(self):
+        self.samples = list()
+        self._lock = threading.Lock()
+
+    def record(self, finished_at, name, seconds, error):
+        with self._lock:
+            self.samples.append((finished_at, name, seconds, error))
+
+    def since(self, index):
+        with self._lock:
+            return self.samples[index:]
+
+
+def run_operation(context, name, recorder, scheduled_at=None):
+    """
+    Runs operation and records it. In rate mode latency is counted from the time operation was scheduled,
+    so waiting for busy workers is part of it.
+    """
+    start = scheduled_at if scheduled_at is not None else time.perf_counter()
+    error = None
+    try:
+        OPERATIONS[name](context)
+    except Exception as exception:
+        error = '{}: {}'.format(type(exception).__name__, exception)
+    finished_at = time.perf_counter()
+    recorder.record(finished_at, name, finished_at - start, error)
+
+
+def run_load(config, users, recorder, deadline, seed):
+    """
+    Runs operations until deadline - closed loop of config['concurrency'] threads, each starting next operation
+    as soon as previous one ends, or, if config['rate'] is set, config['rate'] operations per second
+    started on schedule by pool of config['concurrency'] threads.
+
+    :return: None
+    """
+    names, weights = config['mix']
+    prefix = 'load{}p{}'.format(config['run_id'], seed)
+    local = threading.local()
+
+    def context():
+        if not hasattr(local, 'context'):
+            local.context = Context(users, hash((seed, threading.get_ident())), '{}t{}'.format(
+                prefix, threading.get_ident()))
+        return local.context
+
+    if config['rate']:
+        rng = random.Random(seed)
+        interval = 1 / config['rate']
+        # running operations plus one waiting for each thread - more would only queue up while workers fall behind
+        in_flight = threading.BoundedSemaphore(config['concurrency'] * 2)
+
+        def scheduled(name, scheduled_at):
+            try:
+                run_operation(context(), name, recorder, scheduled_at)
+            finally:
+                in_flight.release()
+
+        with ThreadPoolExecutor(config['concurrency']) as executor:
+            next_at = time.perf_counter()
+            while next_at < deadline:
+                delay = next_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                name = rng.choices(names, weights)[0]
+                if in_flight.acquire(blocking=False):
+                    executor.submit(scheduled, name, next_at)
+                else:
+                    recorder.record(time.perf_counter(), name, None, DROPPED)
+                next_at += interval
+        return
+
+    def loop():
+        while time.perf_counter() < deadline:
+            thread_context = context()
+            run_operation(thread_context, thread_context.rng.choices(names, weights)[0], recorder)
+
+    threads = [threading.Thread(target=loop, daemon=True) for i in range(config['concurrency'])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def connection_stats():
+    """
+    :return: dict with connections of models pool, and on postgres number of all connections to DB
+    """
+    stats = models.pool.stats()
+    if models.backend.name == 'postgres':
+        with transaction() as unit:
+            _cursor = unit.cursor()
+            _cursor.execute("SELECT count(*) FROM pg_stat_activity WHERE datname = current_database();")
+            stats['server'] = _cursor.fetchone()[0]
+    return stats
+
+
+def use_backend(config):
+    if config['backend'] == 'sqlite':
+        models.use_backend('sqlite', path=config['sqlite_path'])
+    else:
+        models.use_backend(config['backend'])
+
+
+def worker_process(config, users, index, started_at):
+    """
+    Runs load in child process, with its own connection pool, and samples pool every interval.
+    Times in results are relative to started_at, so samples of all processes can be merged.
+
+    :return: tuple (list of samples, list of (time, connection stats))
+    """
+    use_backend(config)
+    recorder = Recorder()
+    offset = time.time() - time.perf_counter()
+    deadline = started_at - offset + config['duration']
+    worker = threading.Thread(target=run_load, args=(config, users, recorder, deadline, config['seed'] + index),
+                              daemon=True)
+    pool_samples = list()
+    # output of operations is not needed, stdout is restored and devnull closed when load ends
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        worker.start()
+        while worker.is_alive():
+            worker.join(config['interval'])
+            pool_samples.append((time.perf_counter() + offset - started_at, models.pool.stats()))
+    samples = [(finished_at + offset - started_at, name, seconds, error)
+               for finished_at, name, seconds, error in recorder.samples]
+    return samples, pool_samples
+
+
+def interval_report(elapsed, samples, interval, connections):
+    """
+    :param elapsed: seconds since start of load, float type
+    :param samples: samples finished in this interval
+    :param interval: interval length in seconds
+    :param connections: connection stats dict
+    :return: dict - one row of report over time
+    """
+    latencies = sorted(sample[2] for sample in samples if sample[2] is not None)
+    errors = sum(1 for sample in samples if sample[3])
+    return {'time': round(elapsed, 1),
+            'throughput': round(len(latencies) / interval, 1),
+            'p50_ms': round(percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+            'error_rate': round(errors / len(samples), 4) if samples else 0,
+            'dropped': sum(1 for sample in samples if sample[3] == DROPPED),
+            'connections': connections}
+
+
+def print_interval(row, stream):
+    connections = row['connections']
+    print('{:>7.1f}s {:>9.1f} ops/s  p50 {:>9} ms  p99 {:>9} ms  errors {:>6.2%}  pool {}/{} used{}{}'.format(
+        row['time'], row['throughput'], row['p50_ms'], row['p99_ms'], row['error_rate'],
+        connections.get('used', 0), connections.get('opened', 0),
+        ', server {}'.format(connections['server']) if 'server' in connections else '',
+        '  dropped {}'.format(row['dropped']) if row['dropped'] else ''), file=stream)
+
+
+def summary(samples, duration):
+    """
+    :return: dict {operation name: latency summary with error count and rate}, 'all' for all operations.
+        Dropped operations have no latency, they are counted as errors and as dropped
+    """
+    by_name = {'all': samples}
+    for sample in samples:
+        by_name.setdefault(sample[1], list()).append(sample)
+    result = dict()
+    for name, name_samples in by_name.items():
+        result[name] = summarize([sample[2] for sample in name_samples if sample[2] is not None], elapsed=duration)
+        result[name]['errors'] = sum(1 for sample in name_samples if sample[3])
+        result[name]['dropped'] = sum(1 for sample in name_samples if sample[3] == DROPPED)
+        result[name]['error_rate'] = round(result[name]['errors'] / len(name_samples), 4) if name_samples else 0
+    return result
+
+
+def prepare(config, users, messages):
+    """
+    Migrates DB and, if it has no generated users yet, generates them with messages.
+
+    :return: list of (id, username) tuples of generated users
+    """
+    use_backend(config)
+    with redirect_stdout(io.StringIO()):
+        migrate()
+    with transaction() as unit:
+        _cursor = unit.cursor()
+        _cursor.execute("SELECT id, username FROM users WHERE username LIKE %s ORDER BY id;", ('user%',))
+        generated = _cursor.fetchall()
+    if not generated:
+        dataset = generate(users=users, messages=messages, seed=config['seed'])
+        generated = list(zip(dataset.user_ids, dataset.usernames))
+    return generated
+
+
+def run(args):
+    mix = parse_mix(args.mix)
+    if mix is None:
+        print('Invalid --mix, use e.g. send=50,list=30,delete=10,create=10 with operations: {}'.format(
+            ', '.join(OPERATIONS)))
+        return 1
+    config = {'backend': args.backend,
+              'sqlite_path': args.sqlite_path or os.path.join(tempfile.gettempdir(), 'warsztat2_load.db'),
+              'mix': mix,
+              'concurrency': args.concurrency,
+              'rate': args.rate / args.processes if args.rate and args.processes else args.rate,
+              'duration': args.duration,
+              'interval': args.interval,
+              'seed': args.seed,
+              'run_id': int(time.time())}
+    users = prepare(config, args.users, args.messages)
+    print('Load with {} users, mix {}, {} {} for {}s'.format(
+        len(users), args.mix, args.processes or 1, 'processes' if args.processes else 'process',
+        args.duration), flush=True)
+    report_stream = sys.stdout
+    rows = list()
+    if args.processes:
+        # children open their own connections, inherited ones must not be shared
+        models.pool.closeall()
+        started_at = time.time()
+        with ProcessPoolExecutor(args.processes) as executor:
+            futures = [executor.submit(worker_process, config, users, index, started_at)
+                       for index in range(args.processes)]
+            results = [future.result() for future in futures]
+        samples = sorted(sample for process_samples, pool_samples in results for sample in process_samples)
+        for step in range(1, int(args.duration / args.interval) + 1):
+            end = step * args.interval
+            connections = dict()
+            for process_samples, pool_samples in results:
+                latest = [stats for at, stats in pool_samples if at <= end + args.interval / 2][-1:]
+                for stats in latest:
+                    for key, value in stats.items():
+                        connections[key] = connections.get(key, 0) + value
+            interval_samples = [sample for sample in samples if end - args.interval <= sample[0] < end]
+            rows.append(interval_report(end, interval_samples, args.interval, connections))
+            print_interval(rows[-1], report_stream)
+    else:
+        recorder = Recorder()
+        start = time.perf_counter()
+        deadline = start + args.duration
+        worker = threading.Thread(target=run_load, args=(config, users, recorder, deadline, args.seed), daemon=True)
+        # output of operations is not needed - report goes to report_stream
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            worker.start()
+            seen = 0
+            while worker.is_alive():
+                interval_start = time.perf_counter()
+                worker.join(args.interval)
+                new_samples = recorder.since(seen)
+                seen += len(new_samples)
+                rows.append(interval_report(time.perf_counter() - start, new_samples,
+                                            time.perf_counter() - interval_start, connection_stats()))
+                print_interval(rows[-1], report_stream)
+        samples = [(finished_at - start, name, seconds, error) for finished_at, name, seconds, error in
+                   recorder.samples]
+    totals = summary(samples, args.duration)
+    print('\n{:10} {:>8} {:>10} {:>10} {:>10} {:>10} {:>8}'.format('operation', 'count', 'ops/s', 'p50 ms',
+                                                                  'p99 ms', 'max ms', 'errors'))
+    for name, stats in sorted(totals.items()):
+        print('{:10} {:>8} {:>10} {:>10} {:>10} {:>10} {:>8.2%}'.format(
+            name, stats['iterations'], stats['throughput'], stats['p50_ms'], stats['p99_ms'], stats['max_ms'],
+            stats['error_rate']))
+    errors = dict()
+    for sample in samples:
+        if sample[3]:
+            errors[sample[3]] = errors.get(sample[3], 0) + 1
+    for error, times in sorted(errors.items(), key=lambda item: -item[1])[:5]:
+        print('{} x {}'.format(times, error))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'meta': {'backend': args.backend, 'mix': args.mix, 'concurrency': args.concurrency,
+                                'rate': args.rate, 'processes': args.processes, 'duration': args.duration,
+                                'users': len(users)},
+                       'intervals': rows,
+                       'results': totals}, file, indent=2)
+        print('Results saved to {}'.format(args.output))
+    return 0
+
+
+def set_parser_arguments():
+    """
+    Sets all parser arguments.
+
+    :return: ArgumentParser class object which is used in main()
+    """
+    parser = ArgumentParser(prog='python -m benchmarks.load',
+                            description='Load test of users and messages workflows')
+    parser.add_argument('--backend', choices=('sqlite', 'postgres'), default='sqlite',
+                        help='sqlite file (default) or postgres DB from POSTGRES_* settings')
+    parser.add_argument('--sqlite-path', type=str, help='sqlite DB file, temporary directory by default')
+    parser.add_argument('--mix', type=str, default='send=40,list=40,delete=10,create=10',
+                        help='operations and their weights, from: {}'.format(', '.join(OPERATIONS)))
+    parser.add_argument('--concurrency', type=int, default=8, help='number of worker threads in each process')
+    parser.add_argument('--rate', type=float,
+                        help='target operations per second (all processes), default is as fast as workers can')
+    parser.add_argument('--processes', type=int, default=0, help='run load from this many processes')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load')
+    parser.add_argument('--interval', type=float, default=5, help='seconds between report rows')
+    parser.add_argument('--users', type=int, default=1000, help='number of users generated in empty DB')
+    parser.add_argument('--messages', type=int, default=20000, help='number of messages generated in empty DB')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    parser.add_argument('--output', type=str, help='save report as JSON to this file')
+    return parser
+
+
+if __name__ == '__main__':
+    sys.exit(run(set_parser_arguments().parse_args()))
@@ -0,0 +1,213 @@
+from argparse import ArgumentParser
+from benchmarks.data import generate
+from benchmarks.harness import compare, load_results, measure
+from clcrypto import check_password, password_hash
+from contextlib import redirect_stdout
+from datetime import datetime
+from functools import partial
+from itertools import count, cycle
+import io
+import json
+import models
+from models import Message, User, connector, transaction
+from models.migrations import migrate
+import platform
+import sys
+
+
+def prepare_db(backend_name, users, messages, seed):
+    """
+    Switches models to benchmark DB, migrates it and fills it with generated data.
+    sqlite runs in process memory. postgres uses POSTGRES_* settings and has to be an empty scratch DB.
+
+    :return: Dataset object
+    """
+    if backend_name == 'sqlite':
+        models.use_backend('sqlite', path=':memory:')
+    else:
+        models.use_backend(backend_name)
+    with redirect_stdout(io.StringIO()):
+        migrate()
+    return generate(users=users, messages=messages, seed=seed)
+
+
+def run_main(module, argv):
+    """
+    Runs main() of users or messages program with given command line, the same way as its __main__ block does.
+    Printed output is discarded.
+
+    :param module: users or messages module
+    :param argv: list of command line arguments
+    :return: None
+    """
+    parser = module.set_parser_arguments()
+    parser.parse_args = partial(parser.parse_args, argv)
+    with redirect_stdout(io.StringIO()), transaction():
+        module.main(parser)
+
+
+@connector
+def select_one(_cursor):
+    _cursor.execute("SELECT 1;")
+    return _cursor.fetchone()
+
+
+def save_message(sender_id, recipient_id):
+    message = Message()
+    message.from_id = sender_id
+    message.to_id = recipient_id
+    message.text = 'benchmark message'
+    with transaction() as unit:
+        message.save_to_db(unit.cursor())
+    return message
+
+
+def save_messages(sender_id, recipient_ids):
+    new_messages = list()
+    for recipient_id in recipient_ids:
+        message = Message()
+        message.from_id = sender_id
+        message.to_id = recipient_id
+        message.text = 'benchmark message'
+        new_messages.append(message)
+    with transaction() as unit:
+        Message.save_many(unit.cursor(), new_messages)
+
+
+def cold(func):
+    """
+    :return: setup function which clears user cache, so func runs like in a new process, and returns func() result
+    """
+    def setup():
+        models.user_cache.clear()
+        return func() if func is not None else None
+
+    return setup
+
+
+def collect_benchmarks(dataset):
+    """
+    :param dataset: Dataset object
+    :return: list of tuples (name, measured function, setup function or None)
+    """
+    import messages
+    import users
+
+    password = dataset.password
+    hashed = password_hash(password)
+    hot_id = dataset.hot_inboxes[0]
+    top_sender_id = dataset.senders[0]
+    typical = cycle(dataset.typical_users(50) or dataset.user_ids)
+    usernames = cycle(dataset.usernames)
+    new_usernames = ('benchmark{:07d}'.format(number) for number in count())
+
+    def in_transaction(func):
+        def wrapper(*args):
+            with transaction() as unit:
+                return func(unit.cursor(), *args)
+
+        return wrapper
+
+    def deletable_message():
+        return save_message(top_sender_id, next(typical)).id,
+
+    return [
+        ('crypto.password_hash', lambda: password_hash(password), None),
+        ('crypto.check_password', lambda: check_password(password, hashed), None),
+        ('connector.select_one', select_one, None),
+        ('user.load_by_username', in_transaction(User.load_user_by_username), cold(lambda: (next(usernames),))),
+        ('user.load_by_username.cached', in_transaction(User.load_user_by_username),
+         lambda: (dataset.usernames[0],)),
+        ('user.load_by_id', in_transaction(User.load_user_by_id), cold(lambda: (next(typical),))),
+        ('message.load_all_for_user.hot_inbox', in_transaction(Message.load_all_messages_for_user),
+         lambda: (hot_id,)),
+        ('message.load_all_for_user.typical', in_transaction(Message.load_all_messages_for_user),
+         lambda: (next(typical),)),
+        ('message.load_all_by_user.top_sender', in_transaction(Message.load_all_messages_by_user),
+         lambda: (top_sender_id,)),
+        ('message.save_to_db', save_message, lambda: (top_sender_id, next(typical))),
+        ('message.save_many.100', save_messages, lambda: (top_sender_id, [next(typical) for i in range(100)])),
+        ('scenario.users.create', lambda username: run_main(users, ['-u', username, '-p', password]),
+         cold(lambda: (next(new_usernames),))),
+        ('scenario.messages.list_page.hot_inbox',
+         lambda: run_main(messages, ['-u', dataset.username_of(hot_id), '-p', password, '-l', '--limit', '20']),
+         cold(None)),
+        ('scenario.messages.send',
+         lambda recipient: run_main(messages, ['-u', dataset.username_of(top_sender_id), '-p', password,
+                                               '-t', str(recipient), '-s', 'benchmark message']),
+         cold(lambda: (next(typical),))),
+        ('scenario.messages.delete',
+         lambda message_id: run_main(messages, ['-u', dataset.username_of(top_sender_id), '-p', password,
+                                                '-d', str(message_id)]),
+         cold(deletable_message)),
+    ]
+
+
+def run(args):
+    dataset = prepare_db(args.backend, args.users, args.messages, args.seed)
+    results = dict()
+    for name, func, setup in collect_benchmarks(dataset):
+        if args.only and not any(name.startswith(prefix) for prefix in args.only.split(',')):
+            continue
+        results[name] = measure(func, iterations=args.iterations, warmup=args.warmup, setup=setup)
+        print('{:45} p50 {:>10.3f} ms   p99 {:>10.3f} ms   {:>10.1f} ops/s'.format(
+            name, results[name]['p50_ms'], results[name]['p99_ms'], results[name]['throughput']))
+    report = {'meta': {'created_at': datetime.utcnow().isoformat(),
+                       'backend': models.backend.name,
+                       'python': platform.python_version(),
+                       'iterations': args.iterations,
+                       'dataset': dataset.describe()},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print('Results saved to {}'.format(args.output))
+
+
+def run_compare(args):
+    """
+    Prints comparison of two result files. Exit status is 1 if any benchmark regressed, so CI job can fail on it.
+    """
+    rows = compare(load_results(args.baseline), load_results(args.current), args.metric, args.threshold)
+    regressions = 0
+    for name, old, new, change, regressed in rows:
+        regressions += regressed
+        print('{:45} {:>10.3f} -> {:>10.3f} ms  {:>+7.1%}{}'.format(name, old, new, change,
+                                                                  '  REGRESSION' if regressed else ''))
+    if regressions:
+        print('{} benchmarks slower by more than {:.0%}'.format(regressions, args.threshold))
+        sys.exit(1)
+
+
+def set_parser_arguments():
+    """
+    Sets all parser arguments.
+
+    :return: ArgumentParser class object which is used in main()
+    """
+    parser = ArgumentParser(prog='python -m benchmarks', description='Benchmarks of models, crypto and programs')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='generate data and run benchmarks')
+    run_parser.add_argument('--backend', choices=('sqlite', 'postgres'), default='sqlite',
+                            help='sqlite in memory (default), or empty scratch postgres DB from POSTGRES_* settings')
+    run_parser.add_argument('--users', type=int, default=1000, help='number of generated users')
+    run_parser.add_argument('--messages', type=int, default=20000, help='number of generated messages')
+    run_parser.add_argument('--seed', type=int, default=1, help='random seed of generated data')
+    run_parser.add_argument('--iterations', type=int, default=200, help='measured calls of each benchmark')
+    run_parser.add_argument('--warmup', type=int, default=5, help='calls made before measuring')
+    run_parser.add_argument('--only', type=str, help='run only benchmarks with given name prefixes, comma separated')
+    run_parser.add_argument('--output', type=str, help='save results as JSON to this file')
+    compare_parser = commands.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('baseline', help='results of reference run')
+    compare_parser.add_argument('current', help='results of checked run')
+    compare_parser.add_argument('--metric', default='p50_ms', help='compared metric, e.g. p50_ms or p99_ms')
+    compare_parser.add_argument('--threshold', type=float, default=0.2,
+                                help='relative slowdown reported as regression, 0.2 means 20%%')
+    return parser
+
+
+def main(parser):
+    args = parser.parse_args()
+    if args.command == 'run':
+        return run(args)
+    return run_compare(args)
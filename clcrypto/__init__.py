@@ -1,6 +1,10 @@
+import base64
 import hashlib
-import random
+import hmac
+import os
+import secrets
 import string
+import time
 
 """
 ALPHABET is a global variable, that keeps all uppercase letter, all lowercase
@@ -32,19 +36,17 @@ def is_password_correct(password):
 
 def generate_salt():
     """
-    Generates a 16-character random salt.
+    Generates a 16-character random salt of legacy password hashes.
 
     :return: str with generated salt
     """
-    salt = ""
-    for i in range(0, 16):
-        salt += random.choice(ALPHABET)
-    return salt
+    return ''.join(secrets.choice(ALPHABET) for i in range(16))
 
 
-def password_hash(password, salt=None):
+def legacy_password_hash(password, salt=None):
     """
-    Hashes the password with salt as an optional parameter.
+    Hashes the password the old way - salt + sha256 hexdigest, 80 chars. Kept only to check passwords
+    of users who have not logged in since hashes were upgraded - new hashes are made by password_hash().
     If salt is not provided, generates random salt.
     If salt is less than 16 chars, fills the string to 16 chars.
     If salt is longer than 16 chars, cuts salt to 16 chars.
@@ -73,31 +75,271 @@ def password_hash(password, salt=None):
     return salt + t_sha.hexdigest()
 
 
+"""
+PASSWORD_KDF is key derivation function of new password hashes - 'scrypt' or 'pbkdf2_sha256'.
+PASSWORD_KDF_PARAMS overrides its KDF_DEFAULTS parameters, in the same format as they are stored in hash,
+e.g. 'n=32768,r=8,p=1' or 'i=600000'. Use python -m clcrypto --calibrate to pick them for given hardware.
+Hash format is $kdf$params$salt$key (salt and key in base64), so every hash is checked with its own parameters.
+"""
+KDF_DEFAULTS = {'scrypt': {'n': 2 ** 14, 'r': 8, 'p': 1},
+                'pbkdf2_sha256': {'i': 600000}}
+PASSWORD_KDF = os.environ.get('PASSWORD_KDF', 'scrypt')
+PASSWORD_KDF_PARAMS = os.environ.get('PASSWORD_KDF_PARAMS', '')
+SALT_BYTES = 16
+
+
+def format_params(params):
+    """
+    :param params: dict {name: int value}
+    :return: parameters in hash format, e.g. 'n=16384,p=1,r=8'
+    """
+    return ','.join('{}={}'.format(name, value) for name, value in sorted(params.items()))
+
+
+def parse_params(text):
+    """
+    :param text: parameters in hash format, e.g. 'n=16384,p=1,r=8'
+    :return: dict {name: int value}
+    """
+    return {name: int(value) for name, value in (item.split('=', 1) for item in text.split(',') if item)}
+
+
+def kdf_settings():
+    """
+    :return: tuple (kdf name, params dict) used for new password hashes - KDF_DEFAULTS updated with
+        PASSWORD_KDF_PARAMS
+    """
+    if PASSWORD_KDF not in KDF_DEFAULTS:
+        raise ValueError('Unknown PASSWORD_KDF {}, use one of: {}'.format(PASSWORD_KDF, ', '.join(KDF_DEFAULTS)))
+    params = dict(KDF_DEFAULTS[PASSWORD_KDF])
+    params.update(parse_params(PASSWORD_KDF_PARAMS))
+    return PASSWORD_KDF, params
+
+
+def derive_key(kdf, password, salt, params):
+    """
+    :param kdf: 'scrypt' or 'pbkdf2_sha256'
+    :param password: password, string type
+    :param salt: salt, bytes type
+    :param params: dict of kdf parameters - n, r, p for scrypt, i (iterations) for pbkdf2_sha256
+    :return: 32 bytes key
+    """
+    if kdf == 'scrypt':
+        n, r, p = params['n'], params['r'], params['p']
+        # scrypt needs about 128 * n * r bytes, OpenSSL default limit (32 MB) is too low for n above 2 ** 14
+        return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p, dklen=32,
+                              maxmem=256 * n * r + 2 ** 20)
+    if kdf == 'pbkdf2_sha256':
+        return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, params['i'], dklen=32)
+    raise ValueError('Unknown password KDF {}'.format(kdf))
+
+
+def b64encode(data):
+    return base64.b64encode(data).decode('ascii').rstrip('=')
+
+
+def b64decode(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+def password_hash(password, salt=None, kdf=None, params=None):
+    """
+    Hashes the password with salt as an optional parameter, using kdf with params.
+    If salt is not provided, generates random salt.
+    If kdf is not provided, PASSWORD_KDF with its configured parameters is used.
+
+    :param password: password to be hashed, string type
+    :param salt: salt, string or bytes type, optional
+    :param kdf: 'scrypt' or 'pbkdf2_sha256', optional
+    :param params: dict of kdf parameters, optional. Defaults to KDF_DEFAULTS of given kdf
+    :return: hash in $kdf$params$salt$key format, string type
+    """
+    if kdf is None:
+        kdf, configured = kdf_settings()
+        params = params or configured
+    params = params or KDF_DEFAULTS[kdf]
+    if salt is None:
+        salt = secrets.token_bytes(SALT_BYTES)
+    elif isinstance(salt, str):
+        salt = salt.encode('utf-8')
+    key = derive_key(kdf, password, salt, params)
+    return '${}${}${}${}'.format(kdf, format_params(params), b64encode(salt), b64encode(key))
+
+
 def check_password(pass_to_check, hashed):
     """
     Checks the password.
     The function does the following:
-        - gets the salt + hash joined,
-        - extracts salt and hash,
-        - hashes `pass_to_check` with extracted salt,
-        - compares `hashed` with hashed `pass_to_check`.
+        - takes kdf, its parameters and salt from `hashed` (legacy hashes: 16 chars salt and sha256),
+        - hashes `pass_to_check` the same way,
+        - compares both in constant time,
         - returns True if password is correct, or False. :)
     """
+    if hashed.startswith('$'):
+        try:
+            empty, kdf, params, salt, key = hashed.split('$')
+            new_key = derive_key(kdf, pass_to_check, b64decode(salt), parse_params(params))
+            correct = hmac.compare_digest(new_key, b64decode(key))
+        except (ValueError, KeyError):
+            correct = False
+    else:
+        new_hash = legacy_password_hash(pass_to_check, hashed[:16])
+        correct = hmac.compare_digest(new_hash[16:].encode('ascii'), hashed[16:].encode('utf-8'))
 
-    # extract salt
-    salt = hashed[:16]
-
-    # extract hash to compare with
-    hash_to_check = hashed[16:]
-
-    # hash password with extracted salt
-    new_hash = password_hash(pass_to_check, salt)
-
-    # compare hashes. If equal, return True
-    if new_hash[16:] == hash_to_check:
+    if correct:
         return True
     else:
         print('Logging error, wrong password. Try again')
         return False
 
 
+def needs_rehash(hashed):
+    """
+    Checks if hash should be upgraded - it is legacy hash, hash of other kdf than PASSWORD_KDF,
+    or any of its parameters is weaker than configured one. Stronger hashes are kept,
+    so nodes configured with different parameters do not rehash the same passwords back and forth.
+
+    :param hashed: hash of user password, string type
+    :return: True if password should be hashed again with password_hash(), otherwise False
+    """
+    kdf, params = kdf_settings()
+    parts = hashed.split('$')
+    if len(parts) != 5 or parts[1] != kdf:
+        return True
+    try:
+        stored = parse_params(parts[2])
+    except ValueError:
+        return True
+    return any(stored.get(name, 0) < value for name, value in params.items())
+
+
+def calibrate(target_ms=250, kdf=None):
+    """
+    Finds the strongest parameters of kdf for which checking password on this machine takes at most target_ms.
+    scrypt n (power of 2) is doubled, r=8 and p=1 are kept. pbkdf2_sha256 iterations are scaled from measured rate.
+
+    :param target_ms: target time of one password check in milliseconds
+    :param kdf: 'scrypt' or 'pbkdf2_sha256', defaults to PASSWORD_KDF
+    :return: tuple (kdf name, params dict, measured time in milliseconds)
+    """
+    kdf = kdf or PASSWORD_KDF
+    salt = secrets.token_bytes(SALT_BYTES)
+
+    def measure(params):
+        # best of 3 runs - ignores one-off hiccups of the machine
+        durations = list()
+        for i in range(3):
+            start = time.perf_counter()
+            derive_key(kdf, 'calibration', salt, params)
+            durations.append((time.perf_counter() - start) * 1000)
+        return min(durations)
+
+    if kdf == 'scrypt':
+        params = {'n': 2 ** 10, 'r': 8, 'p': 1}
+        duration = measure(params)
+        while params['n'] < 2 ** 20:
+            stronger = dict(params, n=params['n'] * 2)
+            stronger_duration = measure(stronger)
+            if stronger_duration > target_ms:
+                break
+            params, duration = stronger, stronger_duration
+        return kdf, params, duration
+    if kdf == 'pbkdf2_sha256':
+        sample = {'i': 10000}
+        iterations = int(sample['i'] * target_ms / measure(sample)) // 1000 * 1000
+        params = {'i': max(iterations, 1000)}
+        return kdf, params, measure(params)
+    raise ValueError('Unknown password KDF {}'.format(kdf))
+
+
+"""
+SESSION_SECRET signs session tokens. If it is not set, secret is generated once and kept in SESSION_SECRET_FILE.
+SESSION_TTL is session token lifetime in seconds.
+"""
+SESSION_SECRET_FILE = os.environ.get('SESSION_SECRET_FILE',
+                                     os.path.join(os.path.expanduser('~'), '.warsztat2', 'session_secret'))
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 12 * 60 * 60))
+
+
+def session_secret():
+    """
+    Returns secret used to sign session tokens - from SESSION_SECRET environment variable or secret file.
+    Secret file is created with random secret if it does not exist, readable only by its owner.
+
+    :return: bytes with secret
+    """
+    secret = os.environ.get('SESSION_SECRET')
+    if secret:
+        return secret.encode('utf-8')
+    try:
+        with open(SESSION_SECRET_FILE, 'rb') as file:
+            return file.read()
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(SESSION_SECRET_FILE), mode=0o700, exist_ok=True)
+    secret = base64.urlsafe_b64encode(os.urandom(32))
+    # secret is written to temporary file and linked in place, so other process never reads half written file
+    temporary = '{}.{}'.format(SESSION_SECRET_FILE, secrets.token_hex(8))
+    descriptor = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(descriptor, 'wb') as file:
+        file.write(secret)
+    try:
+        os.link(temporary, SESSION_SECRET_FILE)
+    except FileExistsError:
+        # other process has created secret file at the same time - everybody uses its secret
+        with open(SESSION_SECRET_FILE, 'rb') as file:
+            secret = file.read()
+    finally:
+        os.remove(temporary)
+    return secret
+
+
+def credentials_fingerprint(hashed_password):
+    """
+    Short signature of user's password hash, carried by session tokens. It changes with password,
+    so tokens issued before password change stop working.
+
+    :param hashed_password: password hash of user, string type
+    :return: fingerprint, string type
+    """
+    return hmac.new(session_secret(), b'credentials:' + hashed_password.encode('utf-8'),
+                    hashlib.sha256).hexdigest()[:16]
+
+
+def create_session_token(user_id, username, hashed_password, ttl=None):
+    """
+    Creates signed session token. Token carries user id, username, expiry time and fingerprint of password hash,
+    so it can be checked with one user lookup and without hashing password.
+
+    :param user_id: id of logged in user, int type
+    :param username: username of logged in user, string type
+    :param hashed_password: password hash of logged in user, string type
+    :param ttl: token lifetime in seconds, int type. Defaults to SESSION_TTL
+    :return: token, string type
+    """
+    expires = int(time.time()) + (ttl or SESSION_TTL)
+    payload = '{}:{}:{}:{}'.format(user_id, expires, credentials_fingerprint(hashed_password), username)
+    payload = base64.urlsafe_b64encode(payload.encode('utf-8'))
+    signature = hmac.new(session_secret(), payload, hashlib.sha256).hexdigest()
+    return payload.decode('ascii') + '.' + signature
+
+
+def check_session_token(token):
+    """
+    Checks signature and expiry time of session token.
+    Fingerprint has to be compared with current password hash of user, see credentials_fingerprint().
+
+    :param token: token created by create_session_token(), string type
+    :return: tuple (user_id, username, expires, fingerprint) if token is valid, otherwise None
+    """
+    try:
+        payload, signature = token.encode('ascii').split(b'.')
+        expected = hmac.new(session_secret(), payload, hashlib.sha256).hexdigest().encode('ascii')
+        if not hmac.compare_digest(signature, expected):
+            return None
+        user_id, expires, fingerprint, username = base64.urlsafe_b64decode(payload).decode('utf-8').split(':', 3)
+        if int(expires) < time.time():
+            return None
+        return int(user_id), username, int(expires), fingerprint
+    except (ValueError, UnicodeError):
+        return None
@@ -0,0 +1,46 @@
+from argparse import ArgumentParser
+from clcrypto import KDF_DEFAULTS, calibrate, format_params
+
+
+def set_parser_arguments():
+    """
+    Sets all parser arguments.
+
+    :return: ArgumentParser class object which is used in main()
+    """
+    parser = ArgumentParser(prog='python -m clcrypto', description='Password hashing tools')
+    parser.add_argument('--calibrate', action='store_true',
+                        help='find password KDF parameters for this machine')
+    parser.add_argument('--target-ms', type=float, default=250,
+                        help='target time of one password check in milliseconds, default 250')
+    parser.add_argument('--kdf', choices=sorted(KDF_DEFAULTS), help='calibrated KDF, defaults to PASSWORD_KDF')
+    return parser
+
+
+def main(parser):
+    """
+    Scenarios:
+        1. --calibrate is given:
+            Measures password KDF on this machine and prints settings to be used on nodes of the same class
+        2. Else scenario:
+            In any other case - function prints --help
+
+    :param parser: ArgumentParser class. Created in set_parser_arguments()
+    :return: None
+    """
+    args = parser.parse_args()
+
+    # Scenario no. 1
+    if args.calibrate:
+        kdf, params, duration = calibrate(args.target_ms, args.kdf)
+        print('Password check takes {:.1f} ms on this machine with settings:'.format(duration))
+        print('PASSWORD_KDF={}'.format(kdf))
+        print('PASSWORD_KDF_PARAMS={}'.format(format_params(params)))
+
+    # Scenario no. 2
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main(set_parser_arguments())
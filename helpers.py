@@ -1,10 +1,17 @@
 from models import User, connector
-from clcrypto import check_password
+from clcrypto import check_password, check_session_token, create_session_token, credentials_fingerprint, needs_rehash
+import hmac
+import json
+import os
 
 # Functions here are user by both programs, users and messages. Stored here to have more control over them
 
+# credentials cache keeps session tokens issued by --login, one per username
+CREDENTIALS_FILE = os.environ.get('CREDENTIALS_FILE',
+                                  os.path.join(os.path.expanduser('~'), '.warsztat2', 'credentials.json'))
+
 @connector
-def load_user(_cursor, username=None, id=None):
+def load_user(_cursor, username=None, id=None, fresh=False):
     """
     Loads User class object using User static methods.
     Depends which argument is passed, it will either load by username or by id.
@@ -12,12 +19,13 @@ def load_user(_cursor, username=None, id=None):
     :param _cursor: parameter passed with connector decorator
     :param username: optional argument, string type.
     :param id: optional argument, string type.
+    :param fresh: if True user is read from DB, not from cache - used whenever password or token is checked
     :return: User class object - regardless of optional argument choice. If no arguments passed - it will return None
     """
     if username:
-        return User().load_user_by_username(_cursor, username)
+        return User().load_user_by_username(_cursor, username, cached=not fresh)
     elif id:
-        return User().load_user_by_id(_cursor, id)
+        return User().load_user_by_id(_cursor, id, cached=not fresh)
     else:
         return None
 
@@ -52,7 +60,8 @@ def args_to_be_empty(*args):
 
 def logging_user(user, password):
     """
-    Validates given password with user password saved in DB
+    Validates given password with user password saved in DB.
+    After successful login legacy or weaker password hash is replaced with hash made with current KDF settings.
 
     :param user: User class object
     :param password: password user in log in, string type. Passed through parser
@@ -63,4 +72,122 @@ def logging_user(user, password):
         return False
     elif not check_password(password, user.hashed_password):
         return False
+    if needs_rehash(user.hashed_password):
+        upgrade_password_hash(user, password)
     return True
+
+
+@connector
+def upgrade_password_hash(_cursor, user, password):
+    """
+    Hashes password again with current KDF settings and saves it. Users are upgraded one by one as they log in,
+    so no bulk rehash of all accounts is needed.
+
+    :param _cursor: parameter passed with connector decorator
+    :param user: User class object, logged in with password
+    :param password: correct password of user, string type
+    :return: None
+    """
+    user.set_password(password)
+    user.save_to_db(_cursor)
+
+
+def read_credentials():
+    """
+    :return: dict {username: session token} read from credentials cache file, empty dict if there is no cache
+    """
+    try:
+        with open(CREDENTIALS_FILE) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_session(username, token):
+    """
+    Saves session token in credentials cache file. File is readable only by its owner.
+
+    :param username: username of logged in user, string type
+    :param token: session token, string type
+    :return: None
+    """
+    credentials = read_credentials()
+    credentials[username] = token
+    os.makedirs(os.path.dirname(CREDENTIALS_FILE), mode=0o700, exist_ok=True)
+    descriptor = os.open(CREDENTIALS_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, 'w') as file:
+        json.dump(credentials, file)
+
+
+def session_token(username, token=None):
+    """
+    :param username: username passed through parser, string type
+    :param token: token passed through parser, string type
+    :return: given token, or token cached for username by --login. None if there is neither
+    """
+    if token:
+        return token
+    if username:
+        return read_credentials().get(username)
+    return None
+
+
+def login(username, password):
+    """
+    Validates password and issues session token, which is saved in credentials cache.
+    Later commands of this user need no password to log in, until it expires or password is changed.
+
+    :param username: username passed through parser, string type
+    :param password: password passed through parser, string type
+    :return: session token if logging was successful, otherwise None
+    """
+    user = load_user(username=username, fresh=True)
+    if not logging_user(user, password):
+        return None
+    token = create_session_token(user.id, user.username, user.hashed_password)
+    save_session(user.username, token)
+    return token
+
+
+def authenticate(username, password, token=None):
+    """
+    Logs user in. With password - loads user from DB and validates password with logging_user().
+    Without password - uses session token (given or cached by --login), checked by session_user().
+
+    :param username: username passed through parser, string type
+    :param password: password passed through parser, string type
+    :param token: session token passed through parser, string type
+    :return: User class object if logging was successful, otherwise None. Prints fail statements
+    """
+    if password:
+        user = load_user(username=username, fresh=True)
+        return user if logging_user(user, password) else None
+    token = session_token(username, token)
+    user = session_user(token, username) if token else None
+    if not user:
+        print('Session expired or invalid, log in again with --login')
+        return None
+    return user
+
+
+def session_user(token, username=None):
+    """
+    Checks session token and loads its user. Token is accepted only if user still exists and his password
+    has not changed since token was issued - no password hashing is done.
+
+    :param token: session token, string type
+    :param username: if given, token has to belong to user of this username, string type
+    :return: User class object if token is valid, otherwise None
+    """
+    session = check_session_token(token)
+    if not session:
+        return None
+    user_id, session_username, expires, fingerprint = session
+    if username and session_username != username:
+        return None
+    user = load_user(id=user_id, fresh=True)
+    if not user or user.username != session_username:
+        return None
+    if not hmac.compare_digest(fingerprint, credentials_fingerprint(user.hashed_password)):
+        return None
+    return user
@@ -1,111 +1,400 @@
-from models import Message, connector
+import models
+from models import Message, User, connector, current_unit, transaction
 from argparse import ArgumentParser
-from helpers import load_user, args_to_be_empty, args_required, logging_user
+from datetime import datetime, timedelta
+from helpers import args_to_be_empty, args_required, authenticate, load_user, login
+
+
+def position_to_str(position):
+    """
+    Converts (creation_date, id) position of message into string used in page cursor.
+
+    :param position: (creation_date, id) tuple or None if there are no more messages
+    :return: string, '-' if position is None
+    """
+    if position is None:
+        return '-'
+    return '{}~{}'.format(position[0].isoformat(), position[1])
+
+
+def str_to_position(text):
+    """
+    Reverse of position_to_str().
+
+    :param text: part of page cursor, string type
+    :return: (creation_date, id) tuple or None if it is '-'
+    """
+    if text == '-':
+        return None
+    creation_date, message_id = text.rsplit('~', 1)
+    return datetime.fromisoformat(creation_date), int(message_id)
+
+
+def search_position_to_str(position):
+    """
+    Converts (rank, id) position of found message into page cursor of search results.
+    Rank is written with repr(), so it is read back as exactly the same float.
+
+    :param position: (rank, id) tuple
+    :return: '<rank>~<id>' string
+    """
+    return '{!r}~{}'.format(float(position[0]), position[1])
+
+
+def str_to_search_position(text):
+    """
+    Reverse of search_position_to_str().
+
+    :param text: page cursor of search results, string type
+    :return: (rank, id) tuple
+    :raises ValueError: if text is not valid cursor
+    """
+    rank, message_id = text.rsplit('~', 1)
+    return float(rank), int(message_id)
+
+
+def parse_page_cursor(cursor):
+    """
+    Page cursor keeps positions of last printed sent and received message: '<sent position>,<received position>'.
+    Position is '-' if section has no more messages.
+
+    :param cursor: page cursor printed by load_user_messages(), string type. None for first page
+    :return: tuple (sent position, received position, sent done, received done). None if cursor is invalid
+    """
+    if cursor is None:
+        return None, None, False, False
+    try:
+        sent, received = cursor.split(',')
+        return str_to_position(sent), str_to_position(received), sent == '-', received == '-'
+    except ValueError:
+        return None
+
+
+def parse_age(text):
+    """
+    Parses age given as number followed by unit: h (hours), d (days) or w (weeks), e.g. '90d'.
+
+    :param text: --older-than argument, string type
+    :return: timedelta object, None if text is not valid age
+    """
+    units = {'h': 'hours', 'd': 'days', 'w': 'weeks'}
+    text = text.strip().lower()
+    if len(text) < 2 or text[-1] not in units or not text[:-1].isdigit():
+        return None
+    return timedelta(**{units[text[-1]]: int(text[:-1])})
+
+
+def print_messages(messages, header, limit, position_of=lambda message: (message.creation_date, message.id),
+                   printed_ids=None):
+    """
+    Prints messages one by one, as they are streamed from DB.
+
+    :param messages: iterable of Message objects
+    :param header: format string of the first line of each message
+    :param limit: max number of messages to be printed, int type. None means no limit
+    :param position_of: function which returns keyset position of message, (creation_date, id) by default
+    :param printed_ids: list to which ids of printed messages are appended, None if they are not needed
+    :return: position of the last printed message if there are more messages, otherwise None
+    """
+    position = None
+    for printed, message in enumerate(messages):
+        if limit and printed == limit:
+            return position
+        print(header.format(message))
+        print("Time: {}\nMessage: {}\n".format(message.creation_date, message.text))
+        print('-' * 40)
+        position = position_of(message)
+        if printed_ids is not None:
+            printed_ids.append(message.id)
+    return None
 
 
 @connector
-def load_user_messages(_cursor, user):
+def load_user_messages(_cursor, user, limit=None, before=None):
     """
-    Loads all user messages, sent and received as well.
-    Prints them into console, one message per line.
+    Loads user messages, sent and received as well, newest first.
+    Prints them into console, one message per line, while they are streamed from DB.
+    With limit only one page of each section is printed, followed by cursor of the next page.
+    Printed received messages are marked as read.
 
     :param _cursor: parameter passed with connector decorator
     :param user: User class object , passed by main()
+    :param limit: max number of messages printed in each section, int type. None means all messages
+    :param before: page cursor printed with previous page, string type. None for first page
     :return: function has no return. Prints all messages into console instead.
     """
-    sent_messages = Message.load_all_messages_by_user(_cursor, user.id)
-    received_messages = Message.load_all_messages_for_user(_cursor, user.id)
+    page = parse_page_cursor(before)
+    if page is None:
+        print('Invalid page cursor, please check and try again')
+        return
+    sent_before, received_before, sent_done, received_done = page
+    # one extra message is fetched to know if there is a next page
+    fetch = limit + 1 if limit else None
+
     print("Sent messages".center(40, '-'))
-    for message in sent_messages:
-        print("id: {}; sent to: {};\nTime: {}\nMessage: {}\n".format(message.id,
-                                                                     message.to_id,
-                                                                     message.creation_date,
-                                                                     message.text))
-        print('-'*40)
+    sent_position = None
+    if not sent_done:
+        sent_messages = Message.iter_messages_by_user(_cursor, user.id, fetch, sent_before)
+        sent_position = print_messages(sent_messages, "id: {0.id}; sent to: {0.to_username} (id: {0.to_id});", limit)
+
     print("Received messages".center(40, '-'))
-    for message in received_messages:
-        print("id: {}; from: {};\nTime: {}\nMessage: {}\n".format(message.id,
-                                                                  message.from_id,
-                                                                  message.creation_date,
-                                                                  message.text))
-        print('-' * 40)
+    received_position = None
+    if not received_done:
+        received_messages = Message.iter_messages_for_user(_cursor, user.id, fetch, received_before)
+        read_ids = list()
+        received_position = print_messages(received_messages, "id: {0.id}; from: {0.from_username} (id: {0.from_id});",
+                                           limit, printed_ids=read_ids)
+        Message.mark_read(_cursor, user.id, read_ids)
+
+    if sent_position or received_position:
+        print("Next page: --before={},{}".format(position_to_str(sent_position),
+                                                  position_to_str(received_position)))
+
+
+def parse_recipients(to_user, to_file):
+    """
+    Collects recipient ids from --to argument (comma separated) and --to-file file
+    (ids separated by commas, spaces or new lines). Duplicates are removed, order is kept.
+
+    :param to_user: --to argument, string type or None
+    :param to_file: path to file with recipient ids, string type or None
+    :return: list of int ids, None if any id is invalid, none is given or file cannot be read
+    """
+    raw_ids = list()
+    if to_user:
+        raw_ids.extend(to_user.split(','))
+    if to_file:
+        try:
+            with open(to_file) as file:
+                for line in file:
+                    raw_ids.extend(line.replace(',', ' ').split())
+        except OSError as error:
+            print('Cannot read recipients file: {}'.format(error))
+            return None
+    try:
+        recipients = list(dict.fromkeys(int(raw_id) for raw_id in raw_ids if raw_id.strip()))
+    except ValueError:
+        print('Recipient ID has to be a number, please check and try again')
+        return None
+    if not recipients:
+        print('No recipient ID given, please check and try again')
+        return None
+    return recipients
+
+
+@connector
+def search_messages(_cursor, user, query, limit=None, before=None):
+    """
+    Searches messages user can see - sent by him, or received and not deleted - and prints them, best match first.
+    With limit only one page is printed, followed by cursor of the next page.
+
+    :param _cursor: parameter passed with connector decorator
+    :param user: User class object , passed by main()
+    :param query: searched words, string type
+    :param limit: max number of printed messages, int type. None means all found messages
+    :param before: page cursor printed with previous page, '<rank>~<id>' string. None for first page
+    :return: function has no return. Prints found messages into console instead.
+    """
+    if not query.split():
+        print('Search query is empty, please give at least one word')
+        return
+    position = None
+    if before:
+        try:
+            position = str_to_search_position(before)
+        except ValueError:
+            print('Invalid page cursor, please check and try again')
+            return
+    print("Search results".center(40, '-'))
+    found = Message.search(_cursor, user.id, query, limit + 1 if limit else None, position)
+    last = print_messages(found, "id: {0.id}; from: {0.from_username} (id: {0.from_id}); "
+                                 "to: {0.to_username} (id: {0.to_id});",
+                          limit, position_of=lambda message: (message.rank, message.id))
+    if last:
+        print("Next page: --before={}".format(search_position_to_str(last)))
 
 
 @connector
-def send_message(_cursor, user, to_user, message_text):
+def show_conversation(_cursor, user, other_username, limit=None, before=None):
     """
-    Sends message using Message-class methods. Launched by main().
+    Prints messages exchanged with other user, both directions, in time order.
+    With limit only the newest page is printed, followed by cursor of the previous (older) page.
+    Printed messages received by user are marked as read.
 
     :param _cursor: parameter passed with connector decorator
     :param user: User class object , passed by main()
-    :param to_user: recipient user id, string type
+    :param other_username: username of the other user, string type
+    :param limit: max number of printed messages, int type. None means whole conversation
+    :param before: page cursor printed with previous page, string type. None for the newest page
+    :return: function has no return. Prints messages into console instead.
+    """
+    try:
+        position = str_to_position(before) if before else None
+    except ValueError:
+        print('Invalid page cursor, please check and try again')
+        return
+    other_user = load_user(username=other_username)
+    if not other_user:
+        print('No such user in database')
+        return
+    conversation = Message.load_conversation(_cursor, user.id, other_user.id, limit + 1 if limit else None, position)
+    older = None
+    if limit and len(conversation) > limit:
+        # the extra, oldest message only tells there is an older page
+        conversation = conversation[1:]
+        older = (conversation[0].creation_date, conversation[0].id)
+    print("Conversation with {}".format(other_user.username).center(40, '-'))
+    print_messages(conversation, "id: {0.id}; from: {0.from_username}; to: {0.to_username};", None)
+    Message.mark_read(_cursor, user.id, [message.id for message in conversation if message.to_id == user.id])
+    if older:
+        print("Older messages: --before={}".format(position_to_str(older)))
+
+
+@connector
+def archive_messages(_cursor, older_than, drop=False):
+    """
+    Retention job: removes messages older than given age, see Message.archive().
+    Also creates partitions for the next months, so it is meant to be run periodically, e.g. daily from cron.
+
+    :param _cursor: parameter passed with connector decorator
+    :param older_than: --older-than argument, e.g. '90d', string type
+    :param drop: if True old partitions are dropped instead of detached, boolean type
+    :return: function has no return, prints summary into console
+    """
+    from models.migrations import ensure_partitions
+
+    age = parse_age(older_than)
+    if age is None:
+        print('Invalid --older-than, use number of hours, days or weeks, e.g. 90d')
+        return
+    partitions, deleted = Message.archive(_cursor, datetime.utcnow() - age, drop)
+    for partition in partitions:
+        print('Partition {} {}'.format(partition, 'dropped' if drop else 'detached as archived_' + partition))
+    print('{} old messages {}'.format(deleted, 'deleted' if drop else 'moved to archived_messages'))
+    created = ensure_partitions(_cursor)
+    if created:
+        print('{} new partitions created'.format(created))
+
+
+def follow_user_messages(user):
+    """
+    Prints messages sent to user as they arrive, until interrupted with Ctrl+C.
+    Waits for DB notifications, so no queries are run while there are no new messages.
+
+    :param user: User class object , passed by main()
+    :return: function has no return. Prints messages into console instead.
+    """
+    # asyncio, imported by notifications, is slow to import - only --follow needs it
+    from models.notifications import follow_messages
+
+    if not models.backend.notifications:
+        print('Following messages is not supported by {} storage, use postgres'.format(models.backend.name))
+        return
+    unit = current_unit()
+    if unit is not None:
+        # login is committed now, so following does not keep transaction open
+        unit.commit()
+    print("Waiting for new messages, press Ctrl+C to stop".center(40, '-'))
+    try:
+        print_messages(follow_messages(user.id), "id: {0.id}; from: {0.from_username} (id: {0.from_id});", None)
+    except KeyboardInterrupt:
+        pass
+
+
+@connector
+def count_messages(_cursor, user):
+    """
+    Prints counters of user's received messages. They are read from counters table, without counting messages.
+
+    :param _cursor: parameter passed with connector decorator
+    :param user: User class object , passed by main()
+    :return: function has no return. Prints counters into console instead.
+    """
+    counters = Message.mailbox_counters(_cursor, user.id)
+    print('Received messages: {total}, unread: {unread}, deleted: {hidden}'.format(**counters))
+
+
+@connector
+def send_message(_cursor, user, recipients, message_text):
+    """
+    Sends message to one or many recipients using Message-class methods. Launched by main().
+    All recipients are validated with one query and all messages are inserted in batches,
+    so sending to thousands of users costs a few round-trips.
+
+    :param _cursor: parameter passed with connector decorator
+    :param user: User class object , passed by main()
+    :param recipients: list of recipient user ids, int type
     :param message_text: message text, string type
     :return: function prints success statement if message is sent
     """
-    recipient = load_user(id=to_user)
-    if not recipient:
-        print('Recipient ID not found, please check and try again')
+    existing = User.existing_ids(_cursor, recipients)
+    missing = [recipient for recipient in recipients if recipient not in existing]
+    if missing:
+        print('Recipient ID not found: {}, please check and try again'.format(
+            ', '.join(str(recipient) for recipient in missing)))
         return
-    new_message = Message()
-    new_message.to_id = recipient.id
-    new_message.text = message_text
-    new_message.from_id = user.id
-    new_message.save_to_db(_cursor)
-    print('Message sent!')
+    new_messages = list()
+    for recipient in recipients:
+        new_message = Message()
+        new_message.to_id = recipient
+        new_message.text = message_text
+        new_message.from_id = user.id
+        new_messages.append(new_message)
+    sent = Message.save_many(_cursor, new_messages)
+    if sent == 1:
+        print('Message sent!')
+    else:
+        print('Message sent to {} recipients!'.format(sent))
 
 
 @connector
-def delete_message(_cursor, user, message_id):
+def delete_message(_cursor, user, message_ids):
     """
-    Deletes message of given ID. It has 4 scenarios:
+    Deletes messages of given IDs with one Message.delete_many_for_user() call. For each message there are 4 scenarios:
 
     Scenarios:
         1. Message ID is not valid.
                 Function did not find such message. Prints fail statement.
         2. User requesting deletion is Recipient and message is visibe for him
-                Function uses Message static method to make message invisible for Recipient. Sender still can see it.
+                Message is made invisible for Recipient. Sender still can see it.
         3. User requesting deletion is Sender
-                Function uses Message method to delete message. It will be deleted also for Recipient
+                Message is deleted. It will be deleted also for Recipient
         4. User is neither Sender nor Recipient
                 Function prints fail statement
 
     :param _cursor: parameter passed with connector decorator
     :param user: User class object , user which request delete message
-    :param message_id: message ID to be deleted, string type
+    :param message_ids: message ID to be deleted, or many IDs separated by commas, string type
     :return: function has no return, prints fail/success statemetns
     """
-    message = Message().load_message_by_id(_cursor, message_id)
+    message_ids = [message_id.strip() for message_id in message_ids.split(',') if message_id.strip()]
+    results = Message.delete_many_for_user(_cursor, message_ids, user.id)
+    for message_id, result in results.items():
+        # Scenario no. 1
+        if result == 'not found':
+            print('Message ID {} not found, please check and try again'.format(message_id))
 
-    # Scenario no. 1
-    if not message:
-        print('Message ID not found, please check and try again')
+        # Scenario no. 2 and 3
+        elif result in ('hidden', 'deleted'):
+            if len(results) == 1:
+                print('Message deleted!')
 
-    # Scenario no. 2
-    if message.to_id == user.id and message.is_visible:
-        message.recipient_delete_message()
-        message.save_to_db(_cursor)
-        print('Message deleted!')
-        return
-
-    # Scenario no. 3
-    elif message.from_id == user.id:
-        message.delete_by_sender(_cursor)
-        print('Message deleted!')
-        return
-
-    # Scenario no. 4
-    else:
-        print('You cannot delete this message, you are not sender nor recipient')
+        # Scenario no. 4
+        else:
+            print('You cannot delete message {}, you are not sender nor recipient'.format(message_id))
+    if len(results) > 1:
+        deleted = sum(1 for result in results.values() if result in ('hidden', 'deleted'))
+        print('{} of {} messages deleted!'.format(deleted, len(results)))
 
 
 def main(parser):
     """
     Main function of program. Collects all arguments from parser parameter.
-    Then loads User class object with given username.
-
-    Shield conditions:
-        1. Checks if given username is in DB, if not user is None
-        2. Try to log in user. Stops function if false (logging_user() prints fail statements)
+    When arguments match a scenario, logs user in - with --password, or with session token (--token, or cached by
+    --login for --username). authenticate() prints fail statements. With password, user is loaded from DB and password
+    is checked. With session token, user is loaded by id and token is checked against his current password hash,
+    no password hashing is done.
+    Wrong arguments combination prints help without logging in, so no DB connection is opened.
 
     Scenarios:
         1. --username , --password -l are given:
@@ -114,7 +403,19 @@ def main(parser):
             Sends message to targer user
         3. --username, --password, --delete are given:
             Deletes message
-        4. Else scenario:
+        4. --username, --password, --login are given:
+            Logs user in and saves session token in credentials cache
+        5. --username, --password, --search are given:
+            Searches messages user can see, optionally one page at a time (--limit, --before)
+        6. --username, --password, --count are given:
+            Prints number of received, unread and deleted messages
+        7. --username, --password, --with are given:
+            Prints conversation with other user, optionally one page at a time (--limit, --before)
+        8. --archive, --older-than are given:
+            Retention job, removes old messages of all users. Needs no login
+        9. --username, --password, --follow are given:
+            Prints new messages as they arrive, until interrupted
+        10. Else scenario:
             In any other case - function prints --help
 
 
@@ -126,36 +427,108 @@ def main(parser):
     password = args.password
     messages_list = args.list
     to_user = args.to
+    to_file = args.to_file
     message_text = args.send
     delete = args.delete
+    limit = args.limit
+    before = args.before
+    log_in = args.login
+    token = args.token
+    search = args.search
+    count = args.count
+    with_user = args.with_user
+    archive = args.archive
+    older_than = args.older_than
+    follow = args.follow
 
-    user = load_user(username)
-
-    # Shield conditions
-    if not user:
-        print('Invalid login')
-        return
-    if logging_user(user, password) is False:
+    # Scenario no. 4
+    if args_required(username, password, log_in) and \
+            args_to_be_empty(messages_list, to_user, to_file, message_text, delete, search, count, with_user, follow):
+        if login(username, password):
+            print('Logged in! Next commands can skip --password until session expires')
         return
 
+    # Scenario no. 8
+    if args_required(archive, older_than) and \
+            args_to_be_empty(username, messages_list, to_user, to_file, message_text, delete, search, count, with_user,
+                             follow):
+        return archive_messages(older_than, args.drop)
+
     # Scenario no. 1
-    if args_required(username, password, messages_list) and args_to_be_empty(to_user, message_text, delete):
-        return load_user_messages(user)
+    if args_required(username, messages_list) and \
+            args_to_be_empty(to_user, to_file, message_text, delete, search, count, with_user, follow):
+        user = authenticate(username, password, token)
+        if user:
+            return load_user_messages(user, limit, before)
+        return
 
     # Scenario no. 2
-    elif args_required(username, password, to_user, message_text) and args_to_be_empty(messages_list, delete):
-        return send_message(user, to_user, message_text)
+    elif args_required(username, to_user or to_file, message_text) and \
+            args_to_be_empty(messages_list, delete, search, count, with_user, follow):
+        recipients = parse_recipients(to_user, to_file)
+        if recipients is None:
+            return
+        user = authenticate(username, password, token)
+        if user:
+            return send_message(user, recipients, message_text)
+        return
 
     # Scenario no. 3
-    elif args_required(username, password, delete) and args_to_be_empty(messages_list, to_user, message_text):
-        return delete_message(user, delete)
+    elif args_required(username, delete) and \
+            args_to_be_empty(messages_list, to_user, to_file, message_text, search, count, with_user, follow):
+        user = authenticate(username, password, token)
+        if user:
+            return delete_message(user, delete)
+        return
 
-    # Scenario no. 4
+    # Scenario no. 5
+    elif args_required(username, search) and \
+            args_to_be_empty(messages_list, to_user, to_file, message_text, delete, count, with_user, follow):
+        user = authenticate(username, password, token)
+        if user:
+            return search_messages(user, search, limit, before)
+        return
+
+    # Scenario no. 6
+    elif args_required(username, count) and \
+            args_to_be_empty(messages_list, to_user, to_file, message_text, delete, search, with_user, follow):
+        user = authenticate(username, password, token)
+        if user:
+            return count_messages(user)
+        return
+
+    # Scenario no. 7
+    elif args_required(username, with_user) and \
+            args_to_be_empty(messages_list, to_user, to_file, message_text, delete, search, count, follow):
+        user = authenticate(username, password, token)
+        if user:
+            return show_conversation(user, with_user, limit, before)
+        return
+
+    # Scenario no. 9
+    elif args_required(username, follow) and \
+            args_to_be_empty(messages_list, to_user, to_file, message_text, delete, search, count, with_user):
+        user = authenticate(username, password, token)
+        if user:
+            return follow_user_messages(user)
+        return
+
+    # Scenario no. 10
     else:
         print("""You have used wrong arguments combination. See below scenarios:
         -u USERNAME -p PASSWORD -l | lists all messages, sent and received
+        -u USERNAME -p PASSWORD -l --limit N [--before CURSOR] | lists one page of N messages in each section
         -u USERNAME -p PASSWORD -to TO -s SEND| sends new message -to target user id with -s message text
+        -u USERNAME -p PASSWORD -to ID1,ID2 -s SEND | sends the same message to many users
+        -u USERNAME -p PASSWORD --to-file FILE -s SEND | sends message to all user ids listed in file
         -u USERNAME -p PASSWORD -d | deletes message with ID passed in -d argument
+        -u USERNAME -p PASSWORD -d ID1,ID2 | deletes many messages at once
+        -u USERNAME -p PASSWORD --login | logs in, next commands of USERNAME can skip -p
+        -u USERNAME -p PASSWORD --search QUERY [--limit N] [--before CURSOR] | searches your messages
+        -u USERNAME -p PASSWORD --count | prints number of received, unread and deleted messages
+        -u USERNAME -p PASSWORD --with USER [--limit N] [--before CURSOR] | shows conversation with USER
+        -u USERNAME -p PASSWORD --follow | prints new messages as they arrive, needs postgres
+        --archive --older-than AGE [--drop] | archives messages older than AGE (e.g. 90d), --drop deletes them
         For more see below""")
         return parser.print_help()
 
@@ -171,11 +544,38 @@ def set_parser_arguments():
     parser.add_argument('-p', '--password', type=str, help='write your password ')
     parser.add_argument('-l', '--list', help='list of all messages, send and received',
                         action="store_true")
-    parser.add_argument('-t', '--to', type=str, help='pass recipient id')
+    parser.add_argument('--limit', type=int,
+                        help='with -l, --search or --with: max number of messages listed in each section')
+    parser.add_argument('--before', type=str,
+                        help='with -l, --search or --with: page cursor printed at the end of previous page')
+    parser.add_argument('-t', '--to', type=str, help='pass recipient id, or many ids separated by commas')
+    parser.add_argument('--to-file', type=str, help='pass file with recipient ids, separated by commas or new lines')
     parser.add_argument('-s', '--send', type=str, help='pass your message')
-    parser.add_argument('-d', '--delete', type=str, help='delete message, pass message id')
+    parser.add_argument('-d', '--delete', type=str,
+                        help='delete message, pass message id or many ids separated by commas')
+    parser.add_argument('--search', type=str, help='search your sent and received messages for given words')
+    parser.add_argument('--with', type=str, dest='with_user', help='show conversation with user of given username')
+    parser.add_argument('--count', help='print number of received, unread and deleted messages',
+                        action='store_true')
+    parser.add_argument('--follow', help='wait for new messages and print them as they arrive',
+                        action='store_true')
+    parser.add_argument('--archive', help='move old messages of all users out of messages table into archived_* '
+                                          'tables, used with --older-than. Messages deleted by sender are already '
+                                          'removed for both users, so there are no hidden rows left to purge',
+                        action='store_true')
+    parser.add_argument('--older-than', type=str, help='with --archive: age of removed messages, e.g. 90d, 12w')
+    parser.add_argument('--drop', help='with --archive: drop old partitions and delete old messages instead of '
+                                       'archiving them',
+                        action='store_true')
+    parser.add_argument('--login', help='log in and save session token, so next commands do not need password',
+                        action='store_true')
+    parser.add_argument('--token', type=str, help='session token issued by --login, used instead of password')
     return parser
 
 
-parser_args = set_parser_arguments()
-main(parser_args)
\ No newline at end of file
+# guard lets server.py import helpers from this module without running the program
+if __name__ == '__main__':
+    parser_args = set_parser_arguments()
+    # whole command - login lookup, checks and writes - runs as one transaction with single commit
+    with transaction():
+        main(parser_args)
\ No newline at end of file
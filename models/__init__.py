@@ -1,47 +1,282 @@
 from clcrypto import password_hash
 from datetime import datetime
-from psycopg2 import connect
+from contextlib import contextmanager
+from functools import wraps
+from itertools import zip_longest
+from models.backends import get_backend
+from models.cache import MISSING, NotifiedTTLCache, TTLCache
+from models.metrics import Metrics
+from models.pool import ConnectionPool
+import atexit
+import hashlib
 import os
+import re
+import threading
 
 
-db_username = os.environ.get('POSTGRES_USERNAME')
-passwd = os.environ.get('POSTGRES_PASSWORD')
-hostname = os.environ.get('POSTGRES_HOST')
-db_name = os.environ.get('POSTGRES_DB_NAME')
+pool_min_size = int(os.environ.get('POSTGRES_POOL_MIN', 1))
+pool_max_size = int(os.environ.get('POSTGRES_POOL_MAX', 10))
+pool_max_age = float(os.environ.get('POSTGRES_POOL_MAX_AGE', 300))
+pool_timeout = float(os.environ.get('POSTGRES_POOL_TIMEOUT', 30))
+pool_check_interval = float(os.environ.get('POSTGRES_POOL_CHECK_INTERVAL', 30))
+
+# number of rows fetched in one round-trip by server-side cursors
+messages_itersize = int(os.environ.get('MESSAGES_ITERSIZE', 2000))
+
+
+def user_cache_keys(payload):
+    """
+    :param payload: '<id>:<username>' announced by users_notify trigger (migration 11) when user row changes
+    :return: list of user_cache keys of changed user
+    """
+    user_id, username = payload.split(':', 1)
+    return [('id', int(user_id)), ('username', username)]
+
+
+# user rows cached in process memory, USER_CACHE_TTL = 0 disables cache. USER_CACHE_BACKEND = shared keeps cache
+# of every process in sync - changes of users are announced by DB, needs postgres
+if os.environ.get('USER_CACHE_BACKEND', 'local') == 'shared':
+    user_cache = NotifiedTTLCache(lambda: backend.listen('users_changed'), user_cache_keys,
+                                  max_size=int(os.environ.get('USER_CACHE_SIZE', 10000)),
+                                  ttl=float(os.environ.get('USER_CACHE_TTL', 60)))
+else:
+    user_cache = TTLCache(max_size=int(os.environ.get('USER_CACHE_SIZE', 10000)),
+                          ttl=float(os.environ.get('USER_CACHE_TTL', 60)))
+
+# DB metrics: METRICS=1 turns them on, SLOW_QUERY_MS also logs queries slower than that,
+# METRICS_FILE saves them at exit of program (Prometheus text for *.prom, JSON otherwise)
+slow_query_ms = os.environ.get('SLOW_QUERY_MS')
+query_metrics = Metrics(enabled=os.environ.get('METRICS', '0') not in ('', '0') or bool(slow_query_ms),
+                        slow_query_ms=float(slow_query_ms) if slow_query_ms else None)
+metrics_file = os.environ.get('METRICS_FILE')
+
+backend = None
+pool = None
+
+
+def use_backend(name=None, **options):
+    """
+    Sets storage backend used by @connector and model classes and creates connection pool for it.
+    Called on import with backend chosen by STORAGE_BACKEND environment variable,
+    call it again e.g. to switch to in-memory sqlite in benchmarks. Connections of previous pool are closed.
+
+    :param name: 'postgres' or 'sqlite', string type. Defaults to STORAGE_BACKEND
+    :param options: engine options, see models.backends.get_backend()
+    :return: Backend object
+    """
+    global backend, pool
+    if pool is not None:
+        pool.closeall()
+    backend = get_backend(name, **options)
+    max_size = min(pool_max_size, backend.max_connections or pool_max_size)
+    connect = backend.connect
+    if query_metrics.enabled:
+        connect = query_metrics.timed('connect_seconds', connect)
+    pool = ConnectionPool(connect,
+                          min_size=min(pool_min_size, max_size),
+                          max_size=max_size,
+                          max_age=pool_max_age,
+                          timeout=pool_timeout,
+                          check_interval=pool_check_interval)
+    return backend
+
+
+use_backend()
+atexit.register(lambda: pool.closeall())
+if metrics_file:
+    atexit.register(lambda: query_metrics.write(metrics_file))
+
+
+class UnitOfWork:
+    """
+    One DB transaction shared by all @connector calls made inside transaction() block.
+    Connection is checked out from the pool lazily - only when first decorated function needs a cursor,
+    so blocks which end up not touching DB cost nothing.
+    Identity map keeps objects loaded in this unit of work, so the same row is loaded only once.
+    """
+    def __init__(self):
+        self.cnx = None
+        self._cursor = None
+        self.identity_map = dict()
+        self._after_commit = list()
+
+    def cursor(self):
+        """
+        :return: cursor shared by the whole unit of work
+        """
+        if self._cursor is None:
+            if query_metrics.enabled:
+                # wait includes opening new connection, if pool had none idle
+                with query_metrics.timer('pool_wait_seconds'):
+                    self.cnx = pool.getconn()
+                self._cursor = query_metrics.instrument(self.cnx.cursor())
+            else:
+                self.cnx = pool.getconn()
+                self._cursor = self.cnx.cursor()
+        return self._cursor
+
+    def after_commit(self, func):
+        """
+        Registers function with no arguments which is called after successful commit.
+
+        :param func: function to be called
+        :return: None
+        """
+        self._after_commit.append(func)
+
+    def commit(self):
+        if self.cnx is not None:
+            self._cursor.close()
+            try:
+                if query_metrics.enabled:
+                    with query_metrics.timer('commit_seconds'):
+                        self.cnx.commit()
+                else:
+                    self.cnx.commit()
+            except BaseException:
+                self.rollback()
+                raise
+            pool.putconn(self.cnx)
+            self.cnx = self._cursor = None
+        callbacks, self._after_commit = self._after_commit, list()
+        for func in callbacks:
+            func()
+
+    def rollback(self):
+        if self.cnx is not None:
+            try:
+                self.cnx.rollback()
+            except Exception:
+                pool.putconn(self.cnx, discard=True)
+            else:
+                pool.putconn(self.cnx)
+            self.cnx = self._cursor = None
+
+
+_local = threading.local()
+
+
+def current_unit():
+    """
+    :return: UnitOfWork of transaction() block running in this thread, None outside of such block
+    """
+    return getattr(_local, 'unit', None)
+
+
+@contextmanager
+def transaction():
+    """
+    Runs block as one unit of work - every @connector call inside uses the same connection and cursor,
+    and everything is committed once at the end of the block. Exception rolls back the whole block.
+    Nested transaction() blocks join the outer one.
+
+    :return: UnitOfWork object
+    """
+    unit = getattr(_local, 'unit', None)
+    if unit is not None:
+        yield unit
+        return
+    unit = UnitOfWork()
+    _local.unit = unit
+    try:
+        yield unit
+    except BaseException:
+        unit.rollback()
+        raise
+    else:
+        unit.commit()
+    finally:
+        _local.unit = None
 
 
 def connector(func):
     """
-    Connector function used as decorator to process all postgres DB connections.
+    Connector function used as decorator to process all DB connections.
+    Wrapped function gets cursor of current transaction() block. Called outside of such block,
+    it runs in its own transaction - connection is checked out from the pool and returned there after commit.
 
     :param func: wrapped function
     :return: whatever wrapped function returns is saved to variable and returned by connector
     """
+    @wraps(func)
     def wrapper(*args, **kwargs):
-        cnx = connect(user=db_username,
-                      password=passwd,
-                      host=hostname,
-                      database=db_name)
-        _cursor = cnx.cursor()
-        operation = func(_cursor, *args, **kwargs)
-        cnx.commit()
-        _cursor.close()
-        cnx.close()
-        return operation
+        with transaction() as unit:
+            return func(unit.cursor(), *args, **kwargs)
 
     return wrapper
 
 
-class User:
+class DirtyTracking:
+    """
+    Base class of models. Tracks which columns have been changed since object was loaded or saved,
+    so save_to_db() can update only them.
+    _columns maps attribute name (mangled one for private attributes) to column name.
+    _row_fields lists attributes in order of columns of query row, used by from_row().
+    Models use __slots__ - loading big mailbox allocates little more than row data itself.
+    """
+    __slots__ = ()
+    _columns = dict()
+    _row_fields = ()
+
+    def __setattr__(self, name, value):
+        column = self._columns.get(name)
+        if column is not None and getattr(self, name, MISSING) != value:
+            if self._dirty is None:
+                self._dirty = set()
+            self._dirty.add(column)
+        object.__setattr__(self, name, value)
+
+    @classmethod
+    def from_row(cls, data):
+        """
+        Creates object straight from query row, without running __init__() defaults and without dirty tracking.
+        Attributes which are not in row are set to None.
+
+        :param data: query row, values in order of _row_fields
+        :return: object of cls
+        """
+        loaded = object.__new__(cls)
+        for name, value in zip_longest(cls._row_fields, data):
+            object.__setattr__(loaded, name, value)
+        object.__setattr__(loaded, '_dirty', None)
+        return loaded
+
+    def changed_columns(self):
+        """
+        :return: list of changed columns with their current values, [(column, value), ...]
+        """
+        if not self._dirty:
+            return list()
+        return [(column, getattr(self, name)) for name, column in self._columns.items() if column in self._dirty]
+
+    def mark_clean(self):
+        """
+        Marks all columns as saved. Called after object is saved.
+        """
+        self._dirty = None
+
+    @staticmethod
+    def update_sql(table, changes):
+        """
+        :param table: table name, string type
+        :param changes: list of (column, value) tuples, from changed_columns()
+        :return: UPDATE statement of given columns, with 'WHERE id=%s' condition
+        """
+        assignments = ', '.join('{} = %s'.format(column) for column, value in changes)
+        return "UPDATE {} SET {} WHERE id = %s;".format(table, assignments)
+
+
+class User(DirtyTracking):
     """
     User class, used to process all inquiries to 'users' DB table.
     Methods which have cursor param in their method have to be used with @connector.
     """
-    __id = None
-    username = None
-    __hashed_password = None
+    __slots__ = ('__id', 'username', '__hashed_password', '_dirty')
+    _columns = {'username': 'username', '_User__hashed_password': 'hashed_password'}
+    _row_fields = ('_User__id', 'username', '_User__hashed_password')
 
     def __init__(self):
+        self._dirty = None
         self.__id = -1
         self.username = ""
         self.__hashed_password = ""
@@ -66,7 +301,8 @@ class User:
     def save_to_db(self, _cursor):
         """
         Saves user to DB. If user is not in DB then __id is -1. In this case function inserts new user.
-        Otherwise it updates already existing user in DB
+        Otherwise it updates already existing user in DB - only columns changed since user was loaded.
+        If nothing has changed, no query is run.
 
         :param _cursor: parameter passed with connector decorator
         :return:
@@ -77,14 +313,79 @@ class User:
             values = (self.username, self.__hashed_password)
             _cursor.execute(sql, values)
             self.__id = _cursor.fetchone()[0]
+            self.mark_clean()
             return True
-        else:
-                sql = """UPDATE Users SET username = %s, hashed_password = %s
-                         WHERE id = %s;"""
-                values = (self.username, self.__hashed_password, self.__id)
-                _cursor.execute(sql, values)
+        changes = self.changed_columns()
+        if changes:
+            values = [value for column, value in changes] + [self.__id]
+            _cursor.execute(self.update_sql('Users', changes), values)
+            self.forget()
+            self.mark_clean()
         return False
 
+    @staticmethod
+    def cached_user(key):
+        """
+        Looks user up in identity map of current transaction, then in user_cache. Does not query DB.
+
+        :param key: ('id', user id) or ('username', username) tuple
+        :return: User object if user is cached, otherwise None
+        """
+        unit = current_unit()
+        if unit is not None and key in unit.identity_map:
+            return unit.identity_map[key]
+        data = user_cache.get(key)
+        if data is MISSING:
+            return None
+        return User.mapped_user(data)
+
+    @staticmethod
+    def mapped_user(data):
+        """
+        Creates User object with loaded_user() and registers it in identity map of current transaction.
+
+        :param data: list of variables in this order [id, username, hashed_password]
+        :return: User object if data is not None, otherwise None
+        """
+        loaded_user = User.loaded_user(data)
+        unit = current_unit()
+        if loaded_user and unit is not None:
+            unit.identity_map[('id', data[0])] = loaded_user
+            unit.identity_map[('username', data[1])] = loaded_user
+        return loaded_user
+
+    @staticmethod
+    def remember_user(data):
+        """
+        Caches user row loaded from DB and creates User object from it.
+
+        :param data: list of variables in this order [id, username, hashed_password] or None
+        :return: User object if data is not None, otherwise None
+        """
+        if data:
+            data = tuple(data)
+            user_cache.set(('id', data[0]), data)
+            user_cache.set(('username', data[1]), data)
+        return User.mapped_user(data)
+
+    def forget(self):
+        """
+        Removes user from user_cache and identity map - called whenever user row changes.
+        Cache is invalidated again after commit, so rows loaded by other threads before commit are not kept.
+
+        :return: None
+        """
+        keys = [('id', self.__id), ('username', self.username)]
+        cached = user_cache.peek(('id', self.__id))
+        if cached is not MISSING:
+            keys.append(('username', cached[1]))
+        user_cache.delete(*keys)
+        unit = current_unit()
+        if unit is not None:
+            for key in [key for key, mapped in unit.identity_map.items() if mapped is self]:
+                del unit.identity_map[key]
+            unit.after_commit(lambda: user_cache.delete(*keys))
+
     @staticmethod
     def loaded_user(data):
         """
@@ -94,42 +395,120 @@ class User:
         :return: User object if data is not None, otherwise None
         """
         if data:
-            loaded_user = User()
-            loaded_user.__id = data[0]
-            loaded_user.username = data[1]
-            loaded_user.__hashed_password = data[2]
-            return loaded_user
+            return User.from_row(data)
         else:
             return None
 
     @staticmethod
-    def load_user_by_username(_cursor, username):
+    def load_user_by_username(_cursor, username, cached=True):
         """
         Loads user by given username, users other staticmethod loaded_user()
 
         :param _cursor: parameter passed with connector decorator
         :param username: username which will be used in query, string type
+        :param cached: if False user_cache and identity map are skipped and row is read from DB - used to check
+            password, which may have been changed by other process
         :return: User object if user has been found by query, otherwise None
         """
+        cached_user = User.cached_user(('username', username)) if cached else None
+        if cached_user:
+            return cached_user
         sql = "SELECT id, username, hashed_password FROM users WHERE username=%s"
         _cursor.execute(sql, (username,))
         data = _cursor.fetchone()
-        return User.loaded_user(data)
+        return User.remember_user(data)
     
     @staticmethod
-    def load_user_by_id(_cursor, user_id):
+    def load_user_by_id(_cursor, user_id, cached=True):
         """
         Load user by given id, uses other staticmethod loaded_user()
 
         :param _cursor: parameter passed with connector decorator
         :param user_id: user id which will be used in query, string type
+        :param cached: if False user_cache and identity map are skipped, see load_user_by_username()
         :return: User object if user has been found by query, otherwise None
         """
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return None
+        cached_user = User.cached_user(('id', user_id)) if cached else None
+        if cached_user:
+            return cached_user
         sql = "SELECT id, username, hashed_password FROM users WHERE id=%s;"
         _cursor.execute(sql, (user_id,))
         data = _cursor.fetchone()
-        return User.loaded_user(data)
+        return User.remember_user(data)
     
+    @staticmethod
+    def load_users_by_ids(_cursor, user_ids):
+        """
+        Loads many users in one query. Use it instead of calling load_user_by_id() in a loop.
+        Only users which are not cached are queried.
+
+        :param _cursor: parameter passed with connector decorator
+        :param user_ids: iterable of user ids
+        :return: dict {id: User object}. Ids which were not found are missing in dict
+        """
+        users = dict()
+        missing = list()
+        for user_id in set(int(user_id) for user_id in user_ids):
+            cached_user = User.cached_user(('id', user_id))
+            if cached_user:
+                users[user_id] = cached_user
+            else:
+                missing.append(user_id)
+        if missing:
+            sql = "SELECT id, username, hashed_password FROM users WHERE id = ANY(%s);"
+            _cursor.execute(sql, (missing,))
+            for row in _cursor.fetchall():
+                users[row[0]] = User.remember_user(row)
+        return users
+
+    @staticmethod
+    def existing_ids(_cursor, user_ids):
+        """
+        Checks in one query which of given user ids are in DB.
+
+        :param _cursor: parameter passed with connector decorator
+        :param user_ids: iterable of user ids
+        :return: set of ids which exist in DB
+        """
+        user_ids = list(set(int(user_id) for user_id in user_ids))
+        if not user_ids:
+            return set()
+        _cursor.execute("SELECT id FROM users WHERE id = ANY(%s);", (user_ids,))
+        return set(row[0] for row in _cursor.fetchall())
+
+    @staticmethod
+    def existing_usernames(_cursor, usernames):
+        """
+        Checks in one query which of given usernames are already taken.
+
+        :param _cursor: parameter passed with connector decorator
+        :param usernames: iterable of usernames
+        :return: set of usernames which exist in DB
+        """
+        usernames = list(set(usernames))
+        if not usernames:
+            return set()
+        _cursor.execute("SELECT username FROM users WHERE username = ANY(%s);", (usernames,))
+        return set(row[0] for row in _cursor.fetchall())
+
+    @staticmethod
+    def copy_many(_cursor, rows):
+        """
+        Inserts many new users in bulk - with COPY FROM STDIN on postgres.
+
+        :param _cursor: parameter passed with connector decorator
+        :param rows: list of (username, hashed_password) tuples, password hashed with password_hash()
+        :return: number of saved users
+        """
+        if not rows:
+            return 0
+        backend.copy_rows(_cursor, 'users', ('username', 'hashed_password'), rows)
+        return len(rows)
+
     @staticmethod
     def load_all_users(_cursor):
         """
@@ -152,31 +531,44 @@ class User:
         :param _cursor: parameter passed with connector decorator
         :return: None
         """
+        # messages would be deleted by ON DELETE CASCADE as well - here their bodies are known and collected
+        _cursor.execute("DELETE FROM Messages WHERE from_id=%s OR to_id=%s RETURNING body_id;", (self.__id, self.__id))
+        Message.collect_bodies(_cursor, [row[0] for row in _cursor.fetchall()])
         sql = "DELETE FROM Users WHERE id=%s;"
         _cursor.execute(sql, (self.__id,))
+        # counters have no foreign key, deleting user's messages above still updates them
+        _cursor.execute("DELETE FROM mailbox_counters WHERE user_id=%s;", (self.__id,))
+        self.forget()
         self.__id = -1
         return None
 
 
-class Message:
+class Message(DirtyTracking):
     """
     Message class, used to process all inquiries to 'messages' DB table.
+    Text of message is kept in 'message_bodies' table - each distinct text once, message row refers to it
+    with body_id. Loaders join text back, save_to_db() and save_many() store it.
     Methods which have cursor param in their method have to be used with @connector.
     """
-    __id = None
-    text = None
-    from_id = None
-    to_id = None
-    __is_visible = None
-    __creation_date = None 
+    __slots__ = ('__id', 'text', 'from_id', 'to_id', '__is_visible', '__creation_date', 'body_id',
+                 'from_username', 'to_username', 'rank', '_dirty')
+    # text is tracked to know when message needs other body, save_to_db() turns it into body_id change
+    _columns = {'text': 'text', 'from_id': 'from_id', 'to_id': 'to_id', '_Message__is_visible': 'is_visible'}
+    _row_fields = ('_Message__id', 'text', 'from_id', 'to_id', '_Message__is_visible', '_Message__creation_date',
+                   'body_id', 'from_username', 'to_username', 'rank')
 
     def __init__(self):
+        self._dirty = None
         self.__id = -1
         self.text = ""
         self.from_id = ""
         self.to_id = ""
         self.__is_visible = True
         self.__creation_date = datetime.utcnow()
+        self.body_id = None
+        self.from_username = None
+        self.to_username = None
+        self.rank = None
     
     @property
     def id(self):
@@ -208,18 +600,12 @@ class Message:
         """
         Creates Message object and populates it with given data.
 
-        :param data: list of params in this order [id, text, from_id, to_id, is_visible, creation_date]
+        :param data: list of params in this order [id, text, from_id, to_id, is_visible, creation_date, body_id],
+            optionally followed by [from_username, to_username] if query joins users
         :return: Message object if there is data, otherwise None
         """
         if data:
-            loaded_message = Message()
-            loaded_message.__id = data[0]
-            loaded_message.text = data[1]
-            loaded_message.from_id = data[2]
-            loaded_message.to_id = data[3]
-            loaded_message.__is_visible = data[4]
-            loaded_message.__creation_date = data[5]
-            return loaded_message
+            return Message.from_row(data)
         else:
             return None
     
@@ -232,12 +618,314 @@ class Message:
         :param message_id: id of message to be loaded, string type
         :return: Message object if query found message, otherwise None
         """
-        sql = "SELECT id, text, from_id, to_id, is_visible, creation_date FROM Messages WHERE id=%s;"
+        sql = """SELECT m.id, b.text, m.from_id, m.to_id, m.is_visible, m.creation_date, m.body_id
+                 FROM Messages m
+                 JOIN message_bodies b ON b.id = m.body_id
+                 WHERE m.id=%s;"""
         _cursor.execute(sql, (message_id,))
         data = _cursor.fetchone()
         return Message.load_message(data)
         
         
+    @staticmethod
+    def iter_messages(_cursor, sql, values, itersize=None):
+        """
+        Generator which runs query on server-side cursor and yields Message objects one by one.
+        Rows are fetched from DB in batches of itersize, so memory use does not depend on number of rows.
+        Has to be consumed inside @connector function, since it uses its connection.
+
+        :param _cursor: parameter passed with connector decorator
+        :param sql: query which selects columns in order expected by load_message()
+        :param values: query parameters
+        :param itersize: number of rows fetched in one round-trip, int type. Defaults to MESSAGES_ITERSIZE
+        :return: generator of Message objects
+        """
+        named_cursor = query_metrics.instrument(backend.server_cursor(_cursor, itersize or messages_itersize))
+        try:
+            named_cursor.execute(sql, values)
+            for row in named_cursor:
+                yield Message.load_message(row)
+        finally:
+            named_cursor.close()
+
+    @staticmethod
+    def mailbox_query(column, user_id, limit=None, before=None, visible_only=False):
+        """
+        Builds keyset-paginated query for messages where given column equals user_id.
+        Messages are ordered from the newest, by (creation_date, id) - the same order as mailbox indexes.
+        Text, sender and recipient usernames are joined in the same query.
+
+        :param column: 'from_id' or 'to_id', string type
+        :param user_id: id of user which requests his messages to be loaded, string type
+        :param limit: max number of messages, int type. None means no limit
+        :param before: (creation_date, id) tuple - only messages older than that position are selected
+        :param visible_only: if True, messages hidden by recipient are filtered out, boolean type
+        :return: tuple of sql and its values
+        """
+        sql = """SELECT m.id, b.text, m.from_id, m.to_id, m.is_visible, m.creation_date, m.body_id,
+                        s.username, r.username
+                 FROM Messages m
+                 JOIN message_bodies b ON b.id = m.body_id
+                 JOIN Users s ON s.id = m.from_id
+                 JOIN Users r ON r.id = m.to_id
+                 WHERE m.{}=%s""".format(column)
+        values = [user_id]
+        if visible_only:
+            sql += " AND m.is_visible"
+        if before:
+            # plain creation_date condition lets partitioned table skip partitions newer than the page
+            sql += " AND m.creation_date <= %s AND (m.creation_date, m.id) < (%s, %s)"
+            values.append(before[0])
+            values.extend(before)
+        sql += " ORDER BY m.creation_date DESC, m.id DESC"
+        if limit:
+            sql += " LIMIT %s"
+            values.append(limit)
+        return sql + ";", values
+
+    @staticmethod
+    def iter_messages_for_user(_cursor, user_id, limit=None, before=None, itersize=None):
+        """
+        Yields messages which were sent to user, newest first. Messages which are not visible for user
+        are filtered out by the query, so it is served by partial index of visible messages.
+
+        :param _cursor: parameter passed with connector decorator
+        :param user_id: id of user which requests his messages to be loaded, string type
+        :param limit: max number of messages, int type
+        :param before: (creation_date, id) tuple of last message from previous page
+        :param itersize: number of rows fetched in one round-trip, int type
+        :return: generator of Message objects
+        """
+        sql, values = Message.mailbox_query('to_id', user_id, limit, before, visible_only=True)
+        return Message.iter_messages(_cursor, sql, values, itersize)
+
+    @staticmethod
+    def iter_messages_by_user(_cursor, user_id, limit=None, before=None, itersize=None):
+        """
+        Yields messages which user has sent, newest first.
+
+        :param _cursor: parameter passed with connector decorator
+        :param user_id: id of user which requests his messages to be loaded, string type
+        :param limit: max number of messages, int type
+        :param before: (creation_date, id) tuple of last message from previous page
+        :param itersize: number of rows fetched in one round-trip, int type
+        :return: generator of Message objects
+        """
+        sql, values = Message.mailbox_query('from_id', user_id, limit, before)
+        return Message.iter_messages(_cursor, sql, values, itersize)
+
+    @staticmethod
+    def search(_cursor, user_id, query, limit=None, before=None, itersize=None):
+        """
+        Full-text search over messages user can see - sent by him, or received and visible for him.
+        Uses full-text index of message bodies kept by migrations: tsvector column with GIN index on postgres,
+        FTS5 table on sqlite. Text of broadcast message is indexed once.
+        Results are ordered by rank, best first, and paginated by (rank, id) keyset.
+
+        :param _cursor: parameter passed with connector decorator
+        :param user_id: id of user which searches his messages
+        :param query: searched words, string type. On postgres quotes, OR and -word work like in web search
+        :param limit: max number of messages, int type
+        :param before: (rank, id) tuple of last message from previous page
+        :param itersize: number of rows fetched in one round-trip, int type
+        :return: generator of Message objects with rank set, empty if query has no words
+        """
+        if not query.split():
+            return iter(())
+        columns = """m.id, b.text, m.from_id, m.to_id, m.is_visible, m.creation_date, m.body_id,
+                     s.username AS from_username, r.username AS to_username"""
+        if backend.name == 'sqlite':
+            # every word is quoted, so FTS5 query syntax in user input does not break the query
+            query = ' '.join('"{}"'.format(word.replace('"', '""')) for word in query.split())
+            found = """SELECT {}, -bm25(message_bodies_fts) AS rank
+                       FROM message_bodies_fts
+                       JOIN message_bodies b ON b.id = message_bodies_fts.rowid
+                       JOIN Messages m ON m.body_id = b.id
+                       JOIN Users s ON s.id = m.from_id
+                       JOIN Users r ON r.id = m.to_id
+                       WHERE message_bodies_fts MATCH %s
+                         AND (m.from_id = %s OR (m.to_id = %s AND m.is_visible))""".format(columns)
+        else:
+            # ts_rank() returns real; float8 rank is passed in page cursor and compared back without rounding
+            found = """SELECT {}, ts_rank(b.search_vector, q)::float8 AS rank
+                       FROM message_bodies b
+                       CROSS JOIN websearch_to_tsquery('simple', %s) q
+                       JOIN Messages m ON m.body_id = b.id
+                       JOIN Users s ON s.id = m.from_id
+                       JOIN Users r ON r.id = m.to_id
+                       WHERE b.search_vector @@ q
+                         AND (m.from_id = %s OR (m.to_id = %s AND m.is_visible))""".format(columns)
+        sql = "SELECT * FROM ({}) found".format(found)
+        values = [query, user_id, user_id]
+        if before:
+            sql += " WHERE (rank, id) < (%s, %s)"
+            values.extend(before)
+        sql += " ORDER BY rank DESC, id DESC"
+        if limit:
+            sql += " LIMIT %s"
+            values.append(limit)
+        return Message.iter_messages(_cursor, sql + ";", values, itersize)
+
+    @staticmethod
+    def load_received_by_ids(_cursor, user_id, message_ids):
+        """
+        Loads messages of given ids which were sent to user and are still visible for him. Used by listeners,
+        which get ids of new messages from notifications.
+
+        :param _cursor: parameter passed with connector decorator
+        :param user_id: id of recipient
+        :param message_ids: list of message ids, int type
+        :return: list of Message objects, the oldest first
+        """
+        sql = """SELECT m.id, b.text, m.from_id, m.to_id, m.is_visible, m.creation_date, m.body_id,
+                        s.username, r.username
+                 FROM Messages m
+                 JOIN message_bodies b ON b.id = m.body_id
+                 JOIN Users s ON s.id = m.from_id
+                 JOIN Users r ON r.id = m.to_id
+                 WHERE m.id = ANY(%s) AND m.to_id = %s AND m.is_visible
+                 ORDER BY m.creation_date, m.id;"""
+        _cursor.execute(sql, (list(message_ids), user_id))
+        return [Message.load_message(row) for row in _cursor.fetchall()]
+
+    @staticmethod
+    def load_conversation(_cursor, user_id, other_user_id, limit=None, before=None):
+        """
+        Loads messages exchanged between two users, both directions interleaved, with one query
+        served by conversation index on (least(from_id, to_id), greatest(from_id, to_id), creation_date).
+        Pages go back in time: the newest messages first, older ones with before. Messages in page are in time order.
+        Messages which user has hidden as recipient are left out.
+
+        :param _cursor: parameter passed with connector decorator
+        :param user_id: id of user which requests conversation
+        :param other_user_id: id of the other user
+        :param limit: max number of messages, int type. None means whole conversation
+        :param before: (creation_date, id) tuple of the oldest message from previous page
+        :return: list of Message objects, the oldest first
+        """
+        least, greatest = ('min', 'max') if backend.name == 'sqlite' else ('least', 'greatest')
+        sql = """SELECT m.id, b.text, m.from_id, m.to_id, m.is_visible, m.creation_date, m.body_id,
+                        s.username, r.username
+                 FROM Messages m
+                 JOIN message_bodies b ON b.id = m.body_id
+                 JOIN Users s ON s.id = m.from_id
+                 JOIN Users r ON r.id = m.to_id
+                 WHERE {0}(m.from_id, m.to_id) = %s AND {1}(m.from_id, m.to_id) = %s
+                   AND (m.from_id = %s OR m.is_visible)""".format(least, greatest)
+        values = [min(user_id, other_user_id), max(user_id, other_user_id), user_id]
+        if before:
+            # plain creation_date condition lets partitioned table skip partitions newer than the page
+            sql += " AND m.creation_date <= %s AND (m.creation_date, m.id) < (%s, %s)"
+            values.append(before[0])
+            values.extend(before)
+        sql += " ORDER BY m.creation_date DESC, m.id DESC"
+        if limit:
+            sql += " LIMIT %s"
+            values.append(limit)
+        conversation = list(Message.iter_messages(_cursor, sql + ";", values))
+        conversation.reverse()
+        return conversation
+
+    @staticmethod
+    def archive(_cursor, older_than, drop=False):
+        """
+        Retention job - removes messages created before older_than from messages table.
+        On postgres, monthly partitions which are entirely older are detached and kept as archived_<partition>
+        tables, or dropped if drop is True - no row is deleted one by one. Archived table gets its own text column,
+        so it does not depend on message_bodies any more.
+        Older rows left in newer partitions - every old row on sqlite, which has no partitions - are copied
+        with their texts into archived_messages table and then deleted. Only with drop they are just deleted.
+        Counters of recipients are updated for both.
+        Bodies no message refers to any more are collected at the end.
+
+        :param _cursor: parameter passed with connector decorator
+        :param older_than: messages created before this date are removed, datetime type
+        :param drop: if True old partitions are dropped and old rows deleted instead of archived, boolean type
+        :return: tuple (list of detached or dropped partition names, number of archived or deleted rows)
+        """
+        partitions = list()
+        body_ids = set()
+        if backend.name == 'postgres':
+            _cursor.execute("""SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                               WHERE i.inhparent = 'messages'::regclass ORDER BY c.relname;""")
+            for name, in _cursor.fetchall():
+                month = re.match(r'messages_(\d{4})_(\d{2})$', name)
+                if not month:
+                    continue
+                year, month = int(month.group(1)), int(month.group(2))
+                if datetime(year + month // 12, month % 12 + 1, 1) > older_than:
+                    continue
+                # detaching does not fire delete triggers, rows of partition are subtracted from counters here
+                _cursor.execute("""INSERT INTO mailbox_counters AS c (user_id, total, unread, hidden)
+                                   SELECT to_id, -count(*) FILTER (WHERE is_visible),
+                                          -count(*) FILTER (WHERE is_visible AND NOT is_read),
+                                          -count(*) FILTER (WHERE NOT is_visible)
+                                   FROM {} GROUP BY to_id
+                                   ON CONFLICT (user_id) DO UPDATE SET total = c.total + EXCLUDED.total,
+                                       unread = c.unread + EXCLUDED.unread, hidden = c.hidden + EXCLUDED.hidden;
+                                """.format(name))
+                _cursor.execute("SELECT DISTINCT body_id FROM {};".format(name))
+                body_ids.update(row[0] for row in _cursor.fetchall())
+                _cursor.execute("ALTER TABLE messages DETACH PARTITION {};".format(name))
+                if drop:
+                    _cursor.execute("DROP TABLE {};".format(name))
+                else:
+                    archived = 'archived_' + name
+                    _cursor.execute("ALTER TABLE {} RENAME TO {};".format(name, archived))
+                    # detached partition keeps foreign key to bodies - texts are copied, so bodies can be collected
+                    _cursor.execute("ALTER TABLE {} ADD COLUMN text text;".format(archived))
+                    _cursor.execute("UPDATE {} a SET text = b.text FROM message_bodies b WHERE b.id = a.body_id;"
+                                    .format(archived))
+                    _cursor.execute("""SELECT conname FROM pg_constraint
+                                       WHERE conrelid = %s::regclass AND confrelid = 'message_bodies'::regclass;""",
+                                    (archived,))
+                    for constraint, in _cursor.fetchall():
+                        _cursor.execute('ALTER TABLE {} DROP CONSTRAINT "{}";'.format(archived, constraint))
+                partitions.append(name)
+        if not drop:
+            archived = """SELECT m.id, m.body_id, m.from_id, m.to_id, m.is_visible, m.creation_date, m.is_read, b.text
+                          FROM Messages m JOIN message_bodies b ON b.id = m.body_id"""
+            _cursor.execute("CREATE TABLE IF NOT EXISTS archived_messages AS {} WHERE 1 = 0;".format(archived))
+            _cursor.execute("INSERT INTO archived_messages {} WHERE m.creation_date < %s;".format(archived),
+                            (older_than,))
+        _cursor.execute("DELETE FROM Messages WHERE creation_date < %s RETURNING body_id;", (older_than,))
+        deleted = _cursor.fetchall()
+        body_ids.update(row[0] for row in deleted)
+        Message.collect_bodies(_cursor, body_ids)
+        return partitions, len(deleted)
+
+    @staticmethod
+    def mailbox_counters(_cursor, user_id):
+        """
+        Reads counters of user's received messages. Counters are kept up to date by DB triggers
+        on every insert, update and delete of messages, so it is one primary key lookup, however big mailbox is.
+
+        :param _cursor: parameter passed with connector decorator
+        :param user_id: id of user which requests his counters
+        :return: dict with 'total' (visible), 'unread' (visible and not read) and 'hidden' numbers of messages
+        """
+        _cursor.execute("SELECT total, unread, hidden FROM mailbox_counters WHERE user_id=%s;", (user_id,))
+        row = _cursor.fetchone() or (0, 0, 0)
+        return {'total': row[0], 'unread': row[1], 'hidden': row[2]}
+
+    @staticmethod
+    def mark_read(_cursor, user_id, message_ids):
+        """
+        Marks messages received by user as read. Messages of other users and already read ones are skipped,
+        so counters triggers see only rows which have really changed.
+
+        :param _cursor: parameter passed with connector decorator
+        :param user_id: id of recipient
+        :param message_ids: iterable of message ids, int type
+        :return: number of messages marked as read
+        """
+        message_ids = list(message_ids)
+        if not message_ids:
+            return 0
+        _cursor.execute("UPDATE Messages SET is_read = true WHERE id = ANY(%s) AND to_id = %s AND NOT is_read;",
+                        (message_ids, user_id))
+        return _cursor.rowcount
+
     @staticmethod
     def load_all_messages_for_user(_cursor, user_id):
         """
@@ -248,16 +936,8 @@ class Message:
         :param user_id: id of user which requests his messages to be loaded, string type
         :return: list of all Messages objects
         """
-        all_messages = list()
-        sql = "SELECT id, text, from_id, to_id, is_visible, creation_date FROM Messages WHERE to_id=%s;"
-        _cursor.execute(sql, (user_id,))
-        data = _cursor.fetchall()
-        for row in data:
-            message = Message.load_message(row)
-            if message.is_visible:
-                all_messages.append(message)
-        return all_messages
-    
+        return list(Message.iter_messages_for_user(_cursor, user_id))
+
     @staticmethod
     def load_all_messages_by_user(_cursor, user_id):
         """
@@ -268,49 +948,204 @@ class Message:
         :param user_id: id of user which requests his messages to be loaded, string type
         :return: list of all Messages objects
         """
-        all_messages = list()
-        sql = "SELECT id, text, from_id, to_id, is_visible, creation_date FROM Messages WHERE from_id=%s;"
-        _cursor.execute(sql, (user_id,))
-        data = _cursor.fetchall()
-        for row in data:
-            all_messages.append(Message.load_message(row))
-        return all_messages
-    
+        return list(Message.iter_messages_by_user(_cursor, user_id))
+
     def delete_by_sender(self, _cursor):
         """
         Deletes message which was sent by user. Unlike delete_by_recipient - this method deletes message from DB.
-        Deletes message for sender and recipient as well in result.
+        Deletes message for sender and recipient as well in result. Body of message is deleted too,
+        if no other message refers to it.
 
         :param _cursor: parameter passed with connector decorator
         :return: None
         """
-        sql = "DELETE FROM Messages WHERE id=%s;"
+        sql = "DELETE FROM Messages WHERE id=%s RETURNING body_id;"
         _cursor.execute(sql, (self.id,))
+        Message.collect_bodies(_cursor, [row[0] for row in _cursor.fetchall()])
         self.__id = -1
-        return None     
+        return None
+
+    @staticmethod
+    def delete_for_user(_cursor, message_id, user_id):
+        """
+        Deletes message on behalf of user, see delete_many_for_user().
+
+        :param _cursor: parameter passed with connector decorator
+        :param message_id: id of message to be deleted, string type
+        :param user_id: id of user which requests deletion
+        :return: 'hidden', 'deleted', 'forbidden' or 'not found' - see delete_many_for_user()
+        """
+        return Message.delete_many_for_user(_cursor, [message_id], user_id)[str(message_id)]
+
+    @staticmethod
+    def delete_many_for_user(_cursor, message_ids, user_id):
+        """
+        Deletes messages on behalf of user, without loading them. For each message:
+            - if user is recipient and message is visible for him, message is hidden for recipient ('hidden'),
+            - otherwise if user is sender, message is deleted from DB, for both users ('deleted').
+        Both cases are decided by WHERE conditions of one statement, keyed on user id, so there is no
+        race between reading message and changing it. Only when some messages were not changed,
+        one more query tells which of them do not exist ('not found') and which belong to others ('forbidden').
+        Bodies of deleted messages are collected, see collect_bodies().
+
+        :param _cursor: parameter passed with connector decorator
+        :param message_ids: iterable of message ids, string or int type
+        :param user_id: id of user which requests deletion
+        :return: dict {message id as passed: 'hidden', 'deleted', 'forbidden' or 'not found'}
+        """
+        requested = dict()
+        for message_id in message_ids:
+            try:
+                requested[str(message_id)] = int(message_id)
+            except (TypeError, ValueError):
+                requested[str(message_id)] = None
+        ids = list(set(message_id for message_id in requested.values() if message_id is not None))
+        results = dict()
+        if ids:
+            if backend.writable_cte:
+                sql = """WITH hidden AS (
+                             UPDATE Messages SET is_visible = false
+                             WHERE id = ANY(%s) AND to_id = %s AND is_visible
+                             RETURNING id
+                         ), deleted AS (
+                             DELETE FROM Messages
+                             WHERE id = ANY(%s) AND from_id = %s AND id NOT IN (SELECT id FROM hidden)
+                             RETURNING id, body_id
+                         )
+                         SELECT id, 'hidden', NULL FROM hidden UNION ALL SELECT id, 'deleted', body_id FROM deleted;"""
+                _cursor.execute(sql, (ids, user_id, ids, user_id))
+                rows = _cursor.fetchall()
+                results.update((row[0], row[1]) for row in rows)
+                body_ids = [row[2] for row in rows]
+            else:
+                # engine without writable WITH - the same conditions in two statements of one transaction
+                _cursor.execute("""UPDATE Messages SET is_visible = false
+                                   WHERE id = ANY(%s) AND to_id = %s AND is_visible RETURNING id;""",
+                                (ids, user_id))
+                results.update((row[0], 'hidden') for row in _cursor.fetchall())
+                remaining = [message_id for message_id in ids if message_id not in results]
+                body_ids = list()
+                if remaining:
+                    _cursor.execute("DELETE FROM Messages WHERE id = ANY(%s) AND from_id = %s RETURNING id, body_id;",
+                                    (remaining, user_id))
+                    rows = _cursor.fetchall()
+                    results.update((row[0], 'deleted') for row in rows)
+                    body_ids = [row[1] for row in rows]
+            Message.collect_bodies(_cursor, body_ids)
+            unchanged = [message_id for message_id in ids if message_id not in results]
+            if unchanged:
+                _cursor.execute("SELECT id FROM Messages WHERE id = ANY(%s);", (unchanged,))
+                results.update((row[0], 'forbidden') for row in _cursor.fetchall())
+        return {key: results.get(message_id, 'not found') for key, message_id in requested.items()}
     
     def save_to_db(self, _cursor):
         """
-        Saves message to DB if message is new (id is -1). Otherwise it updates the message.
+        Saves message to DB if message is new (id is -1). Otherwise it updates the message -
+        only columns changed since message was loaded. If nothing has changed, no query is run.
+        Text is stored with save_bodies() - message refers to existing body if the same text is already saved.
 
         :param _cursor: parameter passed with connector decorator
         :return:
         """
         if self.__id == -1:
-            sql = """INSERT INTO Messages(text, from_id, to_id, is_visible, creation_date)
+            self.body_id = Message.save_bodies(_cursor, [self.text])[self.text]
+            sql = """INSERT INTO Messages(body_id, from_id, to_id, is_visible, creation_date)
                      VALUES(%s, %s, %s, %s, %s) RETURNING id;"""
-            values = (self.text, self.from_id, self.to_id, self.is_visible, self.creation_date)
+            values = (self.body_id, self.from_id, self.to_id, self.is_visible, self.creation_date)
             _cursor.execute(sql, values)
             self.__id = _cursor.fetchone()[0]
-        else:
-            sql = """UPDATE Messages SET text = %s, from_id = %s, to_id = %s, is_visible = %s
-                         WHERE id=%s;"""
-            values = (self.text, self.from_id, self.to_id, self.is_visible, self.id)
-            _cursor.execute(sql, values)
-
+            self.mark_clean()
+            return
+        changes = self.changed_columns()
+        old_body_id = None
+        if any(column == 'text' for column, value in changes):
+            old_body_id = self.body_id
+            self.body_id = Message.save_bodies(_cursor, [self.text])[self.text]
+            changes = [(column, value) for column, value in changes if column != 'text'] + [('body_id', self.body_id)]
+        if changes:
+            values = [value for column, value in changes] + [self.id]
+            _cursor.execute(self.update_sql('Messages', changes), values)
+            self.mark_clean()
+        if old_body_id is not None and old_body_id != self.body_id:
+            Message.collect_bodies(_cursor, [old_body_id])
 
+    @staticmethod
+    def save_many(_cursor, messages, page_size=1000):
+        """
+        Inserts many new messages with multi-row INSERT statements, page_size rows per round-trip.
+        Sets id of each saved message. Each distinct text is stored once, so broadcast to many recipients
+        writes one body.
 
+        :param _cursor: parameter passed with connector decorator
+        :param messages: list of new Message objects (id is -1)
+        :param page_size: number of rows inserted by one statement, int type
+        :return: number of saved messages
+        """
+        if not messages:
+            return 0
+        bodies = Message.save_bodies(_cursor, [message.text for message in messages], page_size)
+        for message in messages:
+            message.body_id = bodies[message.text]
+        sql = "INSERT INTO Messages(body_id, from_id, to_id, is_visible, creation_date) VALUES %s RETURNING id;"
+        values = [(message.body_id, message.from_id, message.to_id, message.is_visible, message.creation_date)
+                  for message in messages]
+        ids = backend.insert_many(_cursor, sql, values, page_size)
+        for message, row in zip(messages, ids):
+            message.__id = row[0]
+            message.mark_clean()
+        return len(ids)
 
+    @staticmethod
+    def save_bodies(_cursor, texts, page_size=1000):
+        """
+        Stores texts in message_bodies table, each distinct text once - body is found by sha256 of text.
+        Text which is already stored is reused, so sending it again writes no body at all.
+        On postgres found bodies are locked (FOR KEY SHARE) until commit, so collect_bodies() of concurrent
+        transaction waits for messages which refer to them, instead of deleting them.
 
+        :param _cursor: parameter passed with connector decorator
+        :param texts: iterable of texts, string type
+        :param page_size: number of bodies looked up or inserted by one statement, int type
+        :return: dict {text: body id}
+        """
+        texts_by_hash = {hashlib.sha256(text.encode('utf-8')).digest(): text for text in set(texts)}
+        lock = " FOR KEY SHARE" if backend.name == 'postgres' else ""
+        body_ids = dict()
+        while len(body_ids) < len(texts_by_hash):
+            missing = [digest for digest in texts_by_hash if digest not in body_ids]
+            for start in range(0, len(missing), page_size):
+                _cursor.execute("SELECT hash, id FROM message_bodies WHERE hash = ANY(%s) ORDER BY id{};".format(lock),
+                                (missing[start:start + page_size],))
+                body_ids.update((bytes(digest), body_id) for digest, body_id in _cursor.fetchall())
+            new = [(digest, texts_by_hash[digest]) for digest in missing if digest not in body_ids]
+            if new:
+                # body saved meanwhile by other transaction is skipped here, next loop finds and locks it
+                sql = """INSERT INTO message_bodies(hash, text) VALUES %s
+                         ON CONFLICT (hash) DO NOTHING RETURNING hash, id;"""
+                saved = backend.insert_many(_cursor, sql, new, page_size)
+                body_ids.update((bytes(digest), body_id) for digest, body_id in saved)
+        return {text: body_ids[digest] for digest, text in texts_by_hash.items()}
 
+    @staticmethod
+    def collect_bodies(_cursor, body_ids, page_size=1000):
+        """
+        Garbage collector of message bodies - deletes bodies of given ids which no message refers to any more.
+        Called whenever messages are deleted. On postgres bodies are locked first: concurrent send which reuses
+        body either commits before and its message is seen here, or waits and saves body again.
 
+        :param _cursor: parameter passed with connector decorator
+        :param body_ids: iterable of body ids of deleted messages, int type
+        :param page_size: number of bodies checked by one statement, int type
+        :return: number of deleted bodies
+        """
+        body_ids = sorted(set(body_id for body_id in body_ids if body_id is not None))
+        deleted = 0
+        for start in range(0, len(body_ids), page_size):
+            page = body_ids[start:start + page_size]
+            if backend.name == 'postgres':
+                _cursor.execute("SELECT id FROM message_bodies WHERE id = ANY(%s) ORDER BY id FOR UPDATE;", (page,))
+            _cursor.execute("""DELETE FROM message_bodies WHERE id = ANY(%s)
+                               AND NOT EXISTS (SELECT 1 FROM Messages m WHERE m.body_id = message_bodies.id);""",
+                            (page,))
+            deleted += _cursor.rowcount
+        return deleted
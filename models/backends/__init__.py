@@ -0,0 +1,28 @@
+import os
+
+
+"""
+STORAGE_BACKEND chooses DB engine used by models: 'postgres' (default) or 'sqlite'.
+SQLITE_PATH is path to sqlite DB file used by 'sqlite' engine, ':memory:' (default) keeps DB in process memory.
+"""
+storage_backend = os.environ.get('STORAGE_BACKEND', 'postgres')
+sqlite_path = os.environ.get('SQLITE_PATH', ':memory:')
+
+
+def get_backend(name=None, **options):
+    """
+    Creates storage backend. Engine modules are imported only when chosen, so psycopg2 is not needed for sqlite.
+
+    :param name: 'postgres' or 'sqlite', string type. Defaults to STORAGE_BACKEND
+    :param options: engine options, e.g. path for sqlite
+    :return: Backend object
+    """
+    name = name or storage_backend
+    if name == 'postgres':
+        from models.backends.postgres import PostgresBackend
+        return PostgresBackend(**options)
+    elif name == 'sqlite':
+        from models.backends.sqlite import SQLiteBackend
+        options.setdefault('path', sqlite_path)
+        return SQLiteBackend(**options)
+    raise ValueError('Unknown storage backend: {}'.format(name))
@@ -0,0 +1,72 @@
+class Backend:
+    """
+    Storage backend - everything models need from DB engine which is not plain SQL.
+    Models write SQL with %s placeholders, engines which use other paramstyle translate it in their cursors.
+    """
+    name = None
+    # max number of connections which can be used at the same time, None means no engine limit
+    max_connections = None
+    # if True, engine runs INSERT/UPDATE/DELETE ... RETURNING inside WITH queries
+    writable_cte = False
+    # if True, engine can notify listeners about new messages, see listen()
+    notifications = False
+
+    def connect(self):
+        """
+        :return: new DB connection. Connection has cursor(), commit(), rollback(), close() and closed attribute
+        """
+        raise NotImplementedError
+
+    def server_cursor(self, _cursor, itersize):
+        """
+        Creates cursor which streams rows of a query instead of loading all of them into memory.
+
+        :param _cursor: cursor of current transaction
+        :param itersize: number of rows fetched in one round-trip, int type
+        :return: cursor on the same connection as _cursor
+        """
+        raise NotImplementedError
+
+    def insert_many(self, _cursor, sql, rows, page_size):
+        """
+        Runs multi-row INSERT. sql has one '%s' in place of VALUES list and ends with RETURNING clause.
+
+        :param _cursor: cursor of current transaction
+        :param sql: INSERT ... VALUES %s RETURNING ... statement
+        :param rows: list of tuples, one tuple is one inserted row
+        :param page_size: number of rows inserted by one statement, int type
+        :return: list of returned rows, in order of inserted rows
+        """
+        raise NotImplementedError
+
+    def copy_rows(self, _cursor, table, columns, rows):
+        """
+        Bulk loads rows into table using fastest way engine has.
+
+        :param _cursor: cursor of current transaction
+        :param table: table name, string type
+        :param columns: tuple of column names
+        :param rows: list of tuples, values in order of columns
+        :return: None
+        """
+        raise NotImplementedError
+
+    def lock(self, _cursor, name):
+        """
+        Takes lock which is held until end of current transaction. Used to serialize e.g. migrations.
+
+        :param _cursor: cursor of current transaction
+        :param name: lock name, string type
+        :return: None
+        """
+        raise NotImplementedError
+
+    def listen(self, channel):
+        """
+        Opens dedicated connection, in autocommit mode, which listens for notifications on channel.
+        Only engines with notifications support it.
+
+        :param channel: channel name, string type
+        :return: new DB connection. Caller closes it
+        """
+        raise NotImplementedError
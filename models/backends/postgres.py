@@ -0,0 +1,61 @@
+from io import StringIO
+from itertools import count
+from models.backends.base import Backend
+import csv
+import os
+
+
+db_username = os.environ.get('POSTGRES_USERNAME')
+passwd = os.environ.get('POSTGRES_PASSWORD')
+hostname = os.environ.get('POSTGRES_HOST')
+db_name = os.environ.get('POSTGRES_DB_NAME')
+
+
+class PostgresBackend(Backend):
+    """
+    Postgres engine, uses psycopg2. Connection data is taken from POSTGRES_* environment variables.
+    """
+    name = 'postgres'
+    writable_cte = True
+    notifications = True
+
+    def __init__(self, **connect_kwargs):
+        """
+        :param connect_kwargs: psycopg2.connect() arguments, override POSTGRES_* environment variables
+        """
+        self.connect_kwargs = dict(user=db_username, password=passwd, host=hostname, database=db_name)
+        self.connect_kwargs.update(connect_kwargs)
+        self._cursor_names = count()
+
+    def connect(self):
+        # psycopg2 is imported with first connection, so programs which do not touch DB start faster
+        from psycopg2 import connect
+        return connect(**self.connect_kwargs)
+
+    def server_cursor(self, _cursor, itersize):
+        # named cursor is kept on server side, rows are fetched itersize at a time
+        named_cursor = _cursor.connection.cursor(name='messages_{}'.format(next(self._cursor_names)))
+        named_cursor.itersize = itersize
+        return named_cursor
+
+    def insert_many(self, _cursor, sql, rows, page_size):
+        from psycopg2.extras import execute_values
+        return execute_values(_cursor, sql, rows, page_size=page_size, fetch=True)
+
+    def copy_rows(self, _cursor, table, columns, rows):
+        buffer = StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        sql = "COPY {}({}) FROM STDIN WITH (FORMAT csv);".format(table, ', '.join(columns))
+        _cursor.copy_expert(sql, buffer)
+
+    def lock(self, _cursor, name):
+        _cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (name,))
+
+    def listen(self, channel):
+        # listening connection is not in pool - it stays open as long as listener runs, never inside transaction
+        cnx = self.connect()
+        cnx.autocommit = True
+        with cnx.cursor() as listen_cursor:
+            listen_cursor.execute('LISTEN "{}";'.format(channel))
+        return cnx
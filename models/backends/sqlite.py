@@ -0,0 +1,198 @@
+from datetime import datetime
+from models.backends.base import Backend
+import hashlib
+import re
+import sqlite3
+import threading
+
+
+# models keep dates as naive UTC datetimes, sqlite stores them as ISO text which sorts the same way
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+sqlite3.register_converter('TIMESTAMP', lambda value: datetime.fromisoformat(value.decode()))
+
+_placeholders = re.compile(r"=\s*ANY\(%s\)|%s|%%")
+
+
+def translate(sql, params):
+    """
+    Translates query written for psycopg2 into sqlite3 one: '%s' becomes '?', '%%' becomes '%'
+    and '= ANY(%s)' with list parameter becomes 'IN (?, ?, ...)'.
+    Like psycopg2, query without parameters is left as it is.
+
+    :param sql: query with %s placeholders
+    :param params: sequence of query parameters or None
+    :return: tuple of translated query and list of parameters
+    """
+    if params is None:
+        return sql, ()
+    params = iter(params)
+    translated = list()
+
+    def replace(match):
+        token = match.group(0)
+        if token == '%%':
+            return '%'
+        value = next(params)
+        if token == '%s':
+            translated.append(value)
+            return '?'
+        values = list(value)
+        translated.extend(values)
+        return 'IN ({})'.format(', '.join('?' * len(values)))
+
+    return _placeholders.sub(replace, sql), translated
+
+
+class SQLiteCursor:
+    """
+    sqlite3 cursor which accepts queries written for psycopg2.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self._cursor = connection.raw.cursor()
+        self.itersize = 2000
+
+    def execute(self, sql, params=None):
+        self.connection.begin()
+        sql, params = translate(sql, params)
+        self._cursor.execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        self.connection.begin()
+        seq_of_params = list(seq_of_params)
+        if not seq_of_params:
+            return
+        translated_sql = translate(sql, seq_of_params[0])[0]
+        self._cursor.executemany(translated_sql, [translate(sql, params)[1] for params in seq_of_params])
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size=None):
+        return self._cursor.fetchmany(size or self.itersize)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def __iter__(self):
+        while True:
+            rows = self._cursor.fetchmany(self.itersize)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def close(self):
+        self._cursor.close()
+
+
+class SQLiteConnection:
+    """
+    sqlite3 connection with psycopg2-like transactions: transaction starts with first statement
+    (DDL included) and lasts until commit() or rollback().
+    """
+    def __init__(self, raw, shared=False):
+        """
+        :param raw: sqlite3 connection opened in autocommit mode
+        :param shared: if True close() keeps raw connection open - used for in-memory DB, which lives as long as it
+        """
+        self.raw = raw
+        self.shared = shared
+        self.closed = False
+        self._in_transaction = False
+
+    def begin(self):
+        if not self._in_transaction:
+            # write lock is taken up front - deferred transaction which reads and then writes fails with
+            # 'database is locked' instead of waiting, when other connection has written in the meantime
+            self.raw.execute('BEGIN IMMEDIATE')
+            self._in_transaction = True
+
+    def cursor(self):
+        return SQLiteCursor(self)
+
+    def commit(self):
+        if self._in_transaction:
+            self.raw.execute('COMMIT')
+            self._in_transaction = False
+
+    def rollback(self):
+        if self._in_transaction:
+            self.raw.execute('ROLLBACK')
+            self._in_transaction = False
+
+    def close(self):
+        self.rollback()
+        if not self.shared:
+            self.raw.close()
+        self.closed = True
+
+
+class SQLiteBackend(Backend):
+    """
+    SQLite engine, uses sqlite3 from standard library. DB is kept in file or in process memory (':memory:').
+    In-memory DB is one connection shared by the whole process, hence max_connections is 1.
+    """
+    name = 'sqlite'
+
+    def __init__(self, path=':memory:', busy_timeout=30):
+        """
+        :param path: path to DB file or ':memory:', string type
+        :param busy_timeout: how many seconds connection waits for lock held by other connection
+        """
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._memory_connection = None
+        self._lock = threading.Lock()
+        if path == ':memory:':
+            self.max_connections = 1
+
+    def _open(self):
+        raw = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                              detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        raw.execute('PRAGMA foreign_keys = ON')
+        # the same as postgres sha256(bytea), used by migrations to address message bodies
+        raw.create_function('sha256', 1, lambda value: hashlib.sha256(value).digest(), deterministic=True)
+        if self.path != ':memory:':
+            raw.execute('PRAGMA journal_mode = WAL')
+        return raw
+
+    def connect(self):
+        if self.path != ':memory:':
+            return SQLiteConnection(self._open())
+        with self._lock:
+            if self._memory_connection is None:
+                self._memory_connection = self._open()
+        return SQLiteConnection(self._memory_connection, shared=True)
+
+    def server_cursor(self, _cursor, itersize):
+        # sqlite steps through query result lazily, plain cursor already streams rows
+        stream_cursor = _cursor.connection.cursor()
+        stream_cursor.itersize = itersize
+        return stream_cursor
+
+    def insert_many(self, _cursor, sql, rows, page_size):
+        returned = list()
+        for start in range(0, len(rows), page_size):
+            page = rows[start:start + page_size]
+            row_placeholder = '({})'.format(', '.join(['%s'] * len(page[0])))
+            values = [value for row in page for value in row]
+            _cursor.execute(sql.replace('%s', ', '.join([row_placeholder] * len(page)), 1), values)
+            returned.extend(_cursor.fetchall())
+        return returned
+
+    def copy_rows(self, _cursor, table, columns, rows):
+        sql = "INSERT INTO {}({}) VALUES({});".format(table, ', '.join(columns), ', '.join(['%s'] * len(columns)))
+        _cursor.executemany(sql, rows)
+
+    def lock(self, _cursor, name):
+        # sqlite has one writer at a time, first write of transaction already locks the whole DB
+        pass
@@ -0,0 +1,184 @@
+from collections import OrderedDict
+import select
+import threading
+import time
+
+
+"""
+MISSING is returned by TTLCache.get() when key is not cached - None is valid cached value.
+"""
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache with time-to-live. One instance is shared by all threads of a process,
+    so in server mode all requests use the same cache. It is not shared between processes - changes made
+    by other process are seen after ttl, so credentials are never checked against cached rows.
+    Counts hits, misses, evictions and invalidations.
+
+    It is also the interface of cache backends: get(), peek(), set(), delete(), clear(), start() and stats().
+    NotifiedTTLCache below is the backend for many processes.
+    """
+    def __init__(self, max_size=10000, ttl=60):
+        """
+        :param max_size: max number of cached entries, least recently used are evicted first. int type
+        :param ttl: how many seconds entry is valid, 0 disables cache. int or float type
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.max_size > 0
+
+    def get(self, key):
+        """
+        :param key: cache key, any hashable
+        :return: cached value or MISSING if key is not cached or has expired
+        """
+        if not self.enabled:
+            return MISSING
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def peek(self, key):
+        """
+        Like get(), but does not count hit or miss and does not refresh LRU order.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                return MISSING
+            return entry[1]
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def start(self):
+        """
+        Prepares cache for long running process, e.g. server. Local cache needs nothing.
+        """
+
+    def stats(self):
+        """
+        :return: dict with hit/miss counters and number of cached entries
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'size': len(self._entries)}
+
+
+class NotifiedTTLCache(TTLCache):
+    """
+    TTLCache for many processes, e.g. several servers and CLI commands using the same DB. Each process keeps
+    its own entries, and drops them as soon as DB announces that row has changed - in whichever process.
+    Listener thread keeps one DB connection open for announcements. Entries are served only while it is
+    connected; when connection is lost, cache is cleared, as announcements could have been missed.
+    Row loaded just before change of other process can still be cached after announcement, until ttl.
+    """
+    def __init__(self, listen, keys_of, max_size=10000, ttl=60, retry_delay=5):
+        """
+        :param listen: function which opens DB connection listening for announcements, see Backend.listen()
+        :param keys_of: function which returns list of cache keys of changed row, gets announcement payload
+        :param max_size: see TTLCache
+        :param ttl: see TTLCache
+        :param retry_delay: how many seconds listener waits before it connects again, int or float type
+        """
+        super().__init__(max_size, ttl)
+        self.listen = listen
+        self.keys_of = keys_of
+        self.retry_delay = retry_delay
+        self._listener = None
+        self._listening = threading.Event()
+
+    def get(self, key):
+        self.start()
+        if not self._listening.is_set():
+            with self._lock:
+                self.misses += 1
+            return MISSING
+        return super().get(key)
+
+    def set(self, key, value):
+        if self._listening.is_set():
+            super().set(key, value)
+
+    def start(self):
+        """
+        Starts listener thread, once. Called by first get() as well.
+        """
+        with self._lock:
+            if self._listener is not None:
+                return
+            self._listener = threading.Thread(target=self._listen_forever, name='cache-listener', daemon=True)
+        self._listener.start()
+
+    def _listen_forever(self):
+        while True:
+            try:
+                cnx = self.listen()
+            except NotImplementedError:
+                # storage without notifications - cache stays disabled
+                return
+            except Exception:
+                time.sleep(self.retry_delay)
+                continue
+            try:
+                # entries cached before listening started could be stale
+                self.clear()
+                self._listening.set()
+                while True:
+                    select.select([cnx], [], [])
+                    cnx.poll()
+                    while cnx.notifies:
+                        self.delete(*self.keys_of(cnx.notifies.pop(0).payload))
+            except Exception:
+                pass
+            finally:
+                self._listening.clear()
+                self.clear()
+                try:
+                    cnx.close()
+                except Exception:
+                    pass
+            time.sleep(self.retry_delay)
+
+    def stats(self):
+        stats = super().stats()
+        stats['listening'] = self._listening.is_set()
+        return stats
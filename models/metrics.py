@@ -0,0 +1,282 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import json
+import re
+import threading
+import time
+
+
+"""
+Upper bounds (seconds) of latency histogram buckets, the last bucket (+Inf) is implicit.
+"""
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+"""
+Prefix of all exported metric names.
+"""
+PREFIX = 'warsztat2_db_'
+
+_whitespace = re.compile(r'\s+')
+
+
+def query_key(sql):
+    """
+    Normalizes query into label under which its statistics are kept: values list of multi-row INSERT
+    is cut out and whitespace is collapsed, so each statement of models has one label however many rows it handles.
+
+    :param sql: executed query, string or bytes type
+    :return: string
+    """
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    upper = sql.upper()
+    start = upper.find('VALUES')
+    if start != -1:
+        ends = [end for end in (upper.find('RETURNING', start), upper.find('ON CONFLICT', start)) if end != -1]
+        sql = sql[:start] + 'VALUES ... ' + (sql[min(ends):] if ends else '')
+    return _whitespace.sub(' ', sql).strip()[:200]
+
+
+class Histogram:
+    """
+    Counts of observed values in buckets, with their sum. Not thread-safe, Metrics guards it with its lock.
+    """
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self, size):
+        self.counts = [0] * (size + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, buckets, value):
+        self.counts[bisect_left(buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, buckets, q):
+        """
+        :return: upper bound of bucket in which q-quantile lies, None if nothing was observed
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    """
+    Thread-safe registry of DB metrics: latency histograms (per query and for connect, commit and pool wait)
+    and rows returned per query. Exported in Prometheus text format or as JSON.
+    When disabled, models use raw cursors and skip all timing, so instrumentation costs nothing.
+    """
+    def __init__(self, enabled=False, slow_query_ms=None, buckets=DEFAULT_BUCKETS):
+        """
+        :param enabled: if True, models record metrics, boolean type
+        :param slow_query_ms: queries slower than this (milliseconds) are logged by 'models.slow_queries' logger.
+            None disables slow query log
+        :param buckets: sorted upper bounds of histogram buckets, in seconds
+        """
+        self.enabled = enabled
+        self.slow_query_ms = slow_query_ms
+        self.buckets = tuple(buckets)
+        self._histograms = dict()
+        self._rows = dict()
+        self._slow_queries = 0
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds, query=None):
+        """
+        :param name: histogram name, e.g. 'commit_seconds', string type
+        :param seconds: observed duration, float type
+        :param query: query label of per-query histogram, None for others
+        :return: None
+        """
+        with self._lock:
+            histogram = self._histograms.get((name, query))
+            if histogram is None:
+                histogram = self._histograms[(name, query)] = Histogram(len(self.buckets))
+            histogram.observe(self.buckets, seconds)
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Measures duration of with block into histogram of given name.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name, func):
+        """
+        :return: function which calls func and measures its duration into histogram of given name
+        """
+        def wrapper(*args, **kwargs):
+            with self.timer(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def query_done(self, query, seconds):
+        """
+        Records executed query, logs it if it was slow.
+
+        :param query: query label, see query_key()
+        :param seconds: query duration, float type
+        :return: None
+        """
+        self.observe('query_seconds', seconds, query)
+        if self.slow_query_ms is not None and seconds * 1000 >= self.slow_query_ms:
+            with self._lock:
+                self._slow_queries += 1
+            # logging is imported only when needed, it is slow to import
+            import logging
+            logging.getLogger('models.slow_queries').warning('Slow query (%.1f ms): %s', seconds * 1000, query)
+
+    def add_rows(self, query, rows):
+        with self._lock:
+            self._rows[query] = self._rows.get(query, 0) + rows
+
+    def instrument(self, cursor):
+        """
+        :param cursor: DB cursor
+        :return: InstrumentedCursor wrapping cursor if metrics are enabled, otherwise cursor itself
+        """
+        if not self.enabled:
+            return cursor
+        return InstrumentedCursor(cursor, self)
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._rows.clear()
+            self._slow_queries = 0
+
+    def to_dict(self):
+        """
+        :return: all metrics as dict which can be serialized to JSON. Percentiles are upper bounds of buckets
+        """
+        with self._lock:
+            histograms = dict()
+            items = sorted(self._histograms.items(), key=lambda item: (item[0][0], item[0][1] or ''))
+            for (name, query), histogram in items:
+                p50 = histogram.quantile(self.buckets, 0.5)
+                p99 = histogram.quantile(self.buckets, 0.99)
+                entry = {'count': histogram.count,
+                         'sum': histogram.total,
+                         'p50': None if p50 == float('inf') else p50,
+                         'p99': None if p99 == float('inf') else p99}
+                if query is not None:
+                    entry['query'] = query
+                    entry['rows'] = self._rows.get(query, 0)
+                histograms.setdefault(name, list()).append(entry)
+            return {'histograms': histograms, 'slow_queries': self._slow_queries}
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def to_prometheus(self):
+        """
+        :return: all metrics in Prometheus text exposition format, string type
+        """
+        lines = list()
+        with self._lock:
+            by_name = dict()
+            for (name, query), histogram in self._histograms.items():
+                by_name.setdefault(name, list()).append((query, histogram))
+            for name in sorted(by_name):
+                metric = PREFIX + name
+                lines.append('# TYPE {} histogram'.format(metric))
+                for query, histogram in sorted(by_name[name], key=lambda item: item[0] or ''):
+                    labels = 'query="{}",'.format(_escape(query)) if query is not None else ''
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + (float('inf'),), histogram.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append('{}_bucket{{{}le="{}"}} {}'.format(metric, labels, le, cumulative))
+                    labels = '{{{}}}'.format(labels.rstrip(',')) if labels else ''
+                    lines.append('{}_sum{} {}'.format(metric, labels, repr(histogram.total)))
+                    lines.append('{}_count{} {}'.format(metric, labels, histogram.count))
+            lines.append('# TYPE {}rows_total counter'.format(PREFIX))
+            for query in sorted(self._rows):
+                lines.append('{}rows_total{{query="{}"}} {}'.format(PREFIX, _escape(query), self._rows[query]))
+            lines.append('# TYPE {}slow_queries_total counter'.format(PREFIX))
+            lines.append('{}slow_queries_total {}'.format(PREFIX, self._slow_queries))
+        return '\n'.join(lines) + '\n'
+
+
+    def write(self, path):
+        """
+        Saves metrics to file - in Prometheus text format if path ends with '.prom', otherwise as JSON.
+
+        :param path: file path, string type
+        :return: None
+        """
+        with open(path, 'w') as file:
+            file.write(self.to_prometheus() if path.endswith('.prom') else self.to_json())
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class InstrumentedCursor:
+    """
+    Cursor wrapper which times every execute() and counts fetched rows of each query.
+    Everything else is passed to wrapped cursor.
+    """
+    def __init__(self, cursor, metrics):
+        self._cursor = cursor
+        self._metrics = metrics
+        self._query = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _timed(self, method, sql, *args):
+        self._query = query_key(sql)
+        start = time.perf_counter()
+        try:
+            return method(sql, *args)
+        finally:
+            self._metrics.query_done(self._query, time.perf_counter() - start)
+
+    def execute(self, sql, params=None):
+        return self._timed(self._cursor.execute, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self._timed(self._cursor.executemany, sql, seq_of_params)
+
+    def _fetched(self, rows):
+        if self._query is not None and rows:
+            self._metrics.add_rows(self._query, rows)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        self._fetched(0 if row is None else 1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._cursor.fetchmany(*args)
+        self._fetched(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._fetched(len(rows))
+        return rows
+
+    def __iter__(self):
+        fetched = 0
+        try:
+            for row in self._cursor:
+                fetched += 1
+                yield row
+        finally:
+            self._fetched(fetched)
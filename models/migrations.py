@@ -0,0 +1,530 @@
+from argparse import ArgumentParser
+from datetime import datetime
+import models
+from models import connector
+import os
+
+
+"""
+MIGRATIONS keeps all schema versions in order. Each one is tuple (version, description, statements).
+Statements is list of sql statements run on every backend, or dict {backend name: list of statements}
+if SQL differs between engines. Applied versions are recorded in schema_migrations table.
+Never edit migration which has been released - add new one at the end instead.
+"""
+MIGRATIONS = [
+    (1, 'users and messages tables', {
+        'postgres': [
+            """CREATE TABLE IF NOT EXISTS users (
+                   id serial PRIMARY KEY,
+                   username varchar(255) NOT NULL,
+                   hashed_password varchar(80) NOT NULL
+               );""",
+            """CREATE TABLE IF NOT EXISTS messages (
+                   id serial PRIMARY KEY,
+                   text text NOT NULL,
+                   from_id integer NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+                   to_id integer NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+                   is_visible boolean NOT NULL DEFAULT true,
+                   creation_date timestamp NOT NULL DEFAULT (now() at time zone 'utc')
+               );""",
+        ],
+        'sqlite': [
+            """CREATE TABLE IF NOT EXISTS users (
+                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   username VARCHAR(255) NOT NULL,
+                   hashed_password VARCHAR(80) NOT NULL
+               );""",
+            """CREATE TABLE IF NOT EXISTS messages (
+                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   text TEXT NOT NULL,
+                   from_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+                   to_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+                   is_visible BOOLEAN NOT NULL DEFAULT 1,
+                   creation_date TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now'))
+               );""",
+        ],
+    }),
+    (2, 'indexes for user lookups and mailbox queries', [
+        "CREATE UNIQUE INDEX IF NOT EXISTS users_username_idx ON users (username);",
+        # recipient mailbox - only visible messages are ever listed, keyset order (creation_date, id)
+        """CREATE INDEX IF NOT EXISTS messages_to_visible_idx ON messages (to_id, creation_date DESC, id DESC)
+           WHERE is_visible;""",
+        # sender mailbox, keyset order (creation_date, id)
+        "CREATE INDEX IF NOT EXISTS messages_from_idx ON messages (from_id, creation_date DESC, id DESC);",
+        # all messages of recipient, hidden as well - used by ON DELETE CASCADE
+        "CREATE INDEX IF NOT EXISTS messages_to_idx ON messages (to_id);",
+    ]),
+    (3, 'full-text search over message text', {
+        'postgres': [
+            """ALTER TABLE messages ADD COLUMN search_vector tsvector
+               GENERATED ALWAYS AS (to_tsvector('simple', text)) STORED;""",
+            "CREATE INDEX messages_search_idx ON messages USING GIN (search_vector);",
+        ],
+        'sqlite': [
+            # external content FTS5 table, kept in sync with messages by triggers
+            "CREATE VIRTUAL TABLE messages_fts USING fts5(text, content='messages', content_rowid='id');",
+            """CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+                   INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+               END;""",
+            """CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+                   INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+               END;""",
+            """CREATE TRIGGER messages_fts_update AFTER UPDATE OF text ON messages BEGIN
+                   INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+                   INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+               END;""",
+            "INSERT INTO messages_fts(messages_fts) VALUES ('rebuild');",
+        ],
+    }),
+    (4, 'unread flag and mailbox counters', {
+        'postgres': [
+            # messages which already exist count as read, new ones are unread
+            "ALTER TABLE messages ADD COLUMN is_read boolean NOT NULL DEFAULT true;",
+            "ALTER TABLE messages ALTER COLUMN is_read SET DEFAULT false;",
+            """CREATE TABLE mailbox_counters (
+                   user_id integer PRIMARY KEY,
+                   total bigint NOT NULL DEFAULT 0,
+                   unread bigint NOT NULL DEFAULT 0,
+                   hidden bigint NOT NULL DEFAULT 0
+               );""",
+            """INSERT INTO mailbox_counters(user_id, total, unread, hidden)
+               SELECT to_id, count(*) FILTER (WHERE is_visible), count(*) FILTER (WHERE is_visible AND NOT is_read),
+                      count(*) FILTER (WHERE NOT is_visible)
+               FROM messages GROUP BY to_id;""",
+            # statement level triggers - one counters upsert per recipient per statement, also for bulk sends
+            """CREATE FUNCTION mailbox_counters_apply() RETURNS trigger LANGUAGE plpgsql AS $$
+               BEGIN
+                   IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                       INSERT INTO mailbox_counters AS c (user_id, total, unread, hidden)
+                       SELECT to_id, -count(*) FILTER (WHERE is_visible),
+                              -count(*) FILTER (WHERE is_visible AND NOT is_read),
+                              -count(*) FILTER (WHERE NOT is_visible)
+                       FROM old_rows GROUP BY to_id
+                       ON CONFLICT (user_id) DO UPDATE SET total = c.total + EXCLUDED.total,
+                           unread = c.unread + EXCLUDED.unread, hidden = c.hidden + EXCLUDED.hidden;
+                   END IF;
+                   IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                       INSERT INTO mailbox_counters AS c (user_id, total, unread, hidden)
+                       SELECT to_id, count(*) FILTER (WHERE is_visible),
+                              count(*) FILTER (WHERE is_visible AND NOT is_read), count(*) FILTER (WHERE NOT is_visible)
+                       FROM new_rows GROUP BY to_id
+                       ON CONFLICT (user_id) DO UPDATE SET total = c.total + EXCLUDED.total,
+                           unread = c.unread + EXCLUDED.unread, hidden = c.hidden + EXCLUDED.hidden;
+                   END IF;
+                   RETURN NULL;
+               END $$;""",
+            """CREATE TRIGGER mailbox_counters_insert AFTER INSERT ON messages
+               REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION mailbox_counters_apply();""",
+            """CREATE TRIGGER mailbox_counters_update AFTER UPDATE ON messages
+               REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+               FOR EACH STATEMENT EXECUTE FUNCTION mailbox_counters_apply();""",
+            """CREATE TRIGGER mailbox_counters_delete AFTER DELETE ON messages
+               REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION mailbox_counters_apply();""",
+        ],
+        'sqlite': [
+            "ALTER TABLE messages ADD COLUMN is_read BOOLEAN NOT NULL DEFAULT 0;",
+            "UPDATE messages SET is_read = 1;",
+            """CREATE TABLE mailbox_counters (
+                   user_id INTEGER PRIMARY KEY,
+                   total INTEGER NOT NULL DEFAULT 0,
+                   unread INTEGER NOT NULL DEFAULT 0,
+                   hidden INTEGER NOT NULL DEFAULT 0
+               );""",
+            """INSERT INTO mailbox_counters(user_id, total, unread, hidden)
+               SELECT to_id, sum(is_visible), sum(is_visible AND NOT is_read), sum(NOT is_visible)
+               FROM messages GROUP BY to_id;""",
+            """CREATE TRIGGER mailbox_counters_insert AFTER INSERT ON messages BEGIN
+                   INSERT INTO mailbox_counters(user_id, total, unread, hidden)
+                   VALUES (new.to_id, new.is_visible, new.is_visible AND NOT new.is_read, NOT new.is_visible)
+                   ON CONFLICT(user_id) DO UPDATE SET total = total + excluded.total,
+                       unread = unread + excluded.unread, hidden = hidden + excluded.hidden;
+               END;""",
+            """CREATE TRIGGER mailbox_counters_update AFTER UPDATE OF to_id, is_visible, is_read ON messages BEGIN
+                   INSERT INTO mailbox_counters(user_id, total, unread, hidden)
+                   VALUES (old.to_id, -old.is_visible, -(old.is_visible AND NOT old.is_read), -(NOT old.is_visible))
+                   ON CONFLICT(user_id) DO UPDATE SET total = total + excluded.total,
+                       unread = unread + excluded.unread, hidden = hidden + excluded.hidden;
+                   INSERT INTO mailbox_counters(user_id, total, unread, hidden)
+                   VALUES (new.to_id, new.is_visible, new.is_visible AND NOT new.is_read, NOT new.is_visible)
+                   ON CONFLICT(user_id) DO UPDATE SET total = total + excluded.total,
+                       unread = unread + excluded.unread, hidden = hidden + excluded.hidden;
+               END;""",
+            """CREATE TRIGGER mailbox_counters_delete AFTER DELETE ON messages BEGIN
+                   INSERT INTO mailbox_counters(user_id, total, unread, hidden)
+                   VALUES (old.to_id, -old.is_visible, -(old.is_visible AND NOT old.is_read), -(NOT old.is_visible))
+                   ON CONFLICT(user_id) DO UPDATE SET total = total + excluded.total,
+                       unread = unread + excluded.unread, hidden = hidden + excluded.hidden;
+               END;""",
+        ],
+    }),
+    (5, 'conversation index', {
+        'postgres': [
+            """CREATE INDEX messages_conversation_idx
+               ON messages (least(from_id, to_id), greatest(from_id, to_id), creation_date DESC, id DESC);""",
+        ],
+        'sqlite': [
+            # two-argument min() and max() are sqlite's least() and greatest()
+            """CREATE INDEX messages_conversation_idx
+               ON messages (min(from_id, to_id), max(from_id, to_id), creation_date DESC, id DESC);""",
+        ],
+    }),
+    (6, 'messages partitioned by month of creation_date', {
+        'postgres': [
+            # creates monthly partitions between given dates, rows of new month kept so far by default partition
+            # are moved into it - deleted and inserted through messages, so counters triggers stay balanced
+            """CREATE FUNCTION ensure_message_partitions(since timestamp, until timestamp) RETURNS integer
+               LANGUAGE plpgsql AS $$
+               DECLARE
+                   month_start timestamp := date_trunc('month', since);
+                   partition_name text;
+                   created integer := 0;
+               BEGIN
+                   WHILE month_start < until LOOP
+                       partition_name := 'messages_' || to_char(month_start, 'YYYY_MM');
+                       IF to_regclass(partition_name) IS NULL THEN
+                           CREATE TEMP TABLE moved_messages (LIKE messages) ON COMMIT DROP;
+                           WITH moved AS (
+                               DELETE FROM messages
+                               WHERE creation_date >= month_start AND creation_date < month_start + interval '1 month'
+                               RETURNING id, text, from_id, to_id, is_visible, creation_date, is_read
+                           )
+                           INSERT INTO moved_messages(id, text, from_id, to_id, is_visible, creation_date, is_read)
+                           SELECT * FROM moved;
+                           EXECUTE format('CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+                                          partition_name, month_start, month_start + interval '1 month');
+                           INSERT INTO messages(id, text, from_id, to_id, is_visible, creation_date, is_read)
+                           SELECT id, text, from_id, to_id, is_visible, creation_date, is_read FROM moved_messages;
+                           DROP TABLE moved_messages;
+                           created := created + 1;
+                       END IF;
+                       month_start := month_start + interval '1 month';
+                   END LOOP;
+                   RETURN created;
+               END $$;""",
+            "ALTER TABLE messages RENAME TO messages_unpartitioned;",
+            "ALTER TABLE messages_unpartitioned RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey;",
+            # sequence would be dropped with old table
+            "ALTER SEQUENCE messages_id_seq OWNED BY NONE;",
+            # primary key of partitioned table has to contain partition key
+            """CREATE TABLE messages (
+                   id integer NOT NULL DEFAULT nextval('messages_id_seq'),
+                   text text NOT NULL,
+                   from_id integer NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+                   to_id integer NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+                   is_visible boolean NOT NULL DEFAULT true,
+                   creation_date timestamp NOT NULL DEFAULT (now() at time zone 'utc'),
+                   search_vector tsvector GENERATED ALWAYS AS (to_tsvector('simple', text)) STORED,
+                   is_read boolean NOT NULL DEFAULT false,
+                   PRIMARY KEY (id, creation_date)
+               ) PARTITION BY RANGE (creation_date);""",
+            "ALTER SEQUENCE messages_id_seq OWNED BY messages.id;",
+            # catches rows outside of created partitions, ensure_message_partitions() moves them out
+            "CREATE TABLE messages_default PARTITION OF messages DEFAULT;",
+            """SELECT ensure_message_partitions(
+                   coalesce((SELECT min(creation_date) FROM messages_unpartitioned), now() at time zone 'utc'),
+                   now() at time zone 'utc' + interval '3 months');""",
+            """INSERT INTO messages(id, text, from_id, to_id, is_visible, creation_date, is_read)
+               SELECT id, text, from_id, to_id, is_visible, creation_date, is_read FROM messages_unpartitioned;""",
+            "DROP TABLE messages_unpartitioned;",
+            # indexes and triggers are created on filled table, its rows are already counted
+            """CREATE INDEX messages_to_visible_idx ON messages (to_id, creation_date DESC, id DESC)
+               WHERE is_visible;""",
+            "CREATE INDEX messages_from_idx ON messages (from_id, creation_date DESC, id DESC);",
+            "CREATE INDEX messages_to_idx ON messages (to_id);",
+            "CREATE INDEX messages_search_idx ON messages USING GIN (search_vector);",
+            """CREATE INDEX messages_conversation_idx
+               ON messages (least(from_id, to_id), greatest(from_id, to_id), creation_date DESC, id DESC);""",
+            """CREATE TRIGGER mailbox_counters_insert AFTER INSERT ON messages
+               REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION mailbox_counters_apply();""",
+            """CREATE TRIGGER mailbox_counters_update AFTER UPDATE ON messages
+               REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+               FOR EACH STATEMENT EXECUTE FUNCTION mailbox_counters_apply();""",
+            """CREATE TRIGGER mailbox_counters_delete AFTER DELETE ON messages
+               REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION mailbox_counters_apply();""",
+        ],
+        # sqlite has no partitioning, archive job deletes old rows instead
+        'sqlite': [],
+    }),
+    (7, 'notifications about new messages', {
+        'postgres': [
+            # one NOTIFY per inserted message on channel of its recipient, payload is message id.
+            # Notifications are delivered on commit, so listeners never see rolled back messages
+            """CREATE FUNCTION messages_notify() RETURNS trigger LANGUAGE plpgsql AS $$
+               BEGIN
+                   PERFORM pg_notify('messages_' || to_id, id::text) FROM new_rows;
+                   RETURN NULL;
+               END $$;""",
+            """CREATE TRIGGER messages_notify AFTER INSERT ON messages
+               REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION messages_notify();""",
+        ],
+        # sqlite has no notifications
+        'sqlite': [],
+    }),
+    (8, 'longer password hashes', {
+        # $kdf$params$salt$key hashes are longer than legacy 80 chars. Making varchar longer does not rewrite table
+        'postgres': ["ALTER TABLE users ALTER COLUMN hashed_password TYPE varchar(255);"],
+        # sqlite does not enforce varchar length
+        'sqlite': [],
+    }),
+    (9, 'deduplicated message bodies', {
+        'postgres': [
+            # every distinct text is stored once, found by sha256 of its UTF-8 bytes. Messages refer to body by id,
+            # so row of broadcast message stays narrow. Search vector is kept per body as well
+            """CREATE TABLE message_bodies (
+                   id serial PRIMARY KEY,
+                   hash bytea NOT NULL UNIQUE,
+                   text text NOT NULL,
+                   search_vector tsvector GENERATED ALWAYS AS (to_tsvector('simple', text)) STORED
+               );""",
+            """INSERT INTO message_bodies(hash, text)
+               SELECT DISTINCT sha256(convert_to(text, 'UTF8')), text FROM messages;""",
+            "ALTER TABLE messages ADD COLUMN body_id integer;",
+            """UPDATE messages m SET body_id = b.id FROM message_bodies b
+               WHERE b.hash = sha256(convert_to(m.text, 'UTF8'));""",
+            "ALTER TABLE messages ALTER COLUMN body_id SET NOT NULL;",
+            """ALTER TABLE messages ADD CONSTRAINT messages_body_id_fkey
+               FOREIGN KEY (body_id) REFERENCES message_bodies(id);""",
+            # search index of messages goes with search_vector column
+            "ALTER TABLE messages DROP COLUMN search_vector, DROP COLUMN text;",
+            # bodies garbage collector looks for messages which still refer to body
+            "CREATE INDEX messages_body_idx ON messages (body_id);",
+            "CREATE INDEX message_bodies_search_idx ON message_bodies USING GIN (search_vector);",
+            # the same function as in migration 6, with body_id column instead of text
+            """CREATE OR REPLACE FUNCTION ensure_message_partitions(since timestamp, until timestamp) RETURNS integer
+               LANGUAGE plpgsql AS $$
+               DECLARE
+                   month_start timestamp := date_trunc('month', since);
+                   partition_name text;
+                   created integer := 0;
+               BEGIN
+                   WHILE month_start < until LOOP
+                       partition_name := 'messages_' || to_char(month_start, 'YYYY_MM');
+                       IF to_regclass(partition_name) IS NULL THEN
+                           CREATE TEMP TABLE moved_messages (LIKE messages) ON COMMIT DROP;
+                           WITH moved AS (
+                               DELETE FROM messages
+                               WHERE creation_date >= month_start AND creation_date < month_start + interval '1 month'
+                               RETURNING id, body_id, from_id, to_id, is_visible, creation_date, is_read
+                           )
+                           INSERT INTO moved_messages(id, body_id, from_id, to_id, is_visible, creation_date, is_read)
+                           SELECT * FROM moved;
+                           EXECUTE format('CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+                                          partition_name, month_start, month_start + interval '1 month');
+                           INSERT INTO messages(id, body_id, from_id, to_id, is_visible, creation_date, is_read)
+                           SELECT id, body_id, from_id, to_id, is_visible, creation_date, is_read FROM moved_messages;
+                           DROP TABLE moved_messages;
+                           created := created + 1;
+                       END IF;
+                       month_start := month_start + interval '1 month';
+                   END LOOP;
+                   RETURN created;
+               END $$;""",
+        ],
+        'sqlite': [
+            """CREATE TABLE message_bodies (
+                   id INTEGER PRIMARY KEY,
+                   hash BLOB NOT NULL UNIQUE,
+                   text TEXT NOT NULL
+               );""",
+            # sha256() is registered by sqlite backend, CAST gives UTF-8 bytes of text
+            """INSERT INTO message_bodies(hash, text)
+               SELECT DISTINCT sha256(CAST(text AS BLOB)), text FROM messages;""",
+            # column added by ALTER TABLE can not be NOT NULL without default, models always set it
+            "ALTER TABLE messages ADD COLUMN body_id INTEGER REFERENCES message_bodies(id);",
+            """UPDATE messages SET body_id = (SELECT id FROM message_bodies
+                                             WHERE hash = sha256(CAST(messages.text AS BLOB)));""",
+            # text column can not be dropped while triggers use it - search moves to bodies
+            "DROP TRIGGER messages_fts_insert;",
+            "DROP TRIGGER messages_fts_delete;",
+            "DROP TRIGGER messages_fts_update;",
+            "DROP TABLE messages_fts;",
+            "ALTER TABLE messages DROP COLUMN text;",
+            "CREATE INDEX messages_body_idx ON messages (body_id);",
+            # bodies are never updated, only inserted and deleted by garbage collector
+            "CREATE VIRTUAL TABLE message_bodies_fts USING fts5(text, content='message_bodies', content_rowid='id');",
+            """CREATE TRIGGER message_bodies_fts_insert AFTER INSERT ON message_bodies BEGIN
+                   INSERT INTO message_bodies_fts(rowid, text) VALUES (new.id, new.text);
+               END;""",
+            """CREATE TRIGGER message_bodies_fts_delete AFTER DELETE ON message_bodies BEGIN
+                   INSERT INTO message_bodies_fts(message_bodies_fts, rowid, text) VALUES ('delete', old.id, old.text);
+               END;""",
+            "INSERT INTO message_bodies_fts(message_bodies_fts) VALUES ('rebuild');",
+        ],
+    }),
+    (10, 'no notifications about messages moved between partitions', {
+        'postgres': [
+            # moved rows are inserted again - they are old messages, not new ones
+            """CREATE OR REPLACE FUNCTION messages_notify() RETURNS trigger LANGUAGE plpgsql AS $$
+               BEGIN
+                   IF current_setting('warsztat2.moving_messages', true) = 'on' THEN
+                       RETURN NULL;
+                   END IF;
+                   PERFORM pg_notify('messages_' || to_id, id::text) FROM new_rows;
+                   RETURN NULL;
+               END $$;""",
+            # rows moved out of default partition are marked by moving_messages setting, messages_notify() skips them
+            """CREATE OR REPLACE FUNCTION ensure_message_partitions(since timestamp, until timestamp) RETURNS integer
+               LANGUAGE plpgsql AS $$
+               DECLARE
+                   month_start timestamp := date_trunc('month', since);
+                   partition_name text;
+                   created integer := 0;
+               BEGIN
+                   WHILE month_start < until LOOP
+                       partition_name := 'messages_' || to_char(month_start, 'YYYY_MM');
+                       IF to_regclass(partition_name) IS NULL THEN
+                           CREATE TEMP TABLE moved_messages (LIKE messages) ON COMMIT DROP;
+                           WITH moved AS (
+                               DELETE FROM messages
+                               WHERE creation_date >= month_start AND creation_date < month_start + interval '1 month'
+                               RETURNING id, body_id, from_id, to_id, is_visible, creation_date, is_read
+                           )
+                           INSERT INTO moved_messages(id, body_id, from_id, to_id, is_visible, creation_date, is_read)
+                           SELECT * FROM moved;
+                           EXECUTE format('CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+                                          partition_name, month_start, month_start + interval '1 month');
+                           PERFORM set_config('warsztat2.moving_messages', 'on', true);
+                           INSERT INTO messages(id, body_id, from_id, to_id, is_visible, creation_date, is_read)
+                           SELECT id, body_id, from_id, to_id, is_visible, creation_date, is_read FROM moved_messages;
+                           PERFORM set_config('warsztat2.moving_messages', 'off', true);
+                           DROP TABLE moved_messages;
+                           created := created + 1;
+                       END IF;
+                       month_start := month_start + interval '1 month';
+                   END LOOP;
+                   RETURN created;
+               END $$;""",
+        ],
+        # sqlite has no partitions nor notifications
+        'sqlite': [],
+    }),
+    (11, 'notify about changed users', {
+        # USER_CACHE_BACKEND=shared caches listen on users_changed and drop changed user, whichever process changed it
+        'postgres': [
+            """CREATE FUNCTION users_notify() RETURNS trigger LANGUAGE plpgsql AS $$
+               BEGIN
+                   PERFORM pg_notify('users_changed', old.id || ':' || old.username);
+                   RETURN NULL;
+               END $$;""",
+            """CREATE TRIGGER users_notify AFTER UPDATE OR DELETE ON users
+               FOR EACH ROW EXECUTE FUNCTION users_notify();""",
+        ],
+        # sqlite has no notifications
+        'sqlite': [],
+    }),
+]
+
+"""
+How many months ahead of current one ensure_partitions() creates messages partitions.
+"""
+partitions_ahead = int(os.environ.get('MESSAGES_PARTITIONS_AHEAD', 3))
+
+
+def statements_for_backend(statements):
+    """
+    :param statements: list of sql statements or dict {backend name: list of statements}
+    :return: list of sql statements for backend currently used by models
+    """
+    if isinstance(statements, dict):
+        return statements[models.backend.name]
+    return statements
+
+
+def ensure_migrations_table(_cursor):
+    """
+    Creates schema_migrations table if DB has not been migrated yet.
+
+    :param _cursor: parameter passed with connector decorator
+    :return: None
+    """
+    _cursor.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+                           version integer PRIMARY KEY,
+                           description text NOT NULL,
+                           applied_at timestamp NOT NULL
+                       );""")
+
+
+def current_version(_cursor):
+    """
+    :param _cursor: parameter passed with connector decorator
+    :return: version of last applied migration, 0 if none was applied
+    """
+    _cursor.execute("SELECT coalesce(max(version), 0) FROM schema_migrations;")
+    return _cursor.fetchone()[0]
+
+
+@connector
+def migrate(_cursor, target=None):
+    """
+    Applies all pending migrations up to target version, in order. Whole upgrade runs in one transaction,
+    so DB is never left half-migrated. Lock keeps two processes from migrating at the same time.
+
+    :param _cursor: parameter passed with connector decorator
+    :param target: version to upgrade to, int type. None means latest
+    :return: list of applied versions
+    """
+    models.backend.lock(_cursor, 'schema_migrations')
+    ensure_migrations_table(_cursor)
+    version = current_version(_cursor)
+    applied = list()
+    for migration_version, description, statements in MIGRATIONS:
+        if migration_version <= version or (target is not None and migration_version > target):
+            continue
+        for sql in statements_for_backend(statements):
+            _cursor.execute(sql)
+        _cursor.execute("INSERT INTO schema_migrations(version, description, applied_at) VALUES(%s, %s, %s);",
+                        (migration_version, description, datetime.utcnow()))
+        applied.append(migration_version)
+        print('Applied migration {}: {}'.format(migration_version, description))
+    ensure_partitions(_cursor)
+    return applied
+
+
+def ensure_partitions(_cursor, months_ahead=None):
+    """
+    Creates messages partitions for current month and months_ahead next ones, if they do not exist yet.
+    Run by migrate() and by archive job, so new messages land in their month partition, not in the default one.
+    Does nothing on backends without partitioning or before migration 6.
+
+    :param _cursor: parameter passed with connector decorator
+    :param months_ahead: number of future months, int type. Defaults to MESSAGES_PARTITIONS_AHEAD
+    :return: number of created partitions
+    """
+    if models.backend.name != 'postgres' or current_version(_cursor) < 6:
+        return 0
+    if months_ahead is None:
+        months_ahead = partitions_ahead
+    now = datetime.utcnow()
+    _cursor.execute("SELECT ensure_message_partitions(%s, %s + make_interval(months => %s));",
+                    (now, now, months_ahead + 1))
+    return _cursor.fetchone()[0]
+
+
+@connector
+def show_status(_cursor):
+    """
+    Prints all migrations, marking which of them are applied.
+
+    :param _cursor: parameter passed with connector decorator
+    :return: function has no return, prints migrations into console
+    """
+    ensure_migrations_table(_cursor)
+    version = current_version(_cursor)
+    for migration_version, description, statements in MIGRATIONS:
+        status = 'applied' if migration_version <= version else 'pending'
+        print("{}: {} [{}]".format(migration_version, description, status))
+
+
+def main():
+    parser = ArgumentParser(description='Creates and upgrades DB schema')
+    parser.add_argument('--target', type=int, help='upgrade up to this version, latest if not given')
+    parser.add_argument('--status', help='list migrations and show which are applied', action='store_true')
+    args = parser.parse_args()
+    if args.status:
+        return show_status()
+    if not migrate(args.target):
+        print('Schema is up to date')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+New messages are announced by DB trigger (migration 7) with NOTIFY on channel of recipient, payload is message id.
+It covers every insert - Message.save_to_db() and Message.save_many() alike. Listeners below keep one
+long-lived connection, outside of pool, and load announced messages on it, so waiting for messages
+costs no queries at all.
+"""
+import asyncio
+import models
+from models import Message
+import select
+
+
+def channel_name(user_id):
+    """
+    :param user_id: id of recipient, int or string type
+    :return: name of channel on which new messages of user are announced
+    """
+    return 'messages_{}'.format(int(user_id))
+
+
+def _notified_ids(cnx):
+    """
+    Reads pending notifications of connection.
+
+    :param cnx: listening connection
+    :return: list of announced message ids, int type
+    """
+    cnx.poll()
+    message_ids = list()
+    while cnx.notifies:
+        message_ids.append(int(cnx.notifies.pop(0).payload))
+    return message_ids
+
+
+def _load_notified(cnx, user_id, message_ids):
+    with cnx.cursor() as _cursor:
+        return Message.load_received_by_ids(_cursor, user_id, message_ids)
+
+
+def follow_messages(user_id):
+    """
+    Generator which waits for new messages sent to user and yields them as they arrive. Runs until closed.
+    Messages which recipient hid before they were loaded are skipped.
+
+    :param user_id: id of recipient
+    :return: generator of Message objects
+    """
+    cnx = models.backend.listen(channel_name(user_id))
+    try:
+        while True:
+            select.select([cnx], [], [])
+            message_ids = _notified_ids(cnx)
+            if message_ids:
+                for message in _load_notified(cnx, user_id, message_ids):
+                    yield message
+    finally:
+        cnx.close()
+
+
+async def follow_messages_async(user_id):
+    """
+    Async version of follow_messages(), for asyncio programs: async for message in follow_messages_async(user_id).
+    Waiting is done by event loop, queries run in default executor, so the loop is never blocked.
+
+    :param user_id: id of recipient
+    :return: async generator of Message objects
+    """
+    loop = asyncio.get_running_loop()
+    cnx = await loop.run_in_executor(None, models.backend.listen, channel_name(user_id))
+    readable = asyncio.Event()
+    loop.add_reader(cnx.fileno(), readable.set)
+    try:
+        while True:
+            await readable.wait()
+            readable.clear()
+            message_ids = _notified_ids(cnx)
+            if message_ids:
+                for message in await loop.run_in_executor(None, _load_notified, cnx, user_id, message_ids):
+                    yield message
+    finally:
+        loop.remove_reader(cnx.fileno())
+        cnx.close()
@@ -0,0 +1,175 @@
+import threading
+import time
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection could be checked out of the pool within the configured timeout.
+    """
+
+
+class PooledConnection:
+    """
+    Keeps DB connection together with its bookkeeping data used by ConnectionPool.
+    """
+    def __init__(self, cnx):
+        self.cnx = cnx
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+    def age(self):
+        return time.monotonic() - self.created_at
+
+    def idle_time(self):
+        return time.monotonic() - self.last_used
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of DB connections used by @connector.
+    Connections are opened lazily, on first checkout, and kept open between decorated calls.
+
+    Checkout does a health check: closed connections are dropped, connections idle longer than
+    check_interval are pinged with 'SELECT 1'. Connections older than max_age are recycled (closed and reopened).
+    """
+    def __init__(self, connect_func, min_size=1, max_size=10, max_age=300, timeout=30, check_interval=30):
+        """
+        :param connect_func: function with no arguments which returns new DB connection
+        :param min_size: number of connections opened when pool is used for the first time, int type
+        :param max_size: max number of connections opened at the same time, int type
+        :param max_age: max connection age in seconds, older connections are recycled. 0 disables recycling
+        :param timeout: how many seconds getconn() waits for free connection before it raises PoolTimeout
+        :param check_interval: connections idle longer than this (seconds) are pinged before checkout
+        """
+        if max_size < 1 or min_size > max_size:
+            raise ValueError('Invalid pool size, min: {}, max: {}'.format(min_size, max_size))
+        self.connect_func = connect_func
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_age = max_age
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self._idle = list()
+        self._used = dict()
+        self._opened = 0
+        self._initialized = False
+        self._condition = threading.Condition()
+
+    def _open(self):
+        return PooledConnection(self.connect_func())
+
+    def _is_expired(self, pooled):
+        return self.max_age and pooled.age() > self.max_age
+
+    def _is_healthy(self, pooled):
+        """
+        Checks if connection can be handed out. Pings DB only if connection has been idle for a while.
+
+        :param pooled: PooledConnection object
+        :return: True if connection is usable, otherwise False
+        """
+        if pooled.cnx.closed:
+            return False
+        if pooled.idle_time() < self.check_interval:
+            return True
+        try:
+            _cursor = pooled.cnx.cursor()
+            _cursor.execute('SELECT 1;')
+            _cursor.close()
+            pooled.cnx.rollback()
+        except Exception:
+            return False
+        return True
+
+    @staticmethod
+    def _close(pooled):
+        try:
+            pooled.cnx.close()
+        except Exception:
+            pass
+
+    def _initialize(self):
+        """
+        Opens min_size connections. Called with lock acquired, only once.
+        """
+        self._initialized = True
+        for i in range(0, self.min_size):
+            self._idle.append(self._open())
+            self._opened += 1
+
+    def getconn(self):
+        """
+        Checks out connection from the pool. Waits up to timeout seconds if all connections are in use.
+
+        :return: DB connection
+        """
+        deadline = time.monotonic() + self.timeout
+        with self._condition:
+            if not self._initialized:
+                self._initialize()
+            while True:
+                while self._idle:
+                    pooled = self._idle.pop()
+                    if self._is_expired(pooled) or not self._is_healthy(pooled):
+                        self._close(pooled)
+                        self._opened -= 1
+                        continue
+                    self._used[id(pooled.cnx)] = pooled
+                    return pooled.cnx
+                if self._opened < self.max_size:
+                    # reserve slot before connecting, so other threads respect max_size
+                    self._opened += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout('No free DB connection in pool after {}s'.format(self.timeout))
+                self._condition.wait(remaining)
+
+        try:
+            pooled = self._open()
+        except Exception:
+            with self._condition:
+                self._opened -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._used[id(pooled.cnx)] = pooled
+        return pooled.cnx
+
+    def putconn(self, cnx, discard=False):
+        """
+        Returns connection to the pool. Connection is closed instead if it is broken, too old or discard is True.
+
+        :param cnx: DB connection checked out with getconn()
+        :param discard: if True connection is closed, boolean type
+        :return: None
+        """
+        with self._condition:
+            pooled = self._used.pop(id(cnx))
+            if discard or cnx.closed or self._is_expired(pooled):
+                self._close(pooled)
+                self._opened -= 1
+            else:
+                pooled.last_used = time.monotonic()
+                self._idle.append(pooled)
+            self._condition.notify()
+
+    def closeall(self):
+        """
+        Closes all idle connections. Connections in use are closed when they are returned.
+
+        :return: None
+        """
+        with self._condition:
+            for pooled in self._idle:
+                self._close(pooled)
+                self._opened -= 1
+            self._idle = list()
+            self._initialized = False
+
+    def stats(self):
+        """
+        :return: dict with number of opened, idle and used connections
+        """
+        with self._condition:
+            return {'opened': self._opened, 'idle': len(self._idle), 'used': len(self._used)}
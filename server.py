@@ -0,0 +1,372 @@
+import models
+from models import Message, User, transaction
+from argparse import ArgumentParser
+from clcrypto import create_session_token, is_password_correct
+from helpers import load_user, logging_user, session_user
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from messages import parse_page_cursor, position_to_str, search_position_to_str, str_to_position, \
+    str_to_search_position
+from socketserver import ThreadingMixIn, UnixStreamServer
+import json
+import os
+
+
+class ApiError(Exception):
+    """
+    Raised by API operations, turned into JSON error response with given HTTP status.
+    """
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def authenticate(data, password_only=False):
+    """
+    Logs user in with session token issued by /login - checked by session_user(), no password hashing is done,
+    or loads user and validates his password, the same way users and messages programs do.
+
+    :param data: request body, dict with 'token' or with 'username' and 'password'
+    :param password_only: if True token is not accepted - used by operations which change account
+    :return: User class object
+    """
+    if data.get('token') and not password_only:
+        user = session_user(str(data['token']))
+        if not user:
+            raise ApiError(401, 'Session expired or invalid')
+        return user
+    user = load_user(username=data.get('username'), fresh=True)
+    if not logging_user(user, data.get('password') or ''):
+        raise ApiError(401, 'Invalid login')
+    return user
+
+
+def required(data, *names):
+    """
+    :param data: request body, dict type
+    :param names: names of fields which have to be in request body
+    :return: list of values of given fields
+    """
+    missing = [name for name in names if data.get(name) in (None, '')]
+    if missing:
+        raise ApiError(400, 'Missing fields: {}'.format(', '.join(missing)))
+    return [data[name] for name in names]
+
+
+def message_to_dict(message):
+    return {'id': message.id,
+            'from_id': message.from_id,
+            'from_username': message.from_username,
+            'to_id': message.to_id,
+            'to_username': message.to_username,
+            'text': message.text,
+            'is_visible': bool(message.is_visible),
+            'creation_date': message.creation_date.isoformat()}
+
+
+def take_page(messages, limit, position_of=lambda message: (message.creation_date, message.id)):
+    """
+    :param messages: iterable of Message objects, with one extra message fetched if there is limit
+    :param limit: max number of messages in page, int type. None means no limit
+    :param position_of: function which returns keyset position of message, (creation_date, id) by default
+    :return: tuple (list of message dicts, position of last message if there are more messages, otherwise None)
+    """
+    page = list()
+    for message in messages:
+        if limit and len(page) == limit:
+            return [message_to_dict(page_message) for page_message in page], position_of(page[-1])
+        page.append(message)
+    return [message_to_dict(page_message) for page_message in page], None
+
+
+def login(data):
+    user = authenticate({'username': data.get('username'), 'password': data.get('password')})
+    return {'token': create_session_token(user.id, user.username, user.hashed_password)}
+
+
+def create_user(data):
+    username, password = required(data, 'username', 'password')
+    if load_user(username=username):
+        raise ApiError(409, 'User {} already exists'.format(username))
+    if not is_password_correct(password):
+        raise ApiError(400, 'Password does not meet requirements')
+    user = User()
+    user.username = username
+    user.set_password(password)
+    save_user(user)
+    return {'id': user.id, 'username': user.username}
+
+
+def change_password(data):
+    required(data, 'username', 'password')
+    new_password, = required(data, 'new_password')
+    user = authenticate(data, password_only=True)
+    if not is_password_correct(new_password):
+        raise ApiError(400, 'Password does not meet requirements')
+    user.set_password(new_password)
+    save_user(user)
+    return {'id': user.id}
+
+
+def delete_user(data):
+    required(data, 'username', 'password')
+    user = authenticate(data, password_only=True)
+    user_id = user.id
+    with transaction() as unit:
+        user.delete(unit.cursor())
+    return {'id': user_id}
+
+
+def list_users(data):
+    with transaction() as unit:
+        return {'users': [{'id': user.id, 'username': user.username}
+                          for user in User.load_all_users(unit.cursor())]}
+
+
+def list_messages(data):
+    user = authenticate(data)
+    limit = data.get('limit')
+    page = parse_page_cursor(data.get('before'))
+    if page is None or (limit is not None and (not isinstance(limit, int) or limit < 1)):
+        raise ApiError(400, 'Invalid limit or page cursor')
+    sent_before, received_before, sent_done, received_done = page
+    fetch = limit + 1 if limit else None
+    sent, sent_position, received, received_position = list(), None, list(), None
+    with transaction() as unit:
+        if not sent_done:
+            sent, sent_position = take_page(
+                Message.iter_messages_by_user(unit.cursor(), user.id, fetch, sent_before), limit)
+        if not received_done:
+            received, received_position = take_page(
+                Message.iter_messages_for_user(unit.cursor(), user.id, fetch, received_before), limit)
+            Message.mark_read(unit.cursor(), user.id, [message['id'] for message in received])
+    next_page = None
+    if sent_position or received_position:
+        next_page = '{},{}'.format(position_to_str(sent_position), position_to_str(received_position))
+    return {'sent': sent, 'received': received, 'next': next_page}
+
+
+def conversation(data):
+    with_user, = required(data, 'with')
+    user = authenticate(data)
+    limit = data.get('limit')
+    try:
+        before = str_to_position(data['before']) if data.get('before') else None
+    except ValueError:
+        before = False
+    if before is False or (limit is not None and (not isinstance(limit, int) or limit < 1)):
+        raise ApiError(400, 'Invalid limit or page cursor')
+    other_user = load_user(username=with_user)
+    if not other_user:
+        raise ApiError(404, 'User {} not found'.format(with_user))
+    with transaction() as unit:
+        fetch = limit + 1 if limit else None
+        messages = Message.load_conversation(unit.cursor(), user.id, other_user.id, fetch, before)
+        older = None
+        if limit and len(messages) > limit:
+            messages = messages[1:]
+            older = position_to_str((messages[0].creation_date, messages[0].id))
+        Message.mark_read(unit.cursor(), user.id, [message.id for message in messages if message.to_id == user.id])
+    return {'messages': [message_to_dict(message) for message in messages], 'older': older}
+
+
+def search_messages(data):
+    query, = required(data, 'query')
+    if not isinstance(query, str) or not query.split():
+        raise ApiError(400, 'Search query is empty')
+    user = authenticate(data)
+    limit = data.get('limit')
+    try:
+        before = str_to_search_position(data['before']) if data.get('before') else None
+    except (AttributeError, ValueError):
+        before = False
+    if before is False or (limit is not None and (not isinstance(limit, int) or limit < 1)):
+        raise ApiError(400, 'Invalid limit or page cursor')
+    with transaction() as unit:
+        found = Message.search(unit.cursor(), user.id, query, limit + 1 if limit else None, before)
+        messages, last = take_page(found, limit, position_of=lambda message: (message.rank, message.id))
+    return {'messages': messages, 'next': search_position_to_str(last) if last else None}
+
+
+def count_messages(data):
+    user = authenticate(data)
+    with transaction() as unit:
+        return Message.mailbox_counters(unit.cursor(), user.id)
+
+
+def send_message(data):
+    to, text = required(data, 'to', 'text')
+    user = authenticate(data)
+    try:
+        recipients = list(dict.fromkeys(int(recipient) for recipient in (to if isinstance(to, list) else [to])))
+    except (TypeError, ValueError):
+        raise ApiError(400, 'Recipient ID has to be a number')
+    with transaction() as unit:
+        existing = User.existing_ids(unit.cursor(), recipients)
+        missing = [recipient for recipient in recipients if recipient not in existing]
+        if missing:
+            raise ApiError(404, 'Recipient ID not found: {}'.format(', '.join(str(item) for item in missing)))
+        new_messages = list()
+        for recipient in recipients:
+            new_message = Message()
+            new_message.to_id = recipient
+            new_message.text = text
+            new_message.from_id = user.id
+            new_messages.append(new_message)
+        Message.save_many(unit.cursor(), new_messages)
+    return {'ids': [message.id for message in new_messages]}
+
+
+def delete_message(data):
+    message_id, = required(data, 'message_id')
+    user = authenticate(data)
+    message_ids = message_id if isinstance(message_id, list) else [message_id]
+    with transaction() as unit:
+        results = Message.delete_many_for_user(unit.cursor(), message_ids, user.id)
+    if not isinstance(message_id, list):
+        result = results[str(message_id)]
+        if result == 'not found':
+            raise ApiError(404, 'Message ID not found')
+        if result == 'forbidden':
+            raise ApiError(403, 'You cannot delete this message, you are not sender nor recipient')
+    return {'results': results}
+
+
+def stats(data):
+    return {'user_cache': models.user_cache.stats(), 'pool': models.pool.stats(),
+            'metrics': models.query_metrics.to_dict()}
+
+
+def metrics(data):
+    # plain text result is sent as it is, for Prometheus scraper
+    return models.query_metrics.to_prometheus()
+
+
+def save_user(user):
+    with transaction() as unit:
+        user.save_to_db(unit.cursor())
+
+
+"""
+ROUTES maps (HTTP method, path) to operation. Operation gets request body as dict and returns dict sent as JSON
+(or string sent as plain text).
+Every request runs as one transaction.
+"""
+ROUTES = {
+    ('POST', '/login'): login,
+    ('POST', '/users'): create_user,
+    ('POST', '/users/password'): change_password,
+    ('POST', '/users/delete'): delete_user,
+    ('GET', '/users'): list_users,
+    ('POST', '/messages/list'): list_messages,
+    ('POST', '/messages/count'): count_messages,
+    ('POST', '/messages/conversation'): conversation,
+    ('POST', '/messages/search'): search_messages,
+    ('POST', '/messages/send'): send_message,
+    ('POST', '/messages/delete'): delete_message,
+    ('GET', '/stats'): stats,
+    ('GET', '/metrics'): metrics,
+}
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    """
+    Serves ROUTES as JSON API. Each request is handled in its own thread, using connections from models pool.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def handle_request(self, method):
+        operation = ROUTES.get((method, self.path.split('?')[0]))
+        try:
+            if operation is None:
+                raise ApiError(404, 'Unknown operation {} {}'.format(method, self.path))
+            length = int(self.headers.get('Content-Length') or 0)
+            try:
+                data = json.loads(self.rfile.read(length) or b'{}')
+            except ValueError:
+                raise ApiError(400, 'Request body has to be JSON')
+            if not isinstance(data, dict):
+                raise ApiError(400, 'Request body has to be JSON object')
+            with transaction():
+                result = operation(data)
+            # response is sent only after commit
+            if isinstance(result, str):
+                self.send_text(200, result)
+            else:
+                self.send_json(200, result)
+        except ApiError as error:
+            self.send_json(error.status, {'error': error.message})
+        except Exception as error:
+            self.log_error('%s %s failed: %r', method, self.path, error)
+            self.send_json(500, {'error': 'Internal server error'})
+
+    def send_json(self, status, body):
+        self.send_payload(status, 'application/json', json.dumps(body).encode('utf-8'))
+
+    def send_text(self, status, body):
+        self.send_payload(status, 'text/plain; version=0.0.4', body.encode('utf-8'))
+
+    def send_payload(self, status, content_type, payload):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def address_string(self):
+        # unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix-socket'
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def main(parser):
+    """
+    Starts API server - on TCP host and port, or on unix socket if --unix-socket is given.
+    Serves until interrupted.
+
+    :param parser: ArgumentParser class. Created in set_parser_arguments()
+    :return: function has no return
+    """
+    args = parser.parse_args()
+    if args.unix_socket:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = ThreadingUnixHTTPServer(args.unix_socket, ApiHandler)
+        print('Serving on unix socket {}'.format(args.unix_socket))
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), ApiHandler)
+        print('Serving on http://{}:{}'.format(args.host, args.port))
+    # shared user cache starts listening for changes of users before first request
+    models.user_cache.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def set_parser_arguments():
+    """
+    Sets all parser arguments.
+
+    :return: ArgumentParser class object which is used in main()
+    """
+    parser = ArgumentParser(description='Serves users and messages operations as JSON API')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on')
+    parser.add_argument('--unix-socket', type=str, help='listen on unix socket with given path instead of TCP')
+    return parser
+
+
+if __name__ == '__main__':
+    main(set_parser_arguments())
@@ -0,0 +1,60 @@
+import io
+import shlex
+import unittest
+from contextlib import redirect_stdout
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import mock
+
+import messages
+
+
+def fake_message(message_id, day):
+    return SimpleNamespace(id=message_id, text='message {}'.format(message_id), creation_date=datetime(2026, 1, day),
+                           from_id=2, from_username='bob', to_id=1, to_username='ala')
+
+
+class PageCursorTest(unittest.TestCase):
+    def print_page(self, sent, received, limit, before=None):
+        """
+        Runs load_user_messages() without DB - Message queries return given lists.
+
+        :return: printed text
+        """
+        output = io.StringIO()
+        with mock.patch.object(messages, 'Message') as message_model, redirect_stdout(output):
+            message_model.iter_messages_by_user.return_value = iter(sent)
+            message_model.iter_messages_for_user.return_value = iter(received)
+            messages.load_user_messages.__wrapped__(None, SimpleNamespace(id=1), limit, before)
+        return output.getvalue()
+
+    def next_page_args(self, printed):
+        """
+        :return: arguments of the next page command, parsed with set_parser_arguments()
+        """
+        hint = [line for line in printed.splitlines() if line.startswith('Next page: ')]
+        self.assertEqual(len(hint), 1)
+        command = '-u ala -p Secret123 -l --limit 1 ' + hint[0][len('Next page: '):]
+        return messages.set_parser_arguments().parse_args(shlex.split(command))
+
+    def test_cursor_of_finished_sent_section_is_accepted_by_parser(self):
+        printed = self.print_page([], [fake_message(3, 3), fake_message(2, 2)], 1)
+        args = self.next_page_args(printed)
+        self.assertEqual(messages.parse_page_cursor(args.before), (None, (datetime(2026, 1, 3), 3), True, False))
+
+    def test_cursor_of_both_sections_is_accepted_by_parser(self):
+        printed = self.print_page([fake_message(5, 5), fake_message(4, 4)], [fake_message(3, 3), fake_message(2, 2)], 1)
+        args = self.next_page_args(printed)
+        self.assertEqual(messages.parse_page_cursor(args.before),
+                         ((datetime(2026, 1, 5), 5), (datetime(2026, 1, 3), 3), False, False))
+
+    def test_printed_cursor_continues_listing(self):
+        printed = self.print_page([], [fake_message(3, 3), fake_message(2, 2)], 1)
+        args = self.next_page_args(printed)
+        printed = self.print_page([], [fake_message(2, 2)], 1, args.before)
+        self.assertIn('message 2', printed)
+        self.assertNotIn('Next page', printed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,10 @@
-from models import User, connector
+from models import User, connector, transaction
 from argparse import ArgumentParser
-from clcrypto import is_password_correct
-from helpers import load_user, args_to_be_empty, args_required, logging_user
+from clcrypto import is_password_correct, password_hash
+import csv
+import os
+import time
+from helpers import load_user, args_to_be_empty, args_required, authenticate, login
 
 
 @connector
@@ -69,6 +72,120 @@ def load_all_users_in_db(_cursor):
         print("id: {}; username: {}".format(user.id, user.username))
 
 
+def read_import_batches(path, batch_size):
+    """
+    Streams csv file with 'username,password' rows and yields them in batches, so file is never loaded at once.
+    First row is skipped if it is a 'username,password' header.
+
+    :param path: path to csv file, string type
+    :param batch_size: number of rows in one batch, int type
+    :return: generator of lists of (line number, row) tuples
+    """
+    with open(path, newline='') as file:
+        batch = list()
+        for line_no, row in enumerate(csv.reader(file), 1):
+            if not row or (line_no == 1 and [cell.strip().lower() for cell in row] == ['username', 'password']):
+                continue
+            batch.append((line_no, row))
+            if len(batch) == batch_size:
+                yield batch
+                batch = list()
+        if batch:
+            yield batch
+
+
+def validate_import_batch(batch, seen):
+    """
+    Validates rows of one import batch. Prints why invalid rows are skipped.
+
+    :param batch: list of (line number, row) tuples, from read_import_batches()
+    :param seen: set of usernames already imported from the file, updated by this function
+    :return: list of (line number, username, password) tuples which can be imported
+    """
+    valid = list()
+    for line_no, row in batch:
+        if len(row) != 2 or not row[0].strip():
+            print('Line {}: expected username,password - skipped'.format(line_no))
+            continue
+        username, password = row[0].strip(), row[1]
+        if username in seen:
+            print('Line {}: user {} is duplicated in file - skipped'.format(line_no, username))
+            continue
+        if not is_password_correct(password):
+            print('Line {}: user {} skipped'.format(line_no, username))
+            continue
+        seen.add(username)
+        valid.append((line_no, username, password))
+    return valid
+
+
+def skip_taken_users(valid, taken):
+    """
+    Prints which rows are skipped because their usernames are already in DB.
+
+    :param valid: list of (line number, username, password) tuples, from validate_import_batch()
+    :param taken: set of usernames which exist in DB
+    :return: list of rows of valid with usernames which are not taken
+    """
+    for line_no, username, password in valid:
+        if username in taken:
+            print('Line {}: user {} already exists - skipped'.format(line_no, username))
+    return [row for row in valid if row[1] not in taken]
+
+
+def import_users(path, batch_size=5000, workers=None):
+    """
+    Imports users from csv file with 'username,password' rows. File is processed in batches:
+    rows are validated, usernames already in DB are found with one query,
+    passwords are hashed in parallel in process pool and new users are loaded with COPY.
+    Each batch is committed in its own transaction, so imported users are saved as progress is printed.
+    Batch which fails is reported and skipped, the next ones are still imported.
+    Prints progress after each batch and rows/sec summary at the end.
+
+    :param path: path to csv file, string type
+    :param batch_size: number of rows processed in one batch, int type
+    :param workers: number of processes hashing passwords, int type. Defaults to number of CPUs
+    :return: function has no return. Prints progress and summary
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    if not os.path.isfile(path):
+        print('Import file {} not found'.format(path))
+        return
+    workers = workers or os.cpu_count() or 1
+    start = time.monotonic()
+    imported = 0
+    processed = 0
+    seen = set()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for batch in read_import_batches(path, batch_size):
+            processed += len(batch)
+            valid = validate_import_batch(batch, seen)
+            with transaction() as unit:
+                taken = User.existing_usernames(unit.cursor(), [username for line_no, username, password in valid])
+            valid = skip_taken_users(valid, taken)
+            # passwords are hashed outside of transaction - it would hold DB locks (sqlite write lock) meanwhile
+            chunksize = max(1, len(valid) // (workers * 4))
+            hashes = list(executor.map(password_hash, [password for line_no, username, password in valid],
+                                       chunksize=chunksize))
+            try:
+                with transaction() as unit:
+                    # users created by others while passwords were hashed
+                    taken = User.existing_usernames(unit.cursor(), [username for line_no, username, password in valid])
+                    rows = [(username, hashed) for (line_no, username, password), hashed in zip(valid, hashes)
+                            if username not in taken]
+                    skip_taken_users(valid, taken)
+                    saved = User.copy_many(unit.cursor(), rows)
+                # counted after commit
+                imported += saved
+            except Exception as error:
+                print('Lines {}-{}: batch not imported - {}'.format(batch[0][0], batch[-1][0], error))
+            print('Processed {} rows, imported {} users'.format(processed, imported))
+    elapsed = time.monotonic() - start
+    print('Imported {} of {} users in {:.2f}s ({:.0f} rows/sec)'.format(
+        imported, processed, elapsed, processed / elapsed if elapsed else 0))
+
+
 def main(parser):
     """
     Main function of program. Collects all arguments from parser parameter.
@@ -78,6 +195,7 @@ def main(parser):
         1. --username , --password are only given:
             a) Save new user - launches save_new_user() if load_user() returns None (no user with given username in DB)
             b) If user is in DB - print statement informing that more arguments have to be passed.
+        Scenarios 2 and 3 always need --password, session token from --login is not enough to change account.
         2. --username, --password, --edit, --newpass are given:
             a) Changes password - launches change_password() only if logging_user() is successful.
             b) Returns None if logging has failed, logging_user() prints fail reason.
@@ -86,7 +204,11 @@ def main(parser):
             b) Returns None if logging has failed, logging_user() prints fail reason.
         4. --list is given:
             Launches load_all_users_in_db() which prints all users in DB
-        5. Else scenario:
+        5. --import is given:
+            Launches import_users() which creates users listed in csv file
+        6. --username, --password, --login are given:
+            Logs user in and saves session token in credentials cache.
+        7. Else scenario:
             In any other case - function prints --help
 
     :param parser: ArgumentParser class. Created in set_parser_arguments()
@@ -99,27 +221,29 @@ def main(parser):
     users_list = args.list
     delete = args.delete
     edit = args.edit
-
-    user = load_user(username=username)
+    import_file = args.import_file
+    log_in = args.login
 
     # Scenario no. 1
-    if args_required(username, password) and args_to_be_empty(new_pass, users_list, delete, edit):
-        if not user:
+    if args_required(username, password) and args_to_be_empty(new_pass, users_list, delete, edit, log_in):
+        if not load_user(username=username):
             return save_new_user(username, password)
         else:
             print('Please add arguments, your query is empty')
             return
 
     # Scenario no. 2
-    elif args_required(username, password, edit, new_pass) and args_to_be_empty(delete, users_list):
-        if logging_user(user, password):
+    elif args_required(username, password, edit, new_pass) and args_to_be_empty(delete, users_list, log_in):
+        user = authenticate(username, password)
+        if user:
             return change_password(user, new_pass)
         else:
             return
 
     # Scenario no. 3
-    elif args_required(username, password, delete) and args_to_be_empty(new_pass, users_list, edit):
-        if logging_user(user, password):
+    elif args_required(username, password, delete) and args_to_be_empty(new_pass, users_list, edit, log_in):
+        user = authenticate(username, password)
+        if user:
             return delete_user(user)
         else:
             return
@@ -129,12 +253,24 @@ def main(parser):
         return load_all_users_in_db()
 
     # Scenario no. 5
+    elif args_required(import_file) and args_to_be_empty(username, password, delete, edit, new_pass, users_list):
+        return import_users(import_file, args.batch_size, args.workers)
+
+    # Scenario no. 6
+    elif args_required(username, password, log_in) and args_to_be_empty(new_pass, users_list, delete, edit):
+        if login(username, password):
+            print('Logged in! Next commands can skip --password until session expires')
+        return
+
+    # Scenario no. 7
     else:
         print("""You have used wrong arguments combination. See below scenarios:
         -u USERNAME -p PASSWORD | creates new user
         -u USERNAME -p PASSWORD -n NEWPASS -e | sets new password
         -u USERNAME -p PASSWORD -d | deletes user
         -l | prints all users
+        --import FILE [--batch-size N] [--workers N] | creates users from csv file with username,password rows
+        -u USERNAME -p PASSWORD --login | logs in, next commands of USERNAME can skip -p
         For more see below""")
         return parser.print_help()
 
@@ -167,8 +303,29 @@ def set_parser_arguments():
                         help='edit your user profile - change password. Only a-Z, 0-9 chars and min 8 chars long',
                         action="store_true"
                         )
+    parser.add_argument('--login',
+                        help='log in and save session token, so next commands do not need password',
+                        action='store_true'
+                        )
+    parser.add_argument('--import', type=str, dest='import_file',
+                        help='create users from csv file with username,password rows'
+                        )
+    parser.add_argument('--batch-size', type=int, default=5000,
+                        help='with --import: number of users hashed and saved in one batch'
+                        )
+    parser.add_argument('--workers', type=int,
+                        help='with --import: number of processes hashing passwords, defaults to number of CPUs'
+                        )
     return parser
 
 
-parser_args = set_parser_arguments()
-main(parser_args)
\ No newline at end of file
+# guard keeps --import worker processes from running the program again when they import this module
+if __name__ == '__main__':
+    parser_args = set_parser_arguments()
+    if parser_args.parse_args().import_file:
+        # --import commits batch by batch in import_users(), so it runs outside of command transaction
+        main(parser_args)
+    else:
+        # whole command - login lookup, checks and writes - runs as one transaction with single commit
+        with transaction():
+            main(parser_args)
\ No newline at end of file